@@ -0,0 +1 @@
+"""Akash2API 性能基准工具：上游替身服务与回放压测"""
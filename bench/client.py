@@ -0,0 +1,134 @@
+"""OpenAI 流式客户端与延迟统计工具，供回放基准与压测共用"""
+import json
+import math
+import time
+
+import requests
+
+
+def stream_chat_completion(session: requests.Session, base_url: str, api_key: str, payload: dict,
+                           timeout: float = 300) -> dict:
+    """发送一次流式 chat completion 请求，记录首个内容块时间（TTFT）与总耗时"""
+    result = {
+        "model": payload.get("model"),
+        "ok": False,
+        "status": None,
+        "ttft": None,
+        "latency": None,
+        "chunks": 0,
+        "bytes": 0,
+        "error": None
+    }
+    start = time.perf_counter()
+    try:
+        with session.post(
+            f"{base_url}/v1/chat/completions",
+            json={**payload, "stream": True},
+            headers={"Authorization": f"Bearer {api_key}"},
+            stream=True,
+            timeout=timeout
+        ) as response:
+            result["status"] = response.status_code
+            if response.status_code != 200:
+                result["error"] = f"http_{response.status_code}"
+                result["bytes"] = len(response.content)
+                return result
+            done = False
+            for line in response.iter_lines():
+                result["bytes"] += len(line) + 1
+                if not line.startswith(b"data: "):
+                    continue
+                data = line[6:]
+                if data == b"[DONE]":
+                    done = True
+                    break
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    result["error"] = "stream_error"
+                    break
+                result["chunks"] += 1
+                if result["ttft"] is None:
+                    result["ttft"] = time.perf_counter() - start
+            if done and result["error"] is None:
+                result["ok"] = True
+            elif result["error"] is None:
+                result["error"] = "truncated"
+    except requests.exceptions.Timeout:
+        result["error"] = "timeout"
+    except requests.exceptions.ConnectionError:
+        result["error"] = "connection_error"
+    except ValueError:
+        result["error"] = "invalid_chunk"
+    finally:
+        result["latency"] = time.perf_counter() - start
+    return result
+
+
+def list_models(session: requests.Session, base_url: str, api_key: str, timeout: float = 60) -> dict:
+    """请求 /v1/models，返回与 stream_chat_completion 相同结构的结果"""
+    result = {"model": "models", "ok": False, "status": None, "ttft": None, "latency": None,
+              "chunks": 0, "bytes": 0, "error": None}
+    start = time.perf_counter()
+    try:
+        response = session.get(f"{base_url}/v1/models", headers={"Authorization": f"Bearer {api_key}"}, timeout=timeout)
+        result["status"] = response.status_code
+        result["bytes"] = len(response.content)
+        result["ttft"] = response.elapsed.total_seconds()
+        if response.status_code != 200:
+            result["error"] = f"http_{response.status_code}"
+        elif "data" not in response.json():
+            result["error"] = "invalid_response"
+        else:
+            result["ok"] = True
+    except requests.exceptions.Timeout:
+        result["error"] = "timeout"
+    except requests.exceptions.ConnectionError:
+        result["error"] = "connection_error"
+    except ValueError:
+        result["error"] = "invalid_response"
+    finally:
+        result["latency"] = time.perf_counter() - start
+    return result
+
+
+def percentile(values: list, p: float):
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(p * len(ordered) / 100.0) - 1))
+    return ordered[index]
+
+
+def latency_summary(values: list) -> dict:
+    """延迟分布摘要（秒）"""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(percentile(values, 50), 4),
+        "p90": round(percentile(values, 90), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4)
+    }
+
+
+def summarize(results: list, wall_time: float) -> dict:
+    """汇总一批请求结果：吞吐、TTFT、延迟分布与错误分类"""
+    ok = [r for r in results if r["ok"]]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "failed": len(results) - len(ok),
+        "wall_seconds": round(wall_time, 3),
+        "throughput_rps": round(len(ok) / wall_time, 3) if wall_time else 0.0,
+        "chunks_per_second": round(sum(r["chunks"] for r in ok) / wall_time, 2) if wall_time else 0.0,
+        "ttft": latency_summary([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "latency": latency_summary([r["latency"] for r in ok]),
+        "errors": errors
+    }
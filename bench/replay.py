@@ -0,0 +1,286 @@
+"""回放基准：在本地替身上游之上驱动 /v1/chat/completions 并报告性能指标
+
+启动 bench.stub_upstream 与一个指向它的代理进程，按给定并发与提示词组合发送
+请求，输出吞吐、TTFT、p99 延迟以及代理进程的 CPU 与 RSS。可与基线结果比较，
+超出容忍度时以非零状态码退出，便于在部署前发现 generate() 与 cookie 路径的性能回退。
+
+用法: python -m bench.replay --requests 200 --concurrency 16 --mix short=6,long=3,image=1
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench.client import stream_chat_completion, summarize
+from bench.stub_upstream import DEFAULT_TRANSCRIPT, load_transcript, start_stub
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_API_KEY = "bench-key"
+BENCH_COOKIE = "cf_clearance=bench-clearance; session_token=bench-session"
+
+
+def build_prompt(kind: str) -> dict:
+    """按类型构造请求体：short 单轮提问，long 多轮长对话，image 图片生成"""
+    if kind == "image":
+        return {"model": "AkashGen", "messages": [{"role": "user", "content": "a red fox in a snowy forest, golden hour"}]}
+    if kind == "long":
+        messages = []
+        for turn in range(12):
+            messages.append({"role": "user", "content": f"Question {turn}: " + "explain the trade-offs in detail. " * 20})
+            messages.append({"role": "assistant", "content": f"Answer {turn}: " + "here is a thorough explanation. " * 30})
+        messages.append({"role": "user", "content": "Summarize everything above in one paragraph."})
+        return {"model": "DeepSeek-R1", "messages": messages}
+    return {"model": "DeepSeek-R1", "messages": [{"role": "user", "content": "What is the capital of France?"}]}
+
+
+def parse_mix(raw: str) -> list:
+    """解析 "short=6,long=3,image=1" 形式的权重配置，回放基准与压测（loadtest）共用"""
+    mix = []
+    for item in raw.split(","):
+        name, _, weight = item.partition("=")
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _read_stat(pid: int) -> list:
+    """读取 /proc/<pid>/stat 中进程名之后的字段"""
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().rsplit(")", 1)[1].split()
+
+
+def process_tree(root: int) -> list:
+    """返回 root 及其所有子孙进程的 pid（用于统计 uvicorn 多 worker）"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            children.setdefault(int(_read_stat(int(entry))[1]), []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    pids, stack = [], [root]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, []))
+    return pids
+
+
+class ProcessSampler:
+    """采样 /proc 中代理进程（含 worker 子进程）的 CPU 时间与 RSS（仅 Linux）"""
+
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.rss_samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def cpu_seconds(self) -> float:
+        total = 0.0
+        for pid in process_tree(self.pid):
+            try:
+                fields = _read_stat(pid)
+                total += (int(fields[11]) + int(fields[12])) / self._ticks
+            except (OSError, IndexError, ValueError):
+                continue
+        return total
+
+    def rss_mb(self) -> float:
+        total = 0.0
+        for pid in process_tree(self.pid):
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1]) / 1024.0
+                            break
+            except OSError:
+                continue
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.rss_samples.append(self.rss_mb())
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._cpu_start = self.cpu_seconds()
+        self._rss_start = self.rss_mb()
+        self._thread.start()
+
+    def stop(self) -> dict:
+        self._stop.set()
+        self._thread.join()
+        samples = [s for s in self.rss_samples if s] or [0.0]
+        return {
+            "cpu_seconds": round(self.cpu_seconds() - self._cpu_start, 3),
+            "rss_start_mb": round(self._rss_start, 1),
+            "rss_peak_mb": round(max(samples), 1),
+            "rss_end_mb": round(samples[-1], 1)
+        }
+
+
+def start_proxy(upstream_url: str, port: int, extra_env: dict = None, workers: int = 1) -> subprocess.Popen:
+    """以子进程方式启动指向替身上游的代理"""
+    env = dict(os.environ)
+    env.update({
+        "AKASH_BASE_URL": upstream_url,
+        "AKASH_COOKIE": BENCH_COOKIE,
+        "IMAGE_UPLOAD_URL": f"{upstream_url}/api/jdtc",
+        "OPENAI_API_KEY": BENCH_API_KEY
+    })
+    env.update(extra_env or {})
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--workers", str(workers)],
+        cwd=REPO_ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Proxy exited during startup with code {process.returncode}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return process
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Proxy did not become ready within 30s")
+
+
+def run_load(base_url: str, total: int, concurrency: int, mix: list, seed: int) -> tuple:
+    """按并发数发送 total 个请求，返回 (结果列表, 墙钟时间)"""
+    rng = random.Random(seed)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    kinds = rng.choices(names, weights=weights, k=total)
+    local = threading.local()
+
+    def one(kind):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        result = stream_chat_completion(local.session, base_url, BENCH_API_KEY, build_prompt(kind))
+        result["kind"] = kind
+        return result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, kinds))
+    return results, time.perf_counter() - start
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """与基线比较，返回超出容忍度的指标说明"""
+    checks = [
+        ("throughput_rps", report["summary"]["throughput_rps"], baseline["summary"]["throughput_rps"], False),
+        ("latency_p99", report["summary"]["latency"].get("p99"), baseline["summary"]["latency"].get("p99"), True),
+        ("ttft_p99", report["summary"]["ttft"].get("p99"), baseline["summary"]["ttft"].get("p99"), True),
+        ("cpu_seconds_per_request", report["process"]["cpu_seconds_per_request"], baseline["process"]["cpu_seconds_per_request"], True),
+        ("rss_peak_mb", report["process"]["rss_peak_mb"], baseline["process"]["rss_peak_mb"], True)
+    ]
+    regressions = []
+    for name, current, previous, higher_is_worse in checks:
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if (change > tolerance) if higher_is_worse else (-change > tolerance):
+            regressions.append(f"{name}: {previous} -> {current} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Akash traffic through the proxy and report performance")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mix", default="short=6,long=3,image=1", help="prompt mix weights: short, long, image")
+    parser.add_argument("--transcript", default=DEFAULT_TRANSCRIPT)
+    parser.add_argument("--speed", type=float, default=1.0, help="upstream replay speed multiplier (0 = no delays)")
+    parser.add_argument("--warmup", type=int, default=5, help="requests sent before measuring")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the proxy process (repeatable)")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="previous JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression vs baseline")
+    args = parser.parse_args()
+
+    stub, stub_state = start_stub(transcript=load_transcript(args.transcript), speed=args.speed)
+    upstream_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    port = free_port()
+    extra_env = dict(item.split("=", 1) for item in args.proxy_env)
+    proxy = start_proxy(upstream_url, port, extra_env)
+    base_url = f"http://127.0.0.1:{port}"
+    mix = parse_mix(args.mix)
+
+    try:
+        if args.warmup:
+            run_load(base_url, args.warmup, min(args.warmup, args.concurrency), [("short", 1)], args.seed)
+        sampler = ProcessSampler(proxy.pid)
+        sampler.start()
+        results, wall_time = run_load(base_url, args.requests, args.concurrency, mix, args.seed)
+        process_stats = sampler.stop()
+    finally:
+        proxy.terminate()
+        try:
+            proxy.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proxy.kill()
+        stub.shutdown()
+
+    succeeded = sum(1 for r in results if r["ok"])
+    process_stats["cpu_percent"] = round(100 * process_stats["cpu_seconds"] / wall_time, 1) if wall_time else 0.0
+    process_stats["cpu_seconds_per_request"] = round(process_stats["cpu_seconds"] / succeeded, 5) if succeeded else None
+    report = {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "mix": args.mix,
+            "speed": args.speed,
+            "transcript": os.path.relpath(args.transcript, REPO_ROOT)
+        },
+        "summary": summarize(results, wall_time),
+        "by_kind": {
+            kind: summarize([r for r in results if r["kind"] == kind], wall_time)
+            for kind in sorted({r["kind"] for r in results})
+        },
+        "process": process_stats,
+        "upstream": dict(stub_state.counters)
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("Performance regressions detected:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
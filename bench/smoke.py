@@ -0,0 +1,107 @@
+"""冒烟检查：在替身上游上分别以 requests 与 curl_cffi 传输运行代理，验证聊天与 AkashGen 图片流程
+
+每种传输启动一个代理进程，发送 DeepSeek-R1 与 AkashGen 的流式和非流式请求，
+检查响应正常结束（流式以 [DONE] 结尾且没有 error 事件）、内容不为空，且 AkashGen 返回了图片链接。
+任一检查失败时以非零状态码退出，便于在修改传输或会话生命周期后快速回归。
+
+用法: python -m bench.smoke [--transports requests,curl_cffi] [--speed 0]
+"""
+import argparse
+import importlib.util
+import json
+import subprocess
+import sys
+
+import requests
+
+from bench.replay import BENCH_API_KEY, build_prompt, free_port, start_proxy
+from bench.stub_upstream import DEFAULT_TRANSCRIPT, load_transcript, start_stub
+
+# 每个模型对应的提示词类型（见 bench.replay.build_prompt）
+CHECKS = [("DeepSeek-R1", "short"), ("AkashGen", "image")]
+
+
+def complete(base_url: str, payload: dict, stream: bool, timeout: float = 120) -> str:
+    """发送请求并返回拼接后的 assistant 内容；状态码不对、流中出错或未以 [DONE] 结束时抛出 AssertionError"""
+    with requests.post(
+        f"{base_url}/v1/chat/completions",
+        json={**payload, "stream": stream},
+        headers={"Authorization": f"Bearer {BENCH_API_KEY}"},
+        stream=stream,
+        timeout=timeout
+    ) as response:
+        assert response.status_code == 200, f"http_{response.status_code}: {response.text[:200]}"
+        if not stream:
+            return response.json()["choices"][0]["message"]["content"] or ""
+        content = []
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            if line[6:] == b"[DONE]":
+                return "".join(content)
+            chunk = json.loads(line[6:])
+            assert "error" not in chunk, f"stream error: {chunk['error']}"
+            for choice in chunk["choices"]:
+                content.append(choice["delta"].get("content") or "")
+    raise AssertionError("stream ended without [DONE]")
+
+
+def check_transport(upstream_url: str, transport: str) -> list:
+    """以指定传输启动代理并运行全部检查，返回失败说明列表"""
+    failures = []
+    port = free_port()
+    proxy = start_proxy(upstream_url, port, {"UPSTREAM_TRANSPORT": transport, "REASONING_MODE": "inline"})
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        for model, kind in CHECKS:
+            for stream in (True, False):
+                mode = "stream" if stream else "non-stream"
+                try:
+                    content = complete(base_url, build_prompt(kind), stream)
+                    assert content, "empty content"
+                    if model == "AkashGen":
+                        assert "![Generated Image](" in content, f"no image in reply: {content[-120:]!r}"
+                except (AssertionError, requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    failures.append(f"{transport} {model} {mode}: {e}")
+    finally:
+        proxy.terminate()
+        try:
+            proxy.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proxy.kill()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smoke-test chat and AkashGen over each upstream transport")
+    parser.add_argument("--transports", default="requests,curl_cffi", help="comma-separated UPSTREAM_TRANSPORT values")
+    parser.add_argument("--transcript", default=DEFAULT_TRANSCRIPT)
+    parser.add_argument("--speed", type=float, default=0, help="upstream replay speed multiplier (0 = no delays)")
+    args = parser.parse_args()
+
+    stub, stub_state = start_stub(transcript=load_transcript(args.transcript), speed=args.speed)
+    upstream_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    report = {}
+    failures = []
+    try:
+        for transport in args.transports.split(","):
+            transport = transport.strip()
+            if transport == "curl_cffi" and importlib.util.find_spec("curl_cffi") is None:
+                report[transport] = "skipped: curl_cffi is not installed"
+                continue
+            transport_failures = check_transport(upstream_url, transport)
+            report[transport] = transport_failures or "ok"
+            failures.extend(transport_failures)
+    finally:
+        stub.shutdown()
+
+    print(json.dumps({"transports": report, "upstream": dict(stub_state.counters)}, indent=2))
+    if failures:
+        print("Smoke checks failed:", file=sys.stderr)
+        for line in failures:
+            print(f"  {line}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""回放录制的 Akash 上游响应的本地替身服务
+
+提供 /api/chat、/api/models、/api/image-status、/api/image/* 以及图床上传接口，
+按照录制文件中的首字节延迟与逐行间隔回放流式响应，用于基准测试与压测。
+
+用法: python -m bench.stub_upstream --port 8901 [--transcript bench/transcripts/akash.json]
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_TRANSCRIPT = os.path.join(os.path.dirname(__file__), "transcripts", "akash.json")
+
+
+def load_transcript(path: str = DEFAULT_TRANSCRIPT) -> dict:
+    """读取录制文件"""
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class StubState:
+    """替身服务的共享状态：录制数据、图片任务轮询次数与请求计数"""
+
+    def __init__(self, transcript: dict, speed: float = 1.0):
+        self.transcript = transcript
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.job_polls = {}
+        self.counters = {"chat": 0, "models": 0, "image_status": 0, "image": 0, "upload": 0, "aborted": 0, "page": 0}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def sleep_ms(self, ms: float):
+        if ms and self.speed > 0:
+            time.sleep(ms / 1000.0 / self.speed)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status: int = 200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        transcript = self.state.transcript
+        if parsed.path == "/api/models":
+            self.state.count("models")
+            self._send_json(transcript["models"])
+        elif parsed.path == "/api/image-status":
+            self.state.count("image_status")
+            job_id = parse_qs(parsed.query).get("ids", [""])[0]
+            self._send_json([self._image_status(job_id)])
+        elif parsed.path.startswith("/api/image/"):
+            self.state.count("image")
+            body = base64.b64decode(transcript["image_status"]["image_b64"])
+            self.send_response(200)
+            self.send_header("Content-Type", "image/webp")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif parsed.path == "/":
+            self._send_page()
+        elif parsed.path.startswith("/uploads/"):
+            self._send_json({"ok": True})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _send_page(self):
+        """首页：带 cf_clearance 时像真实站点一样下发新的 session_token，否则返回 Cloudflare 质询"""
+        self.state.count("page")
+        if "cf_clearance=" not in (self.headers.get("Cookie") or ""):
+            body = b"<html><title>Just a moment...</title></html>"
+            self.send_response(403)
+            self.send_header("cf-mitigated", "challenge")
+        else:
+            body = b"<html><title>Akash Chat</title></html>"
+            self.send_response(200)
+            expires = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 3600))
+            self.send_header("Set-Cookie", f"session_token={uuid.uuid4().hex}; Path=/; Expires={expires}; HttpOnly")
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        body = self._read_body()
+        if parsed.path == "/api/chat":
+            self.state.count("chat")
+            self._stream_chat(json.loads(body or b"{}"))
+        elif parsed.path == "/api/jdtc":
+            # 图床上传接口（新野图床格式）
+            self.state.count("upload")
+            url = f"http://{self.headers.get('Host')}/uploads/{uuid.uuid4().hex}.webp"
+            self._send_json({"errno": 0, "message": "ok", "data": {"url": url}})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _image_status(self, job_id: str) -> dict:
+        spec = self.state.transcript["image_status"]
+        with self.state.lock:
+            polls = self.state.job_polls.get(job_id, 0) + 1
+            self.state.job_polls[job_id] = polls
+        if polls <= spec.get("pending_polls", 0):
+            return {"id": job_id, "status": "pending"}
+        with self.state.lock:
+            self.state.job_polls.pop(job_id, None)
+        short_id = job_id.replace("-", "")[:8]
+        return {"id": job_id, "status": "completed", "result": spec["result"].format(short_id=short_id)}
+
+    def _stream_chat(self, payload: dict):
+        chats = self.state.transcript["chat"]
+        spec = chats.get(payload.get("model")) or next(iter(chats.values()))
+        job_id = str(uuid.uuid4())
+        self.state.sleep_ms(spec.get("first_byte_ms", 0))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for index, line in enumerate(spec["lines"]):
+                if index:
+                    self.state.sleep_ms(spec.get("line_delay_ms", 0))
+                data = (line.replace("{job_id}", job_id) + "\n").encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.state.count("aborted")
+            self.close_connection = True
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 代理中途断开（取消流、关闭空闲连接）是预期行为，不打印堆栈
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def start_stub(host: str = "127.0.0.1", port: int = 0, transcript: dict = None, speed: float = 1.0):
+    """在后台线程中启动替身服务，返回 (server, state)"""
+    state = StubState(transcript or load_transcript(), speed)
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = StubServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Akash upstream responses")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--transcript", default=DEFAULT_TRANSCRIPT)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier (0 = no delays)")
+    args = parser.parse_args()
+
+    server, _ = start_stub(args.host, args.port, load_transcript(args.transcript), args.speed)
+    print(f"Stub Akash upstream listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""浏览器 cookie 采集：用 Playwright 打开 Akash 页面，通过 Cloudflare 检查后读取 cookie
+
+只有需要采集 cookie 的进程才会导入本模块，API-only 的 worker 不会加载 Playwright。
+默认由 main 以子进程方式运行：
+
+    echo '{"base_url": "...", "fingerprint": {...}}' | python -m harvester
+
+结果（或 null）以一行 JSON 写到 stdout，日志写到 stderr。
+"""
+import json
+import logging
+import sys
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+from playwright.sync_api import sync_playwright
+
+logger = logging.getLogger(__name__)
+
+
+def harvest(base_url: str, fingerprint) -> Optional[dict]:
+    """使用给定的浏览器指纹获取 cookie，返回 {"cookie", "cookies", "expires"}，失败时返回 None"""
+    browser = None
+    context = None
+    page = None
+    
+    try:
+        logger.info("Starting cookie retrieval process...")
+        logger.info(f"Using browser fingerprint: {fingerprint.user_agent}")
+        
+        with sync_playwright() as p:
+            try:
+                # 启动浏览器
+                logger.info("Launching browser...")
+                browser = p.chromium.launch(
+                    headless=True,
+                    args=[
+                        '--no-sandbox',
+                        '--disable-dev-shm-usage',
+                        '--disable-gpu',
+                        '--disable-software-rasterizer',
+                        '--disable-extensions',
+                        '--disable-setuid-sandbox',
+                        '--no-first-run',
+                        '--no-zygote',
+                        '--single-process',
+                        f'--window-size={fingerprint.viewport[0]},{fingerprint.viewport[1]}',
+                        '--disable-blink-features=AutomationControlled',
+                        '--disable-features=IsolateOrigins,site-per-process'
+                    ]
+                )
+                
+                logger.info("Browser launched successfully")
+                
+                # 创建上下文，使用随机指纹
+                logger.info("Creating browser context...")
+                context = browser.new_context(
+                    viewport={'width': fingerprint.viewport[0], 'height': fingerprint.viewport[1]},
+                    user_agent=fingerprint.user_agent,
+                    locale='en-US',
+                    timezone_id='America/New_York',
+                    permissions=['geolocation'],
+                    extra_http_headers=dict(fingerprint.headers)
+                )
+                
+                # 添加脚本以覆盖 navigator.webdriver
+                context.add_init_script("""
+                    Object.defineProperty(navigator, 'webdriver', {
+                        get: () => false,
+                    });
+                    // 更多指纹伪装
+                    Object.defineProperty(navigator, 'plugins', {
+                        get: () => [1, 2, 3, 4, 5],
+                    });
+                """)
+                
+                logger.info("Browser context created successfully")
+                
+                # 创建页面
+                logger.info("Creating new page...")
+                page = context.new_page()
+                logger.info("Page created successfully")
+                
+                # 设置页面超时
+                page.set_default_timeout(60000)
+                
+                # 访问目标网站，添加重试机制
+                max_retries = 3
+                retry_delay = 5
+                
+                for attempt in range(max_retries):
+                    try:
+                        logger.info(f"Navigating to target website (attempt {attempt + 1}/{max_retries})...")
+                        page.goto(f"{base_url}/", timeout=50000)
+                        break
+                    except Exception as e:
+                        if attempt == max_retries - 1:
+                            raise
+                        logger.warning(f"Navigation attempt {attempt + 1} failed: {e}")
+                        time.sleep(retry_delay)
+                
+                # 等待页面加载
+                logger.info("Waiting for page load...")
+                try:
+                    # 首先等待 DOM 加载完成
+                    page.wait_for_load_state("domcontentloaded", timeout=30000)
+                    logger.info("DOM content loaded")
+                    
+                    # 等待一段时间，让 Cloudflare 检查完成
+                    logger.info("Waiting for Cloudflare check...")
+                    time.sleep(5)
+                    
+                    # 尝试点击页面，模拟用户行为
+                    try:
+                        page.mouse.move(100, 100)
+                        page.mouse.click(100, 100)
+                        logger.info("Simulated user interaction")
+                        
+                        # 随机滚动页面
+                        page.mouse.wheel(0, 100)
+                        time.sleep(0.5)
+                        page.mouse.wheel(0, -50)
+                        logger.info("Simulated scrolling")
+                    except Exception as e:
+                        logger.warning(f"Failed to simulate user interaction: {e}")
+                    
+                    # 再次等待一段时间
+                    time.sleep(5)
+                    
+                except Exception as e:
+                    logger.warning(f"Timeout waiting for load state: {e}")
+                
+                # 等待更长时间确保页面完全加载
+                try:
+                    page.wait_for_load_state("networkidle", timeout=10000)
+                    logger.info("Network idle reached")
+                except Exception as e:
+                    logger.warning(f"Timeout waiting for network idle: {e}")
+                
+                # 获取 cookies
+                logger.info("Getting cookies...")
+                cookies = context.cookies()
+                
+                if not cookies:
+                    logger.error("No cookies found")
+                    return None
+                
+                # 记录所有 cookie 名称以进行调试
+                cookie_names = [cookie['name'] for cookie in cookies]
+                logger.info(f"Retrieved cookies: {cookie_names}")
+                    
+                # 检查是否有 cf_clearance cookie
+                cf_cookie = next((cookie for cookie in cookies if cookie['name'] == 'cf_clearance'), None)
+                if not cf_cookie:
+                    logger.error("cf_clearance cookie not found")
+                    return None
+                
+                # 检查是否有 session_token cookie
+                session_cookie = next((cookie for cookie in cookies if cookie['name'] == 'session_token'), None)
+                if not session_cookie:
+                    logger.error("session_token cookie not found")
+                    # 继续执行，因为某些情况下可能不需要 session_token
+                    
+                # 构建 cookie 字符串
+                cookie_str = '; '.join([f"{cookie['name']}={cookie['value']}" for cookie in cookies])
+                logger.info(f"Cookie string length: {len(cookie_str)}")
+                
+                # 设置 cookie 过期时间
+                if session_cookie and 'expires' in session_cookie and session_cookie['expires'] > 0:
+                    expires = session_cookie['expires']
+                    logger.info(f"Session token expires at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expires))}")
+                else:
+                    # 如果没有明确的过期时间，默认设置为30分钟后过期
+                    expires = time.time() + 1800  # 30 分钟
+                    logger.info("No explicit expiration in session_token cookie, setting default 30 minute expiration")
+                
+                logger.info("Successfully retrieved cookies")
+                return {"cookie": cookie_str, "cookies": cookies, "expires": expires}
+                
+            except Exception as e:
+                logger.error(f"Error in browser operations: {e}")
+                logger.error(f"Error type: {type(e)}")
+                import traceback
+                logger.error(f"Traceback: {traceback.format_exc()}")
+                return None
+            finally:
+                # 确保资源被正确关闭
+                try:
+                    if page:
+                        logger.info("Closing page...")
+                        try:
+                            page.close()
+                            logger.info("Page closed successfully")
+                        except Exception as e:
+                            logger.error(f"Error closing page: {e}")
+                except Exception as e:
+                    logger.error(f"Error in page cleanup: {e}")
+                
+                try:
+                    if context:
+                        logger.info("Closing context...")
+                        try:
+                            context.close()
+                            logger.info("Context closed successfully")
+                        except Exception as e:
+                            logger.error(f"Error closing context: {e}")
+                except Exception as e:
+                    logger.error(f"Error in context cleanup: {e}")
+                
+                try:
+                    if browser:
+                        logger.info("Closing browser...")
+                        try:
+                            browser.close()
+                            logger.info("Browser closed successfully")
+                        except Exception as e:
+                            logger.error(f"Error closing browser: {e}")
+                except Exception as e:
+                    logger.error(f"Error in browser cleanup: {e}")
+                
+                # 确保所有资源都被清理
+                page = None
+                context = None
+                browser = None
+                
+                # 主动触发垃圾回收
+                import gc
+                gc.collect()
+                logger.info("Resource cleanup completed")
+    
+    except Exception as e:
+        logger.error(f"Error fetching cookie: {str(e)}")
+        logger.error(f"Error type: {type(e)}")
+        import traceback
+        logger.error(f"Traceback: {traceback.format_exc()}")
+    
+    # 最后再次确保资源被清理
+    if page:
+        try:
+            page.close()
+        except:
+            pass
+    if context:
+        try:
+            context.close()
+        except:
+            pass
+    if browser:
+        try:
+            browser.close()
+        except:
+            pass
+    
+    # 主动触发垃圾回收
+    import gc
+    gc.collect()
+    
+    return None
+
+
+def main() -> int:
+    """子进程入口：从 stdin 读取采集请求，成功时退出码为 0"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - harvester - %(levelname)s - %(message)s',
+        stream=sys.stderr
+    )
+    request = json.load(sys.stdin)
+    stored = request["fingerprint"]
+    fingerprint = SimpleNamespace(
+        user_agent=stored["user_agent"],
+        viewport=tuple(stored["viewport"]),
+        headers=stored["headers"]
+    )
+    result = harvest(request["base_url"], fingerprint)
+    sys.stdout.write(json.dumps(result) + "\n")
+    sys.stdout.flush()
+    return 0 if result else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+"""Akash2API 压测命令行：模拟 OpenAI 流式客户端逐级加压
+
+以闭环客户端按阶段（并发数:持续秒数）向 /v1/chat/completions 与 /v1/models 施压，
+按权重混合 DeepSeek-R1 / AkashGen / models 流量，输出每个阶段的延迟直方图、
+百分位与错误分类（JSON）。配合 --stub 可在本地替身上游上启动代理，
+并记录代理进程的 CPU 与 RSS，用于为 1 CPU / 1 GB 的部署目标选择 worker 数。
+
+用法:
+    python -m loadtest --base-url http://127.0.0.1:7860 --api-key sk-... --stages 4:30,8:30,16:60
+    python -m loadtest --stub --proxy-workers 2 --stages 8:20,16:20,32:20 --output loadtest.json
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+import requests
+
+from bench.client import list_models, stream_chat_completion, summarize
+from bench.replay import BENCH_API_KEY, ProcessSampler, free_port, parse_mix, start_proxy
+from bench.stub_upstream import DEFAULT_TRANSCRIPT, load_transcript, start_stub
+
+# 直方图桶上界（毫秒）
+HISTOGRAM_BUCKETS_MS = [25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+PROMPTS = [
+    "What is the capital of France?",
+    "Write a haiku about distributed systems.",
+    "Explain the difference between TCP and UDP in three sentences.",
+    "Give me five name ideas for a coffee shop."
+]
+IMAGE_PROMPTS = [
+    "a red fox in a snowy forest, golden hour",
+    "an isometric pixel-art city at night"
+]
+
+
+def parse_stages(raw: str) -> list:
+    """解析 "4:30,8:30,16:60" 形式的阶段配置，返回 [(并发数, 秒数)]"""
+    stages = []
+    for item in raw.split(","):
+        concurrency, _, duration = item.partition(":")
+        stages.append((int(concurrency), float(duration or 30)))
+    return stages
+
+
+def histogram(values: list) -> dict:
+    """按固定桶统计延迟分布，键为 "<=N ms"，超出最大桶的记为 ">N ms" """
+    counts = {f"<={bound}ms": 0 for bound in HISTOGRAM_BUCKETS_MS}
+    overflow = f">{HISTOGRAM_BUCKETS_MS[-1]}ms"
+    counts[overflow] = 0
+    for value in values:
+        ms = value * 1000
+        for bound in HISTOGRAM_BUCKETS_MS:
+            if ms <= bound:
+                counts[f"<={bound}ms"] += 1
+                break
+        else:
+            counts[overflow] += 1
+    return counts
+
+
+def make_request(kind: str, session: requests.Session, base_url: str, api_key: str, rng: random.Random,
+                 stream_timeout: float) -> dict:
+    """按流量类型发送一次请求"""
+    if kind == "models":
+        return list_models(session, base_url, api_key)
+    prompt = rng.choice(IMAGE_PROMPTS if kind == "AkashGen" else PROMPTS)
+    payload = {"model": kind, "messages": [{"role": "user", "content": prompt}]}
+    return stream_chat_completion(session, base_url, api_key, payload, timeout=stream_timeout)
+
+
+def run_stage(base_url: str, api_key: str, concurrency: int, duration: float, mix: list, seed: int,
+              stream_timeout: float) -> tuple:
+    """以闭环客户端运行一个阶段：每个客户端在截止时间前不断发起新请求"""
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(index):
+        rng = random.Random(seed * 1000 + index)
+        with requests.Session() as session:
+            while time.perf_counter() < deadline:
+                kind = rng.choices(names, weights=weights)[0]
+                result = make_request(kind, session, base_url, api_key, rng, stream_timeout)
+                with lock:
+                    results.append(result)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def stage_report(concurrency: int, duration: float, results: list, wall_time: float) -> dict:
+    """单个阶段的报告：总体摘要、直方图、按模型拆分与错误分类"""
+    ok = [r for r in results if r["ok"]]
+    by_model = {}
+    for model in sorted({r["model"] for r in results}):
+        model_results = [r for r in results if r["model"] == model]
+        by_model[model] = {
+            **summarize(model_results, wall_time),
+            "latency_histogram": histogram([r["latency"] for r in model_results if r["ok"]])
+        }
+    status_codes = {}
+    for r in results:
+        key = str(r["status"]) if r["status"] is not None else "none"
+        status_codes[key] = status_codes.get(key, 0) + 1
+    return {
+        "concurrency": concurrency,
+        "duration": duration,
+        **summarize(results, wall_time),
+        "status_codes": status_codes,
+        "latency_histogram": histogram([r["latency"] for r in ok]),
+        "ttft_histogram": histogram([r["ttft"] for r in ok if r["ttft"] is not None and r["model"] != "models"]),
+        "by_model": by_model
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the Akash2API OpenAI-compatible endpoints")
+    parser.add_argument("--base-url", default="http://127.0.0.1:7860", help="proxy to load (ignored with --stub)")
+    parser.add_argument("--api-key", default=None, help="bearer token for the proxy")
+    parser.add_argument("--stages", default="4:30,8:30,16:30", help="concurrency:seconds stages, run in order")
+    parser.add_argument("--mix", default="DeepSeek-R1=8,AkashGen=1,models=1", help="traffic weights by model")
+    parser.add_argument("--stream-timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--stub", action="store_true", help="start a local upstream stand-in and a proxy against it")
+    parser.add_argument("--proxy-workers", type=int, default=1, help="uvicorn workers for the --stub proxy")
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the --stub proxy (repeatable)")
+    parser.add_argument("--transcript", default=DEFAULT_TRANSCRIPT)
+    parser.add_argument("--speed", type=float, default=1.0, help="stub replay speed multiplier (0 = no delays)")
+    parser.add_argument("--pid", type=int, help="sample CPU/RSS of an already running proxy process")
+    args = parser.parse_args()
+
+    stages = parse_stages(args.stages)
+    mix = parse_mix(args.mix)
+    stub = proxy = None
+    base_url, api_key, pid = args.base_url.rstrip("/"), args.api_key or "", args.pid
+
+    if args.stub:
+        stub, _ = start_stub(transcript=load_transcript(args.transcript), speed=args.speed)
+        port = free_port()
+        proxy = start_proxy(
+            f"http://127.0.0.1:{stub.server_address[1]}",
+            port,
+            dict(item.split("=", 1) for item in args.proxy_env),
+            workers=args.proxy_workers
+        )
+        base_url, api_key, pid = f"http://127.0.0.1:{port}", BENCH_API_KEY, proxy.pid
+
+    report = {
+        "config": {
+            "base_url": base_url,
+            "stages": args.stages,
+            "mix": args.mix,
+            "stub": args.stub,
+            "proxy_workers": args.proxy_workers if args.stub else None
+        },
+        "stages": []
+    }
+    try:
+        for index, (concurrency, duration) in enumerate(stages):
+            print(f"Stage {index + 1}/{len(stages)}: {concurrency} clients for {duration:.0f}s", file=sys.stderr)
+            sampler = ProcessSampler(pid) if pid else None
+            if sampler:
+                sampler.start()
+            results, wall_time = run_stage(base_url, api_key, concurrency, duration, mix, args.seed + index,
+                                           args.stream_timeout)
+            stage = stage_report(concurrency, duration, results, wall_time)
+            if sampler:
+                process_stats = sampler.stop()
+                process_stats["cpu_percent"] = round(100 * process_stats["cpu_seconds"] / wall_time, 1)
+                stage["process"] = process_stats
+            report["stages"].append(stage)
+            print(f"  {stage['succeeded']}/{stage['requests']} ok, {stage['throughput_rps']} req/s, "
+                  f"p99 {stage['latency'].get('p99')}s, errors {stage['errors']}", file=sys.stderr)
+    finally:
+        if proxy:
+            proxy.terminate()
+            try:
+                proxy.wait(timeout=10)
+            except Exception:
+                proxy.kill()
+        if stub:
+            stub.shutdown()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
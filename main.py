@@ -1,25 +1,41 @@
 from fastapi import FastAPI, Request, Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import StreamingResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, RedirectResponse, JSONResponse
 from fastapi.background import BackgroundTasks
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from contextlib import asynccontextmanager
 import requests
-from curl_cffi import requests as cffi_requests
 import uuid
 import json
 import time
-from typing import Optional
+from typing import Optional, NamedTuple, Mapping, Callable
+from types import MappingProxyType
 import asyncio
 import base64
+import functools
 import tempfile
 import os
 import re
+import signal
+import socket
+import subprocess
+import sys
 import threading
 import logging
+import weakref
 from dotenv import load_dotenv
-from playwright.sync_api import sync_playwright
+from settings import UpstreamTimeouts, load_settings
 from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from http.cookies import SimpleCookie, CookieError
 from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from collections import deque, OrderedDict
+import hashlib
+import hmac
+import ipaddress
+import math
+import mimetypes
 import random
 
 # 加载环境变量
@@ -36,6 +52,7 @@ logger = logging.getLogger(__name__)
 global_data = {
     "cookie": None,
     "cookies": None,
+    "fingerprint": None,  # 采集 cookie 时使用的浏览器指纹
     "last_update": 0,
     "cookie_expires": 0,  # 添加 cookie 过期时间
     "is_refreshing": False  # 添加刷新状态标志
@@ -46,26 +63,57 @@ async def lifespan(app: FastAPI):
     # 启动时获取 cookie
     logger.info("Starting FastAPI application, initializing cookie fetcher...")
     
-    # 创建并启动线程
-    cookie_thread = threading.Thread(target=get_cookie_with_retry)
-    cookie_thread.daemon = True  # 设置为守护线程
-    cookie_thread.start()
+    # 定期把用量统计写入文件
+    usage_task = asyncio.create_task(flush_usage_periodically()) if USAGE_FILE else None
+    # 配置了多个上游地址时定期探测延迟
+    probe_task = asyncio.create_task(probe_upstreams_periodically()) if len(settings.base_urls) > 1 else None
     
-    # 创建并启动自动刷新线程
-    refresh_thread = threading.Thread(target=auto_refresh_cookie)
-    refresh_thread.daemon = True
-    refresh_thread.start()
-    
-    logger.info("Cookie fetcher and auto-refresh threads started")
+    if AKASH_COOKIE:
+        apply_static_cookie()
+        logger.info("Using static cookie from AKASH_COOKIE, browser harvesting disabled")
+    elif RUN_MODE == "api":
+        if not COOKIE_STORE:
+            logger.error("RUN_MODE=api requires COOKIE_STORE (or AKASH_COOKIE); no cookie will be available")
+        load_cookie_store()
+        logger.info(f"API-only mode, reading cookies from {COOKIE_STORE}")
+    else:
+        # 创建并启动线程
+        cookie_thread = threading.Thread(target=get_cookie_with_retry)
+        cookie_thread.daemon = True  # 设置为守护线程
+        cookie_thread.start()
+        
+        # 创建并启动自动刷新线程
+        refresh_thread = threading.Thread(target=auto_refresh_cookie)
+        refresh_thread.daemon = True
+        refresh_thread.start()
+        
+        logger.info("Cookie fetcher and auto-refresh threads started")
     yield
     
     # 关闭时清理资源
     logger.info("Shutting down FastAPI application")
+    for task in (usage_task, probe_task):
+        if task:
+            task.cancel()
+    await drain_and_shutdown()
+    usage_meter.flush()
     global_data["cookie"] = None
     global_data["cookies"] = None
+    global_data["fingerprint"] = None
     global_data["last_update"] = 0
     global_data["is_refreshing"] = False
 
+def apply_static_cookie():
+    """使用 AKASH_COOKIE 中配置的静态 cookie"""
+    global_data["cookie"] = AKASH_COOKIE
+    global_data["cookies"] = [
+        {"name": name, "value": value} for name, value in parse_cookie_string(AKASH_COOKIE).items()
+    ]
+    global_data["last_update"] = time.time()
+    # 静态 cookie 不会过期，由使用者自行更新
+    global_data["cookie_expires"] = time.time() + 10 * 365 * 86400
+    return AKASH_COOKIE
+
 def get_cookie_with_retry(max_retries=3, retry_delay=5):
     """带重试机制的获取 cookie 函数"""
     retries = 0
@@ -79,35 +127,1471 @@ def get_cookie_with_retry(max_retries=3, retry_delay=5):
         retries += 1
         if retries < max_retries:
             logger.info(f"Retrying cookie fetch in {retry_delay} seconds...")
-            time.sleep(retry_delay)
+            if shutdown_event.wait(retry_delay):
+                return None
     
     logger.error(f"Failed to fetch cookie after {max_retries} attempts")
     return None
 
 app = FastAPI(lifespan=lifespan)
 security = HTTPBearer()
+# 不强制 Authorization 头，供开放模式下公开的接口使用
+optional_security = HTTPBearer(auto_error=False)
+
+# OpenAI 兼容的错误类型（按 HTTP 状态码），未列出的 5xx 为 server_error，其余 4xx 为 invalid_request_error
+ERROR_TYPES = {
+    401: "authentication_error",
+    403: "permission_error",
+    404: "not_found_error",
+    429: "rate_limit_error"
+}
+
+# 返回给客户端的错误次数，按错误类型与错误码分类
+error_stats = {"by_type": {}, "by_code": {}}
+
+class APIError(HTTPException):
+    """带 OpenAI 错误码（以及可选的出错参数名）的 HTTPException"""
+
+    def __init__(self, status_code: int, message: str, code: Optional[str] = None, param: Optional[str] = None,
+                 headers: Optional[dict] = None):
+        super().__init__(status_code=status_code, detail=message, headers=headers)
+        self.code = code
+        self.param = param
+
+def error_body(status_code: int, message: str, code: Optional[str] = None, param: Optional[str] = None) -> dict:
+    """构造 OpenAI 格式的错误对象，并计入 error_stats"""
+    error_type = ERROR_TYPES.get(status_code, "server_error" if status_code >= 500 else "invalid_request_error")
+    error_stats["by_type"][error_type] = error_stats["by_type"].get(error_type, 0) + 1
+    if code:
+        error_stats["by_code"][code] = error_stats["by_code"].get(code, 0) + 1
+    return {"error": {"message": message, "type": error_type, "param": param, "code": code}}
+
+@app.exception_handler(StarletteHTTPException)
+async def openai_error_handler(request: Request, exc: StarletteHTTPException):
+    """所有 HTTPException 都以 OpenAI 错误格式返回，保留 Retry-After 等响应头"""
+    message = exc.detail if isinstance(exc.detail, str) else json.dumps(exc.detail)
+    return JSONResponse(
+        status_code=exc.status_code,
+        content=error_body(exc.status_code, message, getattr(exc, "code", None), getattr(exc, "param", None)),
+        headers=getattr(exc, "headers", None)
+    )
+
+# 上游地址与超时配置，可指向镜像或本地替身服务（例如基准测试用的 bench.stub_upstream）
+settings = load_settings()
+# 静态 cookie：设置后直接使用，不再启动浏览器采集
+AKASH_COOKIE = os.getenv("AKASH_COOKIE", None)
+# 运行模式：full 在本进程中用浏览器采集 cookie；api 只从 COOKIE_STORE 读取，从不加载 Playwright
+RUN_MODE = os.getenv("RUN_MODE", "full").lower()
+# 共享 cookie 存储文件：full 模式采集后写入，api 模式的 worker 从中读取
+COOKIE_STORE = os.getenv("COOKIE_STORE", None)
 
 # OpenAI API Key 配置，可以通过环境变量覆盖
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", None)
 logger.info(f"OPENAI_API_KEY is set: {OPENAI_API_KEY is not None}")
-# logger.info(f"OPENAI_API_KEY value: {OPENAI_API_KEY}")
 
-def get_random_browser_fingerprint():
+def load_api_keys() -> dict:
+    """读取所有可用的 API key，返回 {key: 名称}
+
+    OPENAI_API_KEY 对应名称 default；API_KEYS 形如 "alice=sk-a,bob=sk-b"；
+    API_KEYS_FILE 指向 {"名称": "key"} 格式的 JSON 文件。
+    """
+    keys = {}
+    if OPENAI_API_KEY is not None:
+        keys[OPENAI_API_KEY] = "default"
+    for item in (os.getenv("API_KEYS") or "").split(','):
+        name, _, key = item.partition('=')
+        if name.strip() and key.strip():
+            keys[key.strip()] = name.strip()
+    keys_file = os.getenv("API_KEYS_FILE")
+    if keys_file:
+        with open(keys_file) as f:
+            for name, key in json.load(f).items():
+                keys[key] = name
+    return keys
+
+# 进程内随机盐：内存中只保存 key 的 HMAC 摘要，查找耗时与 key 内容无关
+API_KEY_SALT = os.urandom(32)
+
+def hash_api_key(key: str) -> bytes:
+    return hmac.new(API_KEY_SALT, key.encode('utf-8'), hashlib.sha256).digest()
+
+API_KEY_HASHES = {hash_api_key(key): name for key, name in load_api_keys().items()}
+logger.info(f"API keys configured: {len(API_KEY_HASHES)}")
+# 管理接口（/admin/*）使用的独立 key，未设置时管理接口一律拒绝访问
+ADMIN_API_KEY_HASH = hash_api_key(os.environ["ADMIN_API_KEY"]) if os.getenv("ADMIN_API_KEY") else None
+
+def parse_model_limits(raw: Optional[str]) -> dict:
+    """解析形如 "DeepSeek-R1=4,AkashGen=2" 的按模型配置"""
+    limits = {}
+    for item in (raw or "").split(','):
+        if '=' not in item:
+            continue
+        name, value = item.split('=', 1)
+        try:
+            limits[name.strip()] = int(value.strip())
+        except ValueError:
+            logger.warning(f"Ignoring invalid model limit entry: {item}")
+    return limits
+
+# 上游并发控制配置（0 表示不限制）
+MAX_CONCURRENT_STREAMS = int(os.getenv("MAX_CONCURRENT_STREAMS", "8"))
+MAX_CONCURRENT_PER_MODEL = int(os.getenv("MAX_CONCURRENT_PER_MODEL", "0"))
+MODEL_CONCURRENCY_LIMITS = parse_model_limits(os.getenv("MODEL_CONCURRENCY_LIMITS"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "32"))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", "30"))
+
+class LimiterSlot:
+    """已获得的并发槽位，release 可重复调用，且可在任意线程中调用"""
+
+    def __init__(self, limiter, model: str, queue_time: float):
+        self.limiter = limiter
+        self.model = model
+        self.queue_time = queue_time
+        self.acquired_at = time.monotonic()
+        self.released = False
+        # 与该槽位一同释放的其他槽位（例如按 key 的并发计数）
+        self.companions = []
+
+    def release(self):
+        self.limiter.release(self)
+        for companion in self.companions:
+            companion.release()
+
+class ConcurrencyLimiter:
+    """上游请求的准入控制：全局与按模型的并发上限，加上有界等待队列
+
+    槽位在流式响应结束时才释放，而流是在线程池中消费的，
+    因此内部状态用 threading.Lock 保护，唤醒等待者时通过
+    call_soon_threadsafe 回到其所属的事件循环。
+    """
+
+    def __init__(self, global_limit: int, per_model_limit: int, model_limits: dict,
+                 max_queue: int, queue_timeout: float):
+        self.global_limit = global_limit
+        self.per_model_limit = per_model_limit
+        self.model_limits = model_limits
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._active = 0
+        self._active_by_model = {}
+        # 等待者: [model, future, loop, granted]
+        self._waiters = deque()
+        self._avg_hold = 0.0
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+            "queue_time_total": 0.0,
+            "queue_time_max": 0.0
+        }
+
+    def _model_limit(self, model: str) -> int:
+        return self.model_limits.get(model, self.per_model_limit)
+
+    def _has_capacity(self, model: str) -> bool:
+        if self.global_limit > 0 and self._active >= self.global_limit:
+            return False
+        limit = self._model_limit(model)
+        return not (limit > 0 and self._active_by_model.get(model, 0) >= limit)
+
+    def _take(self, model: str):
+        self._active += 1
+        self._active_by_model[model] = self._active_by_model.get(model, 0) + 1
+
+    def _record_admission(self, queue_time: float):
+        self.stats["admitted"] += 1
+        self.stats["queue_time_total"] += queue_time
+        self.stats["queue_time_max"] = max(self.stats["queue_time_max"], queue_time)
+
+    def retry_after(self) -> int:
+        """根据平均占用时长估算客户端的重试等待秒数"""
+        return max(1, math.ceil(self._avg_hold or 1))
+
+    def _reject(self, reason: str):
+        raise APIError(
+            429,
+            f"Too many concurrent upstream requests ({reason}), please retry later",
+            "upstream_queue_full",
+            headers={"Retry-After": str(self.retry_after())}
+        )
+
+    async def acquire(self, model: str) -> LimiterSlot:
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        with self._lock:
+            # 队列中的等待者必然是当前无法放行的，因此新请求只需检查自身容量
+            if self._has_capacity(model):
+                self._take(model)
+                self._record_admission(0.0)
+                return LimiterSlot(self, model, 0.0)
+            if len(self._waiters) >= self.max_queue:
+                self.stats["rejected_queue_full"] += 1
+                logger.warning(f"Upstream queue full ({len(self._waiters)} waiting), rejecting request for {model}")
+                self._reject("queue full")
+            waiter = [model, loop.create_future(), loop, False]
+            self._waiters.append(waiter)
+            self.stats["queued"] += 1
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), timeout=self.queue_timeout)
+        except BaseException as e:
+            with self._lock:
+                granted = waiter[3]
+                if not granted:
+                    self._waiters.remove(waiter)
+            if granted:
+                # 超时或取消与放行同时发生，槽位已经分配给我们
+                slot = LimiterSlot(self, model, time.monotonic() - start)
+                if isinstance(e, asyncio.TimeoutError):
+                    self._record_admission(slot.queue_time)
+                    return slot
+                slot.release()
+                raise
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["rejected_timeout"] += 1
+                logger.warning(f"Request for {model} waited {self.queue_timeout}s in upstream queue, rejecting")
+                self._reject("queue timeout")
+            raise
+
+        queue_time = time.monotonic() - start
+        self._record_admission(queue_time)
+        logger.info(f"Admitted request for {model} after {queue_time:.2f}s in queue")
+        return LimiterSlot(self, model, queue_time)
+
+    def release(self, slot: LimiterSlot):
+        with self._lock:
+            if slot.released:
+                return
+            slot.released = True
+            held = time.monotonic() - slot.acquired_at
+            self._avg_hold = held if not self._avg_hold else self._avg_hold * 0.9 + held * 0.1
+            self._active -= 1
+            self._active_by_model[slot.model] -= 1
+            # 按顺序放行所有现在有容量的等待者，避免不同模型间的队头阻塞
+            for waiter in list(self._waiters):
+                if self._has_capacity(waiter[0]):
+                    self._waiters.remove(waiter)
+                    self._take(waiter[0])
+                    waiter[3] = True
+                    waiter[2].call_soon_threadsafe(_resolve_future, waiter[1])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            admitted = self.stats["admitted"]
+            return {
+                "active": self._active,
+                "active_by_model": {k: v for k, v in self._active_by_model.items() if v},
+                "waiting": len(self._waiters),
+                "global_limit": self.global_limit,
+                "model_limits": dict(self.model_limits),
+                "per_model_limit": self.per_model_limit,
+                "max_queue": self.max_queue,
+                "avg_hold_seconds": round(self._avg_hold, 3),
+                "avg_queue_seconds": round(self.stats["queue_time_total"] / admitted, 3) if admitted else 0.0,
+                **self.stats
+            }
+
+def _resolve_future(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+upstream_limiter = ConcurrencyLimiter(
+    MAX_CONCURRENT_STREAMS,
+    MAX_CONCURRENT_PER_MODEL,
+    MODEL_CONCURRENCY_LIMITS,
+    MAX_QUEUE_SIZE,
+    QUEUE_TIMEOUT
+)
+
+# 熔断配置
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+HARVEST_FAILURE_THRESHOLD = int(os.getenv("HARVEST_FAILURE_THRESHOLD", "3"))
+HARVEST_RESET_TIMEOUT = float(os.getenv("HARVEST_RESET_TIMEOUT", "300"))
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后打开并快速失败，冷却结束后进入半开状态放行一个探测请求"""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.stats = {"opened": 0, "fast_failed": 0, "probes": 0}
+
+    def retry_after(self) -> int:
+        """距离允许半开探测的剩余秒数"""
+        return max(1, math.ceil(self.opened_at + self.reset_timeout - time.time()))
+
+    def rejecting(self) -> bool:
+        """是否处于打开状态且仍在冷却期内（不会占用探测名额）"""
+        return self.state == "open" and time.time() < self.opened_at + self.reset_timeout
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.time() < self.opened_at + self.reset_timeout:
+                    self.stats["fast_failed"] += 1
+                    return False
+                self.state = "half_open"
+                self._probe_in_flight = False
+                logger.info(f"Circuit '{self.name}' half-open, probing upstream")
+            # 半开状态下同一时间只放行一个探测请求
+            if self._probe_in_flight:
+                self.stats["fast_failed"] += 1
+                return False
+            self._probe_in_flight = True
+            self.stats["probes"] += 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info(f"Circuit '{self.name}' closed after successful probe")
+            self.state = "closed"
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.stats["opened"] += 1
+                    logger.error(f"Circuit '{self.name}' opened after {self.failures} failures, fast-failing for {self.reset_timeout}s")
+                self.state = "open"
+                self.opened_at = time.time()
+
+    def release_probe(self):
+        """探测请求被取消等非上游原因中断时，释放探测名额而不计入失败"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_after": self.retry_after() if self.state == "open" else 0,
+            **self.stats
+        }
+
+circuit_breakers = {
+    "chat": CircuitBreaker("chat", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+    "models": CircuitBreaker("models", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+    "image_status": CircuitBreaker("image_status", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+    "harvest": CircuitBreaker("harvest", HARVEST_FAILURE_THRESHOLD, HARVEST_RESET_TIMEOUT)
+}
+
+def upstream_unavailable(breaker: CircuitBreaker) -> APIError:
+    """熔断打开时返回给客户端的错误"""
+    return APIError(
+        503,
+        f"Akash upstream '{breaker.name}' is unavailable (circuit open), please retry later",
+        "upstream_unavailable",
+        headers={"Retry-After": str(breaker.retry_after())}
+    )
+
+# 上游出错时建议客户端等待的秒数
+UPSTREAM_ERROR_RETRY_AFTER = int(os.getenv("UPSTREAM_ERROR_RETRY_AFTER", "5"))
+
+def upstream_status_error(response: requests.Response) -> APIError:
+    """把上游的非 2xx 响应转换为返回给客户端的错误
+
+    cookie 失效或 Cloudflare 质询不是调用方的问题，返回 502 而不是透传 401/403；
+    上游限流透传 429 与 Retry-After；上游拒绝请求（400）透传，其余为 502。
+    """
+    status = response.status_code
+    text = response.text[:200]
+    retry_after = {"Retry-After": str(UPSTREAM_ERROR_RETRY_AFTER)}
+    if status in (401, 403):
+        return APIError(502, f"Akash rejected the session cookie (status {status})", "upstream_auth_failed",
+                        headers=retry_after)
+    if status == 429:
+        upstream_retry_after = response.headers.get("Retry-After", "")
+        if upstream_retry_after.isdigit():
+            retry_after = {"Retry-After": upstream_retry_after}
+        return APIError(429, "Akash is rate limiting requests, please retry later", "upstream_rate_limited",
+                        headers=retry_after)
+    if status == 400:
+        return APIError(400, f"Akash rejected the request: {text}", "upstream_rejected")
+    return APIError(502, f"Akash API error (status {status}): {text}", "upstream_error", headers=retry_after)
+
+def unexpected_error(e: Exception) -> APIError:
+    """把未处理的异常转换为返回给客户端的错误：上游超时为 504，上游网络错误为 502，其余为 500"""
+    retry_after = {"Retry-After": str(UPSTREAM_ERROR_RETRY_AFTER)}
+    if isinstance(e, TIMEOUT_EXCEPTIONS):
+        return APIError(504, "Akash upstream timed out", "upstream_timeout", headers=retry_after)
+    # 流式读取中途断开（ChunkedEncodingError 等）不在可重试异常之列，同样属于上游连接问题
+    if isinstance(e, RETRYABLE_EXCEPTIONS + (requests.exceptions.RequestException,)):
+        return APIError(502, f"Akash upstream connection failed ({type(e).__name__})", "upstream_connection_error",
+                        headers=retry_after)
+    return APIError(500, "Internal server error", "internal_error")
+
+# 流式响应中途出错时按错误码决定非流式请求返回的状态码
+STREAM_ERROR_STATUS = {"upstream_timeout": 504, "internal_error": 500}
+
+def stream_error_status(error: dict) -> int:
+    """非流式请求聚合到流中的 error 事件时，按错误码还原 HTTP 状态码"""
+    return STREAM_ERROR_STATUS.get(error["error"].get("code"), 502)
+
+async def read_json(request: Request) -> dict:
+    """读取 JSON 请求体，格式错误时返回 400"""
+    try:
+        data = await request.json()
+    except ValueError:
+        raise APIError(400, "Request body must be valid JSON", "invalid_json")
+    if not isinstance(data, dict):
+        raise APIError(400, "Request body must be a JSON object", "invalid_json")
+    return data
+
+def require_upstream(name: str):
+    """依赖项：熔断打开时在等待 cookie 之前直接快速失败"""
+    async def dependency():
+        breaker = circuit_breakers[name]
+        if breaker.rejecting():
+            breaker.stats["fast_failed"] += 1
+            raise upstream_unavailable(breaker)
+    return dependency
+
+class UpstreamPool:
+    """多个上游地址的选择：按探测延迟（EWMA）优先使用最快的可用地址
+
+    请求失败（连接错误、5xx、429）的地址在 cooldown 秒内排到最后，成功后恢复。
+    尚未探测过的地址按配置顺序排在已测得延迟的地址之后。
+    """
+
+    def __init__(self, base_urls: tuple, cooldown: float, alpha: float = 0.3):
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self.endpoints = {
+            url: {"latency": None, "down_until": 0.0, "requests": 0, "failures": 0, "probe_failures": 0}
+            for url in base_urls
+        }
+        self._order = list(base_urls)
+
+    def ordered(self) -> list:
+        """按优先级排列的上游地址：可用的在前（延迟低者优先），冷却中的在后"""
+        now = time.time()
+        with self._lock:
+            return sorted(self._order, key=lambda url: (
+                self.endpoints[url]["down_until"] > now,
+                self.endpoints[url]["latency"] is None,
+                self.endpoints[url]["latency"] or 0.0,
+                self._order.index(url)
+            ))
+
+    def current(self) -> str:
+        return self.ordered()[0]
+
+    def record_latency(self, url: str, latency: float):
+        with self._lock:
+            endpoint = self.endpoints[url]
+            previous = endpoint["latency"]
+            endpoint["latency"] = latency if previous is None else previous * (1 - self.alpha) + latency * self.alpha
+
+    def record_success(self, url: str):
+        with self._lock:
+            self.endpoints[url]["requests"] += 1
+            self.endpoints[url]["down_until"] = 0.0
+
+    def record_failure(self, url: str, probe: bool = False):
+        with self._lock:
+            endpoint = self.endpoints[url]
+            endpoint["probe_failures" if probe else "failures"] += 1
+            if not probe:
+                endpoint["requests"] += 1
+            endpoint["down_until"] = time.time() + self.cooldown
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {
+                url: {
+                    "latency": round(endpoint["latency"], 3) if endpoint["latency"] is not None else None,
+                    "cooldown": round(max(0.0, endpoint["down_until"] - now), 1),
+                    "requests": endpoint["requests"],
+                    "failures": endpoint["failures"],
+                    "probe_failures": endpoint["probe_failures"]
+                }
+                for url, endpoint in self.endpoints.items()
+            }
+
+upstream_pool = UpstreamPool(settings.base_urls, settings.failure_cooldown)
+
+def probe_upstream(url: str):
+    """测量一个上游地址的往返延迟；任何 HTTP 响应（包括 Cloudflare 质询）都算可达"""
+    start = time.monotonic()
+    try:
+        response = requests.head(f"{url}/", timeout=settings.probe_timeout, allow_redirects=False)
+        response.close()
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Upstream probe to {url} failed: {e}")
+        upstream_pool.record_failure(url, probe=True)
+        return
+    upstream_pool.record_latency(url, time.monotonic() - start)
+
+async def probe_upstreams_periodically():
+    """配置了多个上游时定期探测各地址延迟"""
+    while True:
+        await asyncio.gather(*[run_blocking(probe_upstream, url) for url in settings.base_urls])
+        await asyncio.sleep(settings.probe_interval)
+
+def is_upstream_failure(status_code: int) -> bool:
+    """上游 5xx 与限流计为熔断失败，鉴权类 4xx 由 cookie 刷新处理"""
+    return status_code >= 500 or status_code == 429
+
+# 上游重试配置
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_RETRY_STATUSES = {
+    int(code) for code in os.getenv("UPSTREAM_RETRY_STATUSES", "429,500,502,503,504").split(',') if code.strip()
+}
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "8"))
+# 首字节超过该时间仍未返回时发起对冲请求（秒，0 表示关闭）
+UPSTREAM_HEDGE_AFTER = float(os.getenv("UPSTREAM_HEDGE_AFTER", "0"))
+
+# 上游阻塞 I/O 专用线程池，避免占用事件循环默认线程池
+upstream_executor = ThreadPoolExecutor(
+    max_workers=max(MAX_CONCURRENT_STREAMS, 4) * 2 + 4,
+    thread_name_prefix="upstream"
+)
+
+RETRYABLE_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+# 用于区分触发的是连接超时还是等待首字节超时
+CONNECT_TIMEOUT_EXCEPTIONS = (requests.exceptions.ConnectTimeout,)
+TIMEOUT_EXCEPTIONS = (requests.exceptions.Timeout,)
+
+# 各类上游超时的触发次数
+timeout_stats = {"connect": 0, "first_byte": 0, "idle": 0, "total": 0}
+
+def record_timeout(e: BaseException) -> Optional[str]:
+    """若异常是上游超时则计入 timeout_stats，返回超时类别"""
+    if isinstance(e, CONNECT_TIMEOUT_EXCEPTIONS):
+        kind = "connect"
+    elif isinstance(e, TIMEOUT_EXCEPTIONS):
+        kind = "first_byte"
+    else:
+        return None
+    timeout_stats[kind] += 1
+    return kind
+
+def transport_timeout(session, timeouts: UpstreamTimeouts, stream: bool = False) -> tuple:
+    """发送请求时使用的 (连接, 读取) 超时
+
+    requests 在收到响应头后可以把读超时改为空闲超时（见 set_idle_timeout）；
+    curl_cffi 的流式读超时在发送时就固定下来，因此取首字节与空闲超时中较大者。
+    """
+    if stream and not isinstance(session, requests.Session) and timeouts.idle:
+        return (timeouts.connect, max(timeouts.first_byte, timeouts.idle))
+    return timeouts.request
+
+retry_stats = {
+    "attempts": 0,
+    "retries": 0,
+    "retried_statuses": 0,
+    "retried_exceptions": 0,
+    "exhausted": 0,
+    "hedges_fired": 0,
+    "hedge_wins": 0,
+    "failovers": 0
+}
+
+def backoff_delay(attempt: int, response: Optional[requests.Response] = None) -> float:
+    """计算重试等待时间：优先遵循上游 Retry-After，否则使用带完全抖动的指数退避"""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), UPSTREAM_BACKOFF_MAX)
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+
+def _close_response_quietly(future):
+    """关闭被对冲请求淘汰的响应，把连接还给连接池"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        future.result()[0].close()
+    except Exception:
+        pass
+
+def _send_to(send, identity, base_url: str) -> tuple:
+    """向指定上游地址发送请求并记录该地址的结果，返回 (响应, 地址)"""
+    try:
+        response = send(identity, base_url)
+    except RETRYABLE_EXCEPTIONS as e:
+        upstream_pool.record_failure(base_url)
+        record_timeout(e)
+        raise
+    if is_upstream_failure(response.status_code):
+        upstream_pool.record_failure(base_url)
+    else:
+        upstream_pool.record_success(base_url)
+    return response, base_url
+
+async def _send_hedged(send, identities: list, hedge_after: float) -> tuple:
+    """发送一次上游请求；若首字节在 hedge_after 内未到达，则用另一身份再发一次，取先返回者
+
+    主请求发往当前最优的上游地址，对冲请求优先发往次优地址（只有一个地址时发往同一地址）。
+    """
+    loop = asyncio.get_running_loop()
+    base_urls = upstream_pool.ordered()
+    primary = loop.run_in_executor(upstream_executor, _send_to, send, identities[0], base_urls[0])
+    if hedge_after <= 0 or len(identities) < 2:
+        return await primary
+
+    done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+    if done:
+        return primary.result()
+
+    retry_stats["hedges_fired"] += 1
+    logger.info(f"No first byte after {hedge_after}s, firing hedged upstream request")
+    hedge = loop.run_in_executor(upstream_executor, _send_to, send, identities[1], base_urls[min(1, len(base_urls) - 1)])
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        retry_stats["hedge_wins"] += 1
+                    for other in done - {future}:
+                        _close_response_quietly(other)
+                    return future.result()
+            if not pending:
+                # 两次请求都失败，抛出主请求的异常
+                raise primary.exception()
+    finally:
+        for future in pending:
+            future.add_done_callback(_close_response_quietly)
+
+async def request_upstream(send, identities: list, hedge_after: float = 0,
+                           breaker: Optional[CircuitBreaker] = None) -> tuple:
+    """带重试与熔断的上游请求
+
+    send(identity, base_url) 是在线程池中执行的同步请求函数，identities 为可用的
+    (cookie, 指纹) 组合，第一个用于主请求，第二个（如有）用于对冲请求。
+    连接错误与 UPSTREAM_RETRY_STATUSES 中的状态码会按指数退避加抖动重试，
+    配置了多个上游地址时重试立即切换到下一个可用地址。
+    返回 (最后一次尝试的响应, 响应所在的上游地址)，响应原样交给调用方处理；
+    同一上游任务的后续请求（例如图片状态轮询）应沿用该地址。熔断打开时直接抛出 503。
+    """
+    if breaker is not None and not breaker.allow():
+        raise upstream_unavailable(breaker)
+    try:
+        response, base_url = await _request_with_retry(send, identities, hedge_after)
+    except RETRYABLE_EXCEPTIONS:
+        if breaker is not None:
+            breaker.record_failure()
+        raise
+    except BaseException:
+        if breaker is not None:
+            breaker.release_probe()
+        raise
+    if breaker is not None:
+        if is_upstream_failure(response.status_code):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    return response, base_url
+
+async def _request_with_retry(send, identities: list, hedge_after: float) -> tuple:
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        retry_stats["attempts"] += 1
+        last_attempt = attempt == UPSTREAM_MAX_RETRIES
+        base_url = upstream_pool.current()
+        try:
+            response, base_url = await _send_hedged(send, identities, hedge_after)
+        except RETRYABLE_EXCEPTIONS as e:
+            if last_attempt:
+                retry_stats["exhausted"] += 1
+                raise
+            retry_stats["retried_exceptions"] += 1
+            delay = backoff_delay(attempt)
+            reason = f"Upstream request to {base_url} failed ({type(e).__name__}: {e})"
+        else:
+            if response.status_code not in UPSTREAM_RETRY_STATUSES:
+                return response, base_url
+            if last_attempt:
+                retry_stats["exhausted"] += 1
+                return response, base_url
+            retry_stats["retried_statuses"] += 1
+            delay = backoff_delay(attempt, response)
+            reason = f"Upstream {base_url} returned {response.status_code}"
+            response.close()
+        retry_stats["retries"] += 1
+        # 失败的地址已进入冷却，有其他可用地址时不再退避等待
+        next_url = upstream_pool.current()
+        if next_url != base_url:
+            retry_stats["failovers"] += 1
+            logger.warning(f"{reason}, failing over to {next_url}")
+            continue
+        logger.warning(f"{reason}, retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+def parse_cookie_string(cookie: str) -> dict:
+    """解析 cookie 字符串到字典"""
+    cookies_dict = {}
+    for cookie_item in cookie.split(';'):
+        if '=' in cookie_item:
+            name, value = cookie_item.strip().split('=', 1)
+            cookies_dict[name] = value
+    return cookies_dict
+
+# 客户端断开检测间隔（秒）
+DISCONNECT_CHECK_INTERVAL = float(os.getenv("DISCONNECT_CHECK_INTERVAL", "1"))
+# 流式响应超过该时间没有发出数据时发送 SSE 注释心跳，防止中间代理断开空闲连接（秒，0 表示关闭）
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", "15"))
+
+stream_stats = {
+    "completed": 0,
+    "cancelled": 0,
+    "timed_out": 0,
+    "failed": 0,
+    "malformed_lines": 0,
+    "keepalives": 0,
+    "upstream_bytes_read": 0,
+    "estimated_bytes_saved": 0
+}
+# 以 error 事件结束的流，按错误码计数
+stream_failures = {}
+# 已完成流的平均上游字节数，用于估算取消节省的流量
+_avg_stream_bytes = [0.0]
+
+def sse_error_event(error: APIError, meter: dict) -> str:
+    """流式响应已经开始后无法再改状态码，以 OpenAI 流中的 error 事件告知客户端
+
+    生成事件时即把该流计入失败统计，并在 meter 中记下错误码，stream_to_client 据此不再把它算作完成或取消。
+    """
+    meter["error"] = error.code
+    stream_stats["failed"] += 1
+    stream_failures[error.code] = stream_failures.get(error.code, 0) + 1
+    return f"data: {json.dumps(error_body(error.status_code, error.detail, error.code))}\n\n"
+
+_STREAM_END = object()
+
+def _upstream_socket(response: requests.Response) -> socket.socket:
+    """取得 requests 响应底层的 socket（curl_cffi 响应没有，会抛出 AttributeError）"""
+    connection = getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is None:
+        sock = response.raw._fp.fp.raw._sock
+    return sock
+
+def set_idle_timeout(response: requests.Response, timeouts: UpstreamTimeouts):
+    """收到响应头后把 socket 读超时从首字节超时改为空闲超时
+
+    stream_to_client 会在空闲超时时主动中断上游，这里略微放宽，只作为线程不被永久阻塞的兜底。
+    """
+    if not timeouts.idle:
+        return
+    try:
+        _upstream_socket(response).settimeout(timeouts.idle + DISCONNECT_CHECK_INTERVAL + 1)
+    except Exception:
+        pass
+
+def abort_upstream(response: requests.Response):
+    """中断上游响应：先关闭底层 socket 以唤醒阻塞在读取上的线程，再关闭响应归还连接池槽位"""
+    try:
+        _upstream_socket(response).shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
+    try:
+        response.close()
+    except Exception:
+        pass
+
+def _discard_result(future):
+    """吞掉被放弃的线程任务结果或异常"""
+    if not future.cancelled():
+        future.exception()
+
+async def stream_to_client(request: Request, iterator, response: requests.Response, session: requests.Session,
+                           meter: dict, slot: LimiterSlot, timeouts: UpstreamTimeouts, started: float,
+                           keepalive: float = 0):
+    """在线程池中逐块消费同步生成器，并在客户端断开或上游超时时立即关闭上游流
+
+    等待上游下一行时按 DISCONNECT_CHECK_INTERVAL 轮询客户端连接状态，
+    断开后中断上游 socket、释放并发槽位并记录取消统计。
+    超过 timeouts.idle 秒没有读到上游数据，或距 started 超过 timeouts.total 秒时同样中断并计入超时统计。
+    超时或读取上游出错时，先向客户端发送一条 SSE error 事件再结束流。
+    keepalive 大于 0 时，超过该时间没有向客户端发出数据就发送一条 SSE 注释。
+    流结束后关闭 session；读取线程仍在运行时等它退出再关闭，避免 curl_cffi 句柄在使用中被释放。
+    """
+    loop = asyncio.get_running_loop()
+    pending = None
+    completed = False
+    timed_out = None
+    last_check = time.monotonic()
+    last_activity = last_check
+    last_sent = last_check
+    last_bytes = meter.get("bytes", 0)
+    try:
+        while True:
+            if pending is None:
+                pending = loop.run_in_executor(upstream_executor, next, iterator, _STREAM_END)
+            done, _ = await asyncio.wait({pending}, timeout=DISCONNECT_CHECK_INTERVAL)
+            now = time.monotonic()
+            # 读取线程每读到一行都会更新 meter，用字节数变化判断上游是否仍有数据
+            if done or meter.get("bytes", 0) != last_bytes:
+                last_bytes = meter.get("bytes", 0)
+                last_activity = now
+            if timeouts.total and now - started > timeouts.total:
+                timed_out = "total"
+            elif timeouts.idle and now - last_activity > timeouts.idle:
+                timed_out = "idle"
+            if timed_out:
+                yield sse_error_event(APIError(504, f"Upstream stream exceeded the {timed_out} timeout",
+                                               "upstream_timeout"), meter)
+                break
+            if not done or now - last_check >= DISCONNECT_CHECK_INTERVAL:
+                last_check = now
+                if await request.is_disconnected():
+                    break
+            if not done:
+                if keepalive and now - last_sent >= keepalive:
+                    last_sent = now
+                    stream_stats["keepalives"] += 1
+                    yield ": keepalive\n\n"
+                continue
+            try:
+                chunk = pending.result()
+            except Exception as e:
+                pending = None
+                error = unexpected_error(e)
+                logger.error(f"Upstream stream failed after {meter.get('bytes', 0)} bytes: {e!r}",
+                             exc_info=error.code == "internal_error")
+                yield sse_error_event(error, meter)
+                break
+            pending = None
+            if chunk is _STREAM_END:
+                completed = True
+                break
+            last_sent = now
+            yield chunk
+    finally:
+        if completed:
+            response.close()
+        else:
+            abort_upstream(response)
+        if pending is not None:
+            pending.add_done_callback(_discard_result)
+            pending.add_done_callback(lambda _: session.close())
+        else:
+            iterator.close()
+            session.close()
+        slot.release()
+
+        bytes_read = meter.get("bytes", 0)
+        stream_stats["upstream_bytes_read"] += bytes_read
+        # 发出过 error 事件的流已计入 failed，之后无论流如何结束都不再算作完成或取消
+        failed = meter.get("error") is not None
+        if timed_out:
+            stream_stats["timed_out"] += 1
+            timeout_stats[timed_out] += 1
+            logger.warning(f"Upstream stream hit the {timed_out} timeout after {bytes_read} bytes, aborted")
+        elif completed and not failed:
+            stream_stats["completed"] += 1
+            avg = _avg_stream_bytes[0]
+            _avg_stream_bytes[0] = bytes_read if not avg else avg * 0.9 + bytes_read * 0.1
+        elif not failed:
+            stream_stats["cancelled"] += 1
+            saved = max(0, int(_avg_stream_bytes[0] - bytes_read))
+            stream_stats["estimated_bytes_saved"] += saved
+            logger.info(f"Client disconnected, cancelled upstream stream after {bytes_read} bytes (~{saved} bytes saved)")
+
+# 上下文窗口管理：按模型的 token 预算（0 表示不裁剪）
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))
+CONTEXT_TOKEN_BUDGETS = parse_model_limits(os.getenv("CONTEXT_TOKEN_BUDGETS"))
+# 为模型输出预留的 token 数
+CONTEXT_RESERVED_TOKENS = int(os.getenv("CONTEXT_RESERVED_TOKENS", "2048"))
+# 各模型每个 token 对应的平均拉丁字符数
+MODEL_CHARS_PER_TOKEN = {"DeepSeek-R1": 3.8, "AkashGen": 4.0}
+DEFAULT_CHARS_PER_TOKEN = 4.0
+# 哪些消息附带 parts：all（与官网一致）、last（仅最后一条）、none
+MESSAGE_PARTS_MODE = os.getenv("MESSAGE_PARTS_MODE", "last").lower()
+
+context_stats = {
+    "trimmed_requests": 0,
+    "messages_dropped": 0,
+    "tokens_dropped": 0,
+    "duplicate_bytes_saved": 0
+}
+
+def estimate_tokens(text: str, model: str) -> int:
+    """粗略估算 token 数：拉丁字符按模型的字符/token 比例，CJK 等非 ASCII 字符约一个字符一个 token"""
+    if not text:
+        return 0
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    ratio = MODEL_CHARS_PER_TOKEN.get(model, DEFAULT_CHARS_PER_TOKEN)
+    return int(ascii_chars / ratio) + (len(text) - ascii_chars) + 1
+
+# 每张图片按固定 token 数估算（与 OpenAI 高清图片的典型开销相当）
+IMAGE_TOKEN_ESTIMATE = 765
+
+class TokenCounter:
+    """按 estimate_tokens 的规则增量估算流式输出的 token 数，只累计字符数不保存文本"""
+
+    def __init__(self, model: str):
+        self.ratio = MODEL_CHARS_PER_TOKEN.get(model, DEFAULT_CHARS_PER_TOKEN)
+        self.ascii_chars = 0
+        self.other_chars = 0
+
+    def add(self, text: str):
+        ascii_chars = len(text.encode('ascii', 'ignore'))
+        self.ascii_chars += ascii_chars
+        self.other_chars += len(text) - ascii_chars
+
+    def total(self) -> int:
+        return int(self.ascii_chars / self.ratio) + self.other_chars
+
+def estimate_prompt_tokens(akash_data: dict) -> int:
+    """估算转发给 Akash 的提示词 token 数"""
+    model = akash_data["model"]
+    tokens = estimate_tokens(akash_data.get("system", ""), model)
+    for msg in akash_data["messages"]:
+        tokens += estimate_tokens(msg.get("content", ""), model) + 4
+        tokens += IMAGE_TOKEN_ESTIMATE * len(msg.get("experimental_attachments", []))
+    return tokens
+
+def convert_content(content) -> tuple:
+    """把 OpenAI 的 content（字符串或内容片段数组）转换为 (文本, 文本 parts, 图片附件)
+
+    image_url 会原样引用客户端传来的 URL 字符串（包括 base64 data URL），
+    只切片读取 data URL 的头部来获得 MIME 类型，不做解码或复制。
+    """
+    if content is None:
+        return "", [], []
+    if isinstance(content, str):
+        return content, [{"type": "text", "text": content}], []
+
+    texts = []
+    attachments = []
+    for part in content if isinstance(content, list) else []:
+        if not isinstance(part, dict):
+            continue
+        part_type = part.get("type")
+        if part_type == "text":
+            texts.append(part.get("text") or "")
+        elif part_type == "image_url":
+            image = part.get("image_url")
+            url = image.get("url") if isinstance(image, dict) else image
+            if not url:
+                continue
+            if url.startswith("data:"):
+                # 形如 data:image/png;base64,...，只查找前 100 个字符内的分隔符
+                end = url.find(";", 5, 100)
+                content_type = url[5:end] if end > 0 else "image/png"
+            else:
+                content_type = mimetypes.guess_type(url.split("?", 1)[0])[0] or "image/jpeg"
+            attachments.append({
+                "name": f"image-{len(attachments) + 1}",
+                "contentType": content_type,
+                "url": url
+            })
+        else:
+            logger.debug(f"Ignoring unsupported content part type: {part_type}")
+    return "\n".join(texts), [{"type": "text", "text": text} for text in texts], attachments
+
+def message_text(msg: dict) -> str:
+    """取出消息中的文本内容"""
+    content = msg.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(part.get("text") or "" for part in content
+                         if isinstance(part, dict) and part.get("type") == "text")
+    return ""
+
+def estimate_message_tokens(msg: dict, model: str) -> int:
+    # 每条消息额外计入角色与分隔符的开销，图片按固定开销计算而非 base64 长度
+    tokens = estimate_tokens(message_text(msg), model) + 4
+    content = msg.get("content")
+    if isinstance(content, list):
+        tokens += IMAGE_TOKEN_ESTIMATE * sum(
+            1 for part in content if isinstance(part, dict) and part.get("type") == "image_url"
+        )
+    return tokens
+
+def trim_messages(messages: list, model: str, system: str) -> tuple:
+    """按预算从最早的非 system 消息开始裁剪，始终保留 system 消息与最后一条消息
+
+    返回 (保留的消息, 丢弃条数, 丢弃的估算 token 数)。
+    """
+    budget = CONTEXT_TOKEN_BUDGETS.get(model, CONTEXT_TOKEN_BUDGET)
+    if budget <= 0 or len(messages) <= 1:
+        return messages, 0, 0
+
+    costs = [estimate_message_tokens(msg, model) for msg in messages]
+    total = sum(costs) + estimate_tokens(system, model)
+    limit = max(budget - CONTEXT_RESERVED_TOKENS, 0)
+    if total <= limit:
+        return messages, 0, 0
+
+    keep = [True] * len(messages)
+    dropped_tokens = 0
+    last = len(messages) - 1
+    for index, msg in enumerate(messages[:last]):
+        if total <= limit:
+            break
+        if msg.get("role") == "system":
+            continue
+        keep[index] = False
+        total -= costs[index]
+        dropped_tokens += costs[index]
+    # 不以 assistant 消息开头，避免留下没有提问的回答
+    for index, msg in enumerate(messages[:last]):
+        if not keep[index] or msg.get("role") == "system":
+            continue
+        if msg.get("role") != "assistant":
+            break
+        keep[index] = False
+        dropped_tokens += costs[index]
+
+    kept = [msg for msg, flag in zip(messages, keep) if flag]
+    if total > limit:
+        logger.warning(f"Prompt for {model} still ~{total} tokens after trimming (budget {limit})")
+    return kept, len(messages) - len(kept), dropped_tokens
+
+def tool_invocations(msg: dict, tool_results: dict) -> list:
+    """把 assistant 消息的 tool_calls 与对应的 tool 消息合并为 Akash 网页端使用的 toolInvocations"""
+    invocations = []
+    for call in msg.get("tool_calls") or []:
+        function = call.get("function") or {}
+        try:
+            args = json.loads(function.get("arguments") or "{}")
+        except ValueError:
+            args = function.get("arguments")
+        invocation = {
+            "state": "call",
+            "toolCallId": call.get("id"),
+            "toolName": function.get("name"),
+            "args": args
+        }
+        if call.get("id") in tool_results:
+            invocation["state"] = "result"
+            invocation["result"] = message_text(tool_results[call["id"]])
+        invocations.append(invocation)
+    return invocations
+
+def prepare_messages(messages: list, model: str, system: str) -> tuple:
+    """转发前的提示词预处理：裁剪到上下文预算，并把消息转换为 Akash 格式
+
+    官网请求中每条消息的 content 会在 parts 中重复一份；按 MESSAGE_PARTS_MODE
+    只为需要的消息附带 parts，减少长对话的上传体积。返回 (消息列表, system)。
+    """
+    kept, dropped, dropped_tokens = trim_messages(messages, model, system)
+    if dropped:
+        context_stats["trimmed_requests"] += 1
+        context_stats["messages_dropped"] += dropped
+        context_stats["tokens_dropped"] += dropped_tokens
+        logger.info(f"Trimmed {dropped} old messages (~{dropped_tokens} tokens) to fit the {model} context budget")
+        system = f"{system}\n\n(Earlier conversation truncated: {dropped} messages omitted.)"
+
+    # tool 消息没有独立的 Akash 角色，结果并入发起调用的 assistant 消息
+    tool_results = {msg.get("tool_call_id"): msg for msg in kept if msg.get("role") == "tool"}
+    processed_messages = []
+    last = max((index for index, msg in enumerate(kept) if msg.get("role") != "tool"), default=-1)
+    for index, msg in enumerate(kept):
+        if msg.get("role") == "tool":
+            continue
+        text, text_parts, attachments = convert_content(msg.get("content"))
+        processed_msg = {
+            "role": msg.get("role"),
+            "content": text
+        }
+        if attachments:
+            processed_msg["experimental_attachments"] = attachments
+        invocations = tool_invocations(msg, tool_results)
+        if invocations:
+            processed_msg["toolInvocations"] = invocations
+        if MESSAGE_PARTS_MODE == "all" or (MESSAGE_PARTS_MODE == "last" and index == last):
+            processed_msg["parts"] = text_parts + [
+                {"type": "tool-invocation", "toolInvocation": invocation} for invocation in invocations
+            ]
+        else:
+            context_stats["duplicate_bytes_saved"] += len(text.encode('utf-8'))
+        processed_messages.append(processed_msg)
+    return processed_messages, system
+
+# 确定性请求（temperature=0）的响应缓存，默认关闭
+COMPLETION_CACHE_ENABLED = os.getenv("COMPLETION_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+COMPLETION_CACHE_MAX_BYTES = int(os.getenv("COMPLETION_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", "3600"))
+
+class CachedCompletion(NamedTuple):
+    model: str
+    content: str
+    reasoning_content: str
+    finish_reason: str
+    expires_at: float
+    size: int
+
+class CompletionCache:
+    """按内存上限做 LRU 淘汰并带 TTL 的响应缓存，可在线程池中安全写入"""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+    def get(self, key: str) -> Optional[CachedCompletion]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry.expires_at <= time.time():
+                self._remove(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def put(self, key: str, model: str, content: str, finish_reason: str, reasoning_content: str = ""):
+        # 按 UTF-8 长度加上固定开销估算占用
+        size = len(content.encode('utf-8')) + len(reasoning_content.encode('utf-8')) + 256
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CachedCompletion(model, content, reasoning_content, finish_reason,
+                                                   time.time() + self.ttl, size)
+            self._size += size
+            self.stats["stores"] += 1
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": COMPLETION_CACHE_ENABLED,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                **self.stats
+            }
+
+completion_cache = CompletionCache(COMPLETION_CACHE_MAX_BYTES, COMPLETION_CACHE_TTL)
+
+def completion_cache_key(akash_data: dict) -> str:
+    """对规范化后的 akash_data（去掉每次随机生成的 id）计算缓存键
+
+    逐段编码并增量计算哈希，带有大图片时不会生成整份 JSON 字符串。
+    """
+    payload = {key: value for key, value in akash_data.items() if key != "id"}
+    encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256()
+    for chunk in encoder.iterencode(payload):
+        digest.update(chunk.encode('utf-8'))
+    return digest.hexdigest()
+
+def encode_payload(payload: dict) -> bytes:
+    """把上游请求体序列化一次，供重试与对冲请求复用"""
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def build_chunk(chat_id: str, model: str, delta: dict, finish_reason: Optional[str] = None) -> dict:
+    """构造流式的 chat.completion.chunk"""
+    return {
+        "id": f"chatcmpl-{chat_id}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "delta": delta,
+            "index": 0,
+            "finish_reason": finish_reason
+        }]
+    }
+
+def build_usage(prompt_tokens: int, completion_tokens: int) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+def build_usage_chunk(chat_id: str, model: str, usage: dict) -> dict:
+    """stream_options.include_usage 要求的最后一个块：choices 为空，只携带 usage"""
+    return {
+        "id": f"chatcmpl-{chat_id}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [],
+        "usage": usage
+    }
+
+def build_completion(chat_id: str, model: str, content: str, finish_reason: str,
+                     reasoning_content: Optional[str] = None, tool_calls: Optional[list] = None,
+                     usage: Optional[dict] = None) -> dict:
+    """构造非流式的 chat.completion 响应"""
+    message = {"role": "assistant", "content": content if content or not tool_calls else None}
+    if reasoning_content:
+        message["reasoning_content"] = reasoning_content
+    if tool_calls:
+        message["tool_calls"] = tool_calls
+    completion = {
+        "id": f"chatcmpl-{chat_id}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": message,
+            "finish_reason": finish_reason
+        }]
+    }
+    if usage:
+        completion["usage"] = usage
+    return completion
+
+def replay_cached_stream(chat_id: str, entry: CachedCompletion, usage: Optional[dict] = None):
+    """以 SSE 形式回放缓存的响应"""
+    deltas = [({"role": "assistant", "content": entry.content}, None), ({}, entry.finish_reason)]
+    if entry.reasoning_content:
+        deltas.insert(0, ({"role": "assistant", "reasoning_content": entry.reasoning_content}, None))
+    for delta, finish_reason in deltas:
+        yield f"data: {json.dumps(build_chunk(chat_id, entry.model, delta, finish_reason))}\n\n"
+    if usage:
+        yield f"data: {json.dumps(build_usage_chunk(chat_id, entry.model, usage))}\n\n"
+    yield "data: [DONE]\n\n"
+
+async def collect_completion(stream, chat_id: str, model: str) -> dict:
+    """把 SSE 流聚合成单个 chat.completion 响应（stream=false 时使用）
+
+    流中出现 error 事件时直接返回该错误对象，由调用方转换为对应的状态码。
+    """
+    content = []
+    reasoning = []
+    tool_calls = {}
+    finish_reason = None
+    usage = None
+    try:
+        async for event in stream:
+            if not event.startswith("data: "):
+                continue
+            payload = event[6:].strip()
+            # [DONE] 之后生成器随即结束，继续读到流结束才会被记为正常完成
+            if payload == "[DONE]":
+                continue
+            chunk = json.loads(payload)
+            if "error" in chunk:
+                return chunk
+            usage = chunk.get("usage") or usage
+            for choice in chunk.get("choices", []):
+                delta = choice.get("delta", {})
+                if delta.get("content"):
+                    content.append(delta["content"])
+                if delta.get("reasoning_content"):
+                    reasoning.append(delta["reasoning_content"])
+                for call in delta.get("tool_calls") or []:
+                    entry = tool_calls.setdefault(call["index"], {"id": None, "type": "function",
+                                                                  "function": {"name": None, "arguments": ""}})
+                    if call.get("id"):
+                        entry["id"] = call["id"]
+                    function = call.get("function") or {}
+                    if function.get("name"):
+                        entry["function"]["name"] = function["name"]
+                    entry["function"]["arguments"] += function.get("arguments") or ""
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+    finally:
+        await stream.aclose()
+    return build_completion(chat_id, model, "".join(content), finish_reason or "stop",
+                            "".join(reasoning) or None, [tool_calls[index] for index in sorted(tool_calls)] or None,
+                            usage)
+
+# Vercel AI data stream 的结束原因到 OpenAI finish_reason 的映射
+FINISH_REASONS = {"stop": "stop", "length": "length", "tool-calls": "tool_calls", "content-filter": "content_filter"}
+
+class DataStreamParser:
+    """逐行解析 Vercel AI data stream（"<类型>:<JSON>"），转换为 OpenAI 的 delta
+
+    0 文本、g 推理、b/c 流式工具调用（开始 / 参数增量）、9 完整工具调用、
+    3 错误、e 步骤结束、d 消息结束；其余类型（f、2、8、a 等）没有对应的 OpenAI 字段，直接忽略。
+    每行独立解析，不缓存整个响应。
+    """
+
+    def __init__(self):
+        self.tool_indexes = {}
+        self.streamed_tools = set()
+        self.finish_reason = None
+        self.finished = False
+        self.error = None
+        self.usage = None
+        self._step_usage = [0, 0]
+
+    def _tool_index(self, tool_call_id: str) -> int:
+        if tool_call_id not in self.tool_indexes:
+            self.tool_indexes[tool_call_id] = len(self.tool_indexes)
+        return self.tool_indexes[tool_call_id]
+
+    def feed(self, msg_type: str, value) -> list:
+        """处理一行，返回需要发送的 delta 列表"""
+        if msg_type == '0':
+            return [{"content": value}] if value else []
+        if msg_type == 'g':
+            return [{"reasoning_content": value}] if value else []
+        if msg_type == 'b':
+            self.streamed_tools.add(value["toolCallId"])
+            return [{"tool_calls": [{
+                "index": self._tool_index(value["toolCallId"]),
+                "id": value["toolCallId"],
+                "type": "function",
+                "function": {"name": value.get("toolName"), "arguments": ""}
+            }]}]
+        if msg_type == 'c':
+            self.streamed_tools.add(value["toolCallId"])
+            return [{"tool_calls": [{
+                "index": self._tool_index(value["toolCallId"]),
+                "function": {"arguments": value.get("argsTextDelta", "")}
+            }]}]
+        if msg_type == '9':
+            # 已经以 b/c 增量发送过的工具调用，完整版本不再重复发送
+            if value["toolCallId"] in self.streamed_tools:
+                return []
+            return [{"tool_calls": [{
+                "index": self._tool_index(value["toolCallId"]),
+                "id": value["toolCallId"],
+                "type": "function",
+                "function": {"name": value.get("toolName"), "arguments": json.dumps(value.get("args", {}), ensure_ascii=False)}
+            }]}]
+        if msg_type == '3':
+            self.error = value
+            logger.error(f"Akash stream error: {value}")
+            return []
+        if msg_type in ('e', 'd'):
+            reason = value.get("finishReason") if isinstance(value, dict) else None
+            if reason:
+                self.finish_reason = FINISH_REASONS.get(reason, "stop")
+            self._record_usage(msg_type, value.get("usage") if isinstance(value, dict) else None)
+            self.finished = self.finished or msg_type == 'd'
+        return []
+
+    def _record_usage(self, msg_type: str, usage):
+        # d 携带整条消息的用量；只有 e 时累加各步骤的用量。上游可能返回 NaN 等非整数值
+        if not isinstance(usage, dict):
+            return
+        prompt, completion = usage.get("promptTokens"), usage.get("completionTokens")
+        if not (isinstance(prompt, int) and isinstance(completion, int)):
+            return
+        if msg_type == 'd':
+            self.usage = (prompt, completion)
+        else:
+            self._step_usage[0] += prompt
+            self._step_usage[1] += completion
+            self.usage = tuple(self._step_usage)
+
+    def final_reason(self) -> str:
+        if self.finish_reason:
+            return self.finish_reason
+        return "tool_calls" if self.tool_indexes else "stop"
+
+# 推理内容的输出方式：separate 作为 reasoning_content 单独发送，inline 保留 <think> 原样放在 content 中，drop 丢弃
+REASONING_MODE = os.getenv("REASONING_MODE", "separate").lower()
+
+class ThinkSplitter:
+    """流式拆分 content 中的 <think>...</think>，标签可能跨越相邻片段
+
+    以状态机逐片段处理：末尾可能是标签前缀的部分先暂存，等下一个片段到来再判断。
+    </think> 之后紧跟的空白不会发送，避免正文以空行开头。
+    """
+
+    OPEN = "<think>"
+    CLOSE = "</think>"
+
+    def __init__(self):
+        self.in_think = False
+        self.pending = ""
+        self.strip_leading = False
+
+    def _emit(self, out: list, text: str):
+        if not text:
+            return
+        if self.in_think:
+            out.append({"reasoning_content": text})
+            return
+        if self.strip_leading:
+            text = text.lstrip()
+            if not text:
+                return
+            self.strip_leading = False
+        out.append({"content": text})
+
+    def feed(self, text: str) -> list:
+        """处理一个 content 片段，返回拆分后的 delta 列表"""
+        buffer = self.pending + text
+        self.pending = ""
+        out = []
+        while buffer:
+            tag = self.CLOSE if self.in_think else self.OPEN
+            position = buffer.find(tag)
+            if position >= 0:
+                self._emit(out, buffer[:position])
+                buffer = buffer[position + len(tag):]
+                self.in_think = not self.in_think
+                self.strip_leading = not self.in_think
+                continue
+            # 保留可能是标签开头的末尾部分
+            keep = next((size for size in range(min(len(tag) - 1, len(buffer)), 0, -1)
+                         if buffer.endswith(tag[:size])), 0)
+            self._emit(out, buffer[:len(buffer) - keep])
+            self.pending = buffer[len(buffer) - keep:]
+            break
+        return out
+
+    def flush(self) -> list:
+        """流结束时发送暂存的内容"""
+        out = []
+        self._emit(out, self.pending)
+        self.pending = ""
+        return out
+
+class BrowserFingerprint(NamedTuple):
+    """不可变的浏览器指纹：请求头在构建时一次性生成，可在请求间安全共享"""
+    user_agent: str
+    viewport: tuple
+    headers: Mapping[str, str]
+
+# 预生成的指纹池大小
+FINGERPRINT_POOL_SIZE = int(os.getenv("FINGERPRINT_POOL_SIZE", "16"))
+
+def build_browser_fingerprint(rng: random.Random) -> BrowserFingerprint:
     """生成随机的浏览器指纹"""
     # 随机选择浏览器版本
     chrome_versions = ["120", "121", "122", "123", "124", "125"]
     edge_versions = ["120", "121", "122", "123", "124", "125"]
-    selected_version = random.choice(chrome_versions)
-    edge_version = random.choice(edge_versions)
+    selected_version = rng.choice(chrome_versions)
+    edge_version = rng.choice(edge_versions)
     
-    # 随机选择操作系统
+    # 随机选择操作系统，sec-ch-ua-platform 与 UA 中的系统保持一致
     os_versions = [
-        "Windows NT 10.0; Win64; x64",
-        "Macintosh; Intel Mac OS X 10_15_7",
-        "Macintosh; Intel Mac OS X 11_0_1",
-        "Macintosh; Intel Mac OS X 12_0_1"
+        ("Windows NT 10.0; Win64; x64", '"Windows"'),
+        ("Macintosh; Intel Mac OS X 10_15_7", '"macOS"'),
+        ("Macintosh; Intel Mac OS X 11_0_1", '"macOS"'),
+        ("Macintosh; Intel Mac OS X 12_0_1", '"macOS"')
     ]
-    selected_os = random.choice(os_versions)
+    selected_os, platform = rng.choice(os_versions)
     
     # 随机选择语言偏好
     languages = [
@@ -116,7 +1600,7 @@ def get_random_browser_fingerprint():
         "zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6",
         "en-GB,en;q=0.9,en-US;q=0.8"
     ]
-    selected_language = random.choice(languages)
+    selected_language = rng.choice(languages)
     
     # 随机选择视口大小
     viewport_sizes = [
@@ -126,7 +1610,7 @@ def get_random_browser_fingerprint():
         (1536, 864),
         (1680, 1050)
     ]
-    selected_viewport = random.choice(viewport_sizes)
+    selected_viewport = rng.choice(viewport_sizes)
     
     # 构建用户代理字符串
     user_agent = f"Mozilla/5.0 ({selected_os}) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{selected_version}.0.0.0 Safari/537.36 Edg/{edge_version}.0.0.0"
@@ -136,273 +1620,385 @@ def get_random_browser_fingerprint():
         "accept": "*/*",
         "accept-language": selected_language,
         "content-type": "application/json",
-        "origin": "https://chat.akash.network",
-        "referer": "https://chat.akash.network/",
+        "origin": settings.primary_url,
+        "referer": f"{settings.primary_url}/",
         "sec-ch-ua": f'"Microsoft Edge";v="{edge_version}", "Not-A.Brand";v="8", "Chromium";v="{selected_version}"',
         "sec-ch-ua-mobile": "?0",
-        "sec-ch-ua-platform": '"macOS"',
+        "sec-ch-ua-platform": platform,
         "sec-fetch-dest": "empty",
         "sec-fetch-mode": "cors",
         "sec-fetch-site": "same-origin",
         "user-agent": user_agent
     }
     
-    return {
-        "headers": headers,
-        "viewport": selected_viewport,
-        "user_agent": user_agent
-    }
+    return BrowserFingerprint(user_agent, selected_viewport, MappingProxyType(headers))
 
-def get_cookie():
-    """获取 cookie 的函数"""
-    browser = None
-    context = None
-    page = None
+# 启动时一次性生成指纹池，请求路径上不再构建请求头
+fingerprint_pool = tuple(
+    build_browser_fingerprint(random.Random()) for _ in range(max(FINGERPRINT_POOL_SIZE, 1))
+)
+
+def get_random_browser_fingerprint() -> BrowserFingerprint:
+    """从指纹池中随机取一个指纹（用于采集新 cookie）"""
+    return random.choice(fingerprint_pool)
+
+# Cloudflare 质询（401/403）与 cookie 刷新计数
+cookie_stats = {
+    "challenges": 0,
+    "refreshes": 0,
+    "renewals": 0,
+    "renewal_failures": 0
+}
+
+def current_fingerprint() -> BrowserFingerprint:
+    """当前 cookie 采集时所用的指纹，上游请求必须与之保持一致以减少 Cloudflare 质询"""
+    return global_data.get("fingerprint") or fingerprint_pool[0]
+
+# 上游传输：requests，或使用 curl_cffi 模拟与指纹一致的浏览器 TLS/HTTP2 特征
+UPSTREAM_TRANSPORT = os.getenv("UPSTREAM_TRANSPORT", "requests").lower()
+# cookie 过期时先尝试用一次 HTTP 请求续期 session_token，失败再启动浏览器
+COOKIE_RENEWAL = os.getenv("COOKIE_RENEWAL", "true").lower() in ("1", "true", "yes")
+# 续期的请求头模拟浏览器直接打开页面
+PAGE_REQUEST_HEADERS = {
+    "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "sec-fetch-dest": "document",
+    "sec-fetch-mode": "navigate",
+    "sec-fetch-site": "none",
+    "upgrade-insecure-requests": "1"
+}
+
+_curl_cffi = {"module": None, "loaded": False}
+
+def register_curl_timeouts(cffi_requests):
+    global CONNECT_TIMEOUT_EXCEPTIONS, TIMEOUT_EXCEPTIONS
+    CONNECT_TIMEOUT_EXCEPTIONS = CONNECT_TIMEOUT_EXCEPTIONS + (cffi_requests.exceptions.ConnectTimeout,)
+    TIMEOUT_EXCEPTIONS = TIMEOUT_EXCEPTIONS + (cffi_requests.exceptions.Timeout,)
+
+def load_curl_cffi():
+    """按需导入 curl_cffi，未安装时返回 None；导入后把它的网络异常也加入可重试异常与超时分类"""
+    global RETRYABLE_EXCEPTIONS
+    if not _curl_cffi["loaded"]:
+        _curl_cffi["loaded"] = True
+        try:
+            from curl_cffi import requests as cffi_requests
+        except ImportError as e:
+            logger.warning(f"curl_cffi not available, using requests transport: {e}")
+        else:
+            _curl_cffi["module"] = cffi_requests
+            RETRYABLE_EXCEPTIONS = RETRYABLE_EXCEPTIONS + (cffi_requests.RequestsError,)
+            register_curl_timeouts(cffi_requests)
+    return _curl_cffi["module"]
+
+@functools.lru_cache(maxsize=None)
+def impersonate_target(user_agent: str) -> str:
+    """选择不高于 UA 中 Chrome 主版本的最新 curl_cffi 模拟目标"""
+    from curl_cffi.requests import BrowserType
+    match = re.search(r"Chrome/(\d+)", user_agent)
+    versions = sorted(int(m.group(1)) for m in (re.fullmatch(r"chrome(\d+)", b.value) for b in BrowserType) if m)
+    candidates = [version for version in versions if match and version <= int(match.group(1))]
+    return f"chrome{candidates[-1]}" if candidates else "chrome"
+
+# 尚未回收的上游会话，停机时统一关闭其连接池
+_open_sessions = weakref.WeakSet()
+
+def new_upstream_session(fingerprint: BrowserFingerprint):
+    """按 UPSTREAM_TRANSPORT 创建访问 Akash 的会话，并带上指纹请求头"""
+    cffi_requests = load_curl_cffi() if UPSTREAM_TRANSPORT == "curl_cffi" else None
+    if cffi_requests:
+        session = cffi_requests.Session(impersonate=impersonate_target(fingerprint.user_agent))
+    else:
+        session = requests.Session()
+    session.headers.update(fingerprint.headers)
+    _open_sessions.add(session)
+    return session
+
+def set_cookie_expiry(set_cookie_headers: list, name: str) -> Optional[float]:
+    """从 Set-Cookie 响应头中读取指定 cookie 的过期时间（curl_cffi 的 cookie jar 不保留该信息）"""
+    for header in set_cookie_headers:
+        jar = SimpleCookie()
+        try:
+            jar.load(header)
+        except CookieError:
+            continue
+        morsel = jar.get(name)
+        if morsel is None:
+            continue
+        try:
+            if morsel["max-age"]:
+                return time.time() + int(morsel["max-age"])
+            if morsel["expires"]:
+                return parsedate_to_datetime(morsel["expires"]).timestamp()
+        except (TypeError, ValueError):
+            return None
+    return None
+
+def renew_cookie() -> Optional[str]:
+    """用与指纹一致的 curl_cffi 会话打开一次首页续期 session_token
+
+    cf_clearance 仍然有效时站点会直接返回页面并下发新的 session_token，
+    只需一次 HTTP 请求；遇到 Cloudflare 质询或没有新 token 时返回 None，由调用方改用浏览器采集。
+    """
+    cookie = global_data["cookie"]
+    fingerprint = global_data["fingerprint"]
+    if not (COOKIE_RENEWAL and cookie and fingerprint):
+        return None
+    cffi_requests = load_curl_cffi()
+    if not cffi_requests:
+        return None
     
+    headers = {name: value for name, value in fingerprint.headers.items()
+               if name not in ("content-type", "origin", "sec-fetch-dest", "sec-fetch-mode", "sec-fetch-site")}
+    headers.update(PAGE_REQUEST_HEADERS)
     try:
-        logger.info("Starting cookie retrieval process...")
-        
-        # 获取随机浏览器指纹
-        fingerprint = get_random_browser_fingerprint()
-        logger.info(f"Using browser fingerprint: {fingerprint['user_agent']}")
-        
-        with sync_playwright() as p:
-            try:
-                # 启动浏览器
-                logger.info("Launching browser...")
-                browser = p.chromium.launch(
-                    headless=True,
-                    args=[
-                        '--no-sandbox',
-                        '--disable-dev-shm-usage',
-                        '--disable-gpu',
-                        '--disable-software-rasterizer',
-                        '--disable-extensions',
-                        '--disable-setuid-sandbox',
-                        '--no-first-run',
-                        '--no-zygote',
-                        '--single-process',
-                        f'--window-size={fingerprint["viewport"][0]},{fingerprint["viewport"][1]}',
-                        '--disable-blink-features=AutomationControlled',
-                        '--disable-features=IsolateOrigins,site-per-process'
-                    ]
-                )
-                
-                logger.info("Browser launched successfully")
-                
-                # 创建上下文，使用随机指纹
-                logger.info("Creating browser context...")
-                context = browser.new_context(
-                    viewport={'width': fingerprint["viewport"][0], 'height': fingerprint["viewport"][1]},
-                    user_agent=fingerprint["user_agent"],
-                    locale='en-US',
-                    timezone_id='America/New_York',
-                    permissions=['geolocation'],
-                    extra_http_headers=fingerprint["headers"]
-                )
-                
-                # 添加脚本以覆盖 navigator.webdriver
-                context.add_init_script("""
-                    Object.defineProperty(navigator, 'webdriver', {
-                        get: () => false,
-                    });
-                    // 更多指纹伪装
-                    Object.defineProperty(navigator, 'plugins', {
-                        get: () => [1, 2, 3, 4, 5],
-                    });
-                """)
-                
-                logger.info("Browser context created successfully")
-                
-                # 创建页面
-                logger.info("Creating new page...")
-                page = context.new_page()
-                logger.info("Page created successfully")
-                
-                # 设置页面超时
-                page.set_default_timeout(60000)
-                
-                # 访问目标网站，添加重试机制
-                max_retries = 3
-                retry_delay = 5
-                
-                for attempt in range(max_retries):
-                    try:
-                        logger.info(f"Navigating to target website (attempt {attempt + 1}/{max_retries})...")
-                        page.goto("https://chat.akash.network/", timeout=50000)
-                        break
-                    except Exception as e:
-                        if attempt == max_retries - 1:
-                            raise
-                        logger.warning(f"Navigation attempt {attempt + 1} failed: {e}")
-                        time.sleep(retry_delay)
-                
-                # 等待页面加载
-                logger.info("Waiting for page load...")
-                try:
-                    # 首先等待 DOM 加载完成
-                    page.wait_for_load_state("domcontentloaded", timeout=30000)
-                    logger.info("DOM content loaded")
-                    
-                    # 等待一段时间，让 Cloudflare 检查完成
-                    logger.info("Waiting for Cloudflare check...")
-                    time.sleep(5)
-                    
-                    # 尝试点击页面，模拟用户行为
-                    try:
-                        page.mouse.move(100, 100)
-                        page.mouse.click(100, 100)
-                        logger.info("Simulated user interaction")
-                        
-                        # 随机滚动页面
-                        page.mouse.wheel(0, 100)
-                        time.sleep(0.5)
-                        page.mouse.wheel(0, -50)
-                        logger.info("Simulated scrolling")
-                    except Exception as e:
-                        logger.warning(f"Failed to simulate user interaction: {e}")
-                    
-                    # 再次等待一段时间
-                    time.sleep(5)
-                    
-                except Exception as e:
-                    logger.warning(f"Timeout waiting for load state: {e}")
-                
-                # 等待更长时间确保页面完全加载
-                try:
-                    page.wait_for_load_state("networkidle", timeout=10000)
-                    logger.info("Network idle reached")
-                except Exception as e:
-                    logger.warning(f"Timeout waiting for network idle: {e}")
-                
-                # 获取 cookies
-                logger.info("Getting cookies...")
-                cookies = context.cookies()
-                
-                if not cookies:
-                    logger.error("No cookies found")
-                    return None
-                
-                # 记录所有 cookie 名称以进行调试
-                cookie_names = [cookie['name'] for cookie in cookies]
-                logger.info(f"Retrieved cookies: {cookie_names}")
-                    
-                # 检查是否有 cf_clearance cookie
-                cf_cookie = next((cookie for cookie in cookies if cookie['name'] == 'cf_clearance'), None)
-                if not cf_cookie:
-                    logger.error("cf_clearance cookie not found")
-                    return None
-                
-                # 检查是否有 session_token cookie
-                session_cookie = next((cookie for cookie in cookies if cookie['name'] == 'session_token'), None)
-                if not session_cookie:
-                    logger.error("session_token cookie not found")
-                    # 继续执行，因为某些情况下可能不需要 session_token
-                    
-                # 构建 cookie 字符串
-                cookie_str = '; '.join([f"{cookie['name']}={cookie['value']}" for cookie in cookies])
-                logger.info(f"Cookie string length: {len(cookie_str)}")
-                
-                global_data["cookie"] = cookie_str
-                global_data["cookies"] = cookies  # 保存完整的 cookies 列表
-                global_data["last_update"] = time.time()
-                
-                # 设置 cookie 过期时间
-                if session_cookie and 'expires' in session_cookie and session_cookie['expires'] > 0:
-                    global_data["cookie_expires"] = session_cookie['expires']
-                    logger.info(f"Session token expires at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(session_cookie['expires']))}")
-                else:
-                    # 如果没有明确的过期时间，默认设置为30分钟后过期
-                    global_data["cookie_expires"] = time.time() + 1800  # 30 分钟
-                    logger.info("No explicit expiration in session_token cookie, setting default 30 minute expiration")
-                
-                logger.info("Successfully retrieved cookies")
-                return cookie_str
-                
-            except Exception as e:
-                logger.error(f"Error in browser operations: {e}")
-                logger.error(f"Error type: {type(e)}")
-                import traceback
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                return None
-            finally:
-                # 确保资源被正确关闭
-                try:
-                    if page:
-                        logger.info("Closing page...")
-                        try:
-                            page.close()
-                            logger.info("Page closed successfully")
-                        except Exception as e:
-                            logger.error(f"Error closing page: {e}")
-                except Exception as e:
-                    logger.error(f"Error in page cleanup: {e}")
-                
-                try:
-                    if context:
-                        logger.info("Closing context...")
-                        try:
-                            context.close()
-                            logger.info("Context closed successfully")
-                        except Exception as e:
-                            logger.error(f"Error closing context: {e}")
-                except Exception as e:
-                    logger.error(f"Error in context cleanup: {e}")
-                
-                try:
-                    if browser:
-                        logger.info("Closing browser...")
-                        try:
-                            browser.close()
-                            logger.info("Browser closed successfully")
-                        except Exception as e:
-                            logger.error(f"Error closing browser: {e}")
-                except Exception as e:
-                    logger.error(f"Error in browser cleanup: {e}")
-                
-                # 确保所有资源都被清理
-                page = None
-                context = None
-                browser = None
-                
-                # 主动触发垃圾回收
-                import gc
-                gc.collect()
-                logger.info("Resource cleanup completed")
+        with cffi_requests.Session(impersonate=impersonate_target(fingerprint.user_agent)) as session:
+            response = session.get(f"{settings.primary_url}/", cookies=parse_cookie_string(cookie), headers=headers,
+                                   timeout=15)
+            renewed = {c.name: c.value for c in response.cookies.jar}
+    except cffi_requests.RequestsError as e:
+        logger.warning(f"Cookie renewal request failed: {e}")
+        cookie_stats["renewal_failures"] += 1
+        return None
     
-    except Exception as e:
-        logger.error(f"Error fetching cookie: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+    if response.status_code != 200 or response.headers.get("cf-mitigated") or "session_token" not in renewed:
+        logger.info(f"Cookie renewal not possible (status {response.status_code}), falling back to browser")
+        cookie_stats["renewal_failures"] += 1
+        return None
     
-    # 最后再次确保资源被清理
-    if page:
-        try:
-            page.close()
-        except:
-            pass
-    if context:
+    values = parse_cookie_string(cookie)
+    values.update(renewed)
+    cookie_str = '; '.join(f"{name}={value}" for name, value in values.items())
+    expires = set_cookie_expiry(response.headers.get_list("set-cookie"), "session_token")
+    global_data["cookie"] = cookie_str
+    global_data["cookies"] = [{"name": name, "value": value} for name, value in values.items()]
+    global_data["last_update"] = time.time()
+    global_data["cookie_expires"] = expires if expires and expires > 0 else time.time() + 1800
+    if COOKIE_STORE:
+        save_cookie_store()
+    cookie_stats["renewals"] += 1
+    logger.info("Renewed session_token without launching a browser")
+    return cookie_str
+
+def get_cookie():
+    """获取 cookie 的函数，浏览器采集受熔断保护"""
+    if AKASH_COOKIE:
+        return apply_static_cookie()
+    if RUN_MODE == "api":
+        return load_cookie_store()
+    cookie = renew_cookie()
+    if cookie:
+        return cookie
+    breaker = circuit_breakers["harvest"]
+    if not breaker.allow():
+        logger.warning(f"Cookie harvest circuit open, skipping browser launch for {breaker.retry_after()}s")
+        return None
+    cookie = harvest_cookie()
+    if cookie:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+    return cookie
+
+# 浏览器采集方式：subprocess 在受监管的子进程中运行 Chromium，inline 在本进程的线程中运行
+HARVEST_MODE = os.getenv("HARVEST_MODE", "subprocess").lower()
+# 子进程的总耗时上限（秒）与进程组常驻内存上限（MB，0 表示不限制）
+HARVEST_TIMEOUT = float(os.getenv("HARVEST_TIMEOUT", "180"))
+HARVEST_MAX_RSS_MB = int(os.getenv("HARVEST_MAX_RSS_MB", "700"))
+
+harvest_stats = {
+    "runs": 0,
+    "succeeded": 0,
+    "failed": 0,
+    "timeouts": 0,
+    "memory_kills": 0,
+    "last_duration": None,
+    "last_peak_rss_mb": None
+}
+# 正在运行的 harvester 子进程，停机时整组结束
+_harvest_processes = set()
+
+def fingerprint_to_dict(fingerprint: BrowserFingerprint) -> dict:
+    return {
+        "user_agent": fingerprint.user_agent,
+        "viewport": list(fingerprint.viewport),
+        "headers": dict(fingerprint.headers)
+    }
+
+def fingerprint_from_dict(stored: dict) -> BrowserFingerprint:
+    return BrowserFingerprint(stored["user_agent"], tuple(stored["viewport"]), MappingProxyType(stored["headers"]))
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def process_group_rss(pgid: int) -> Optional[int]:
+    """统计进程组内所有进程（采集子进程、Playwright 驱动与 Chromium）的常驻内存字节数，无 /proc 时返回 None"""
+    try:
+        pids = [name for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return None
+    total = 0
+    for pid in pids:
         try:
-            context.close()
-        except:
-            pass
-    if browser:
+            with open(f"/proc/{pid}/stat") as f:
+                # comm 字段可能包含空格，从最后一个 ')' 之后开始按空格切分
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # fields[2] 为进程组 ID，fields[21] 为常驻页数
+        if int(fields[2]) == pgid:
+            total += int(fields[21]) * _PAGE_SIZE
+    return total
+
+def _kill_process_group(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # 进程组内已没有进程
+        pass
+    if process.poll() is None:
+        process.kill()
+    process.wait()
+
+def harvest_in_subprocess(fingerprint: BrowserFingerprint) -> Optional[dict]:
+    """在独立进程组中运行 harvester，超时或超出内存上限时整组结束，浏览器崩溃不会影响 API 进程
+
+    请求通过 stdin 传入，结果以一行 JSON 经 stdout 管道返回；子进程日志直接输出到 stderr。
+    """
+    harvest_stats["runs"] += 1
+    start = time.monotonic()
+    peak = 0
+    process = subprocess.Popen(
+        [sys.executable, "-m", "harvester"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        start_new_session=True
+    )
+    _harvest_processes.add(process)
+    try:
         try:
-            browser.close()
-        except:
+            process.stdin.write(json.dumps({"base_url": settings.primary_url,
+                                            "fingerprint": fingerprint_to_dict(fingerprint)}).encode('utf-8'))
+            process.stdin.close()
+        except BrokenPipeError:
+            # 子进程已提前退出，下面按退出码处理
             pass
+        while process.poll() is None:
+            if time.monotonic() - start > HARVEST_TIMEOUT:
+                harvest_stats["timeouts"] += 1
+                logger.error(f"Cookie harvester exceeded {HARVEST_TIMEOUT}s, killing it")
+                _kill_process_group(process)
+                return None
+            rss = process_group_rss(process.pid) if HARVEST_MAX_RSS_MB > 0 else None
+            if rss:
+                peak = max(peak, rss)
+                if rss > HARVEST_MAX_RSS_MB * 1024 * 1024:
+                    harvest_stats["memory_kills"] += 1
+                    logger.error(f"Cookie harvester using {rss // (1024 * 1024)}MB (limit {HARVEST_MAX_RSS_MB}MB), killing it")
+                    _kill_process_group(process)
+                    return None
+            time.sleep(0.5)
+        # 子进程退出后可能残留继承了 stdout 的 Chromium 进程，先整组清理再读取管道，避免读不到 EOF
+        _kill_process_group(process)
+        output = process.stdout.read().decode('utf-8', 'replace').strip().splitlines()
+    except BaseException:
+        _kill_process_group(process)
+        raise
+    finally:
+        _harvest_processes.discard(process)
+        process.stdout.close()
+        harvest_stats["last_duration"] = round(time.monotonic() - start, 1)
+        harvest_stats["last_peak_rss_mb"] = round(peak / (1024 * 1024), 1) if peak else None
     
-    # 主动触发垃圾回收
-    import gc
-    gc.collect()
+    if process.returncode != 0 or not output:
+        logger.error(f"Cookie harvester exited with status {process.returncode}")
+        return None
+    try:
+        return json.loads(output[-1])
+    except ValueError:
+        logger.error("Cookie harvester returned malformed output")
+        return None
+
+def harvest_cookie():
+    """使用浏览器获取 cookie，默认在受监管的子进程中运行；Playwright 只在 inline 模式下导入本进程"""
+    # 获取随机浏览器指纹
+    fingerprint = get_random_browser_fingerprint()
+    if HARVEST_MODE == "inline":
+        from harvester import harvest
+        result = harvest(settings.primary_url, fingerprint)
+    else:
+        result = harvest_in_subprocess(fingerprint)
+    if not result:
+        harvest_stats["failed"] += 1
+        return None
+    harvest_stats["succeeded"] += 1
     
-    return None
+    global_data["cookie"] = result["cookie"]
+    global_data["cookies"] = result["cookies"]  # 保存完整的 cookies 列表
+    global_data["fingerprint"] = fingerprint  # cookie 与采集时的指纹绑定
+    global_data["last_update"] = time.time()
+    global_data["cookie_expires"] = result["expires"]
+    if COOKIE_STORE:
+        save_cookie_store()
+    return result["cookie"]
+
+def save_cookie_store():
+    """把当前 cookie 及其绑定的指纹原子地写入共享存储，供 API-only worker 读取"""
+    fingerprint = global_data["fingerprint"]
+    payload = {
+        "cookie": global_data["cookie"],
+        "cookies": global_data["cookies"],
+        "expires": global_data["cookie_expires"],
+        "updated_at": global_data["last_update"],
+        "fingerprint": fingerprint_to_dict(fingerprint)
+    }
+    tmp_path = f"{COOKIE_STORE}.tmp"
+    try:
+        # cookie 属于凭据，只允许当前用户读写
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, COOKIE_STORE)
+        logger.info(f"Saved cookie to store {COOKIE_STORE}")
+    except OSError as e:
+        logger.error(f"Failed to write cookie store {COOKIE_STORE}: {e}")
+
+# 共享存储的最后修改时间，未变化时不重复读取
+_cookie_store_state = {"mtime": None}
+
+def load_cookie_store() -> Optional[str]:
+    """从共享存储读取 cookie；文件未变化时只做一次 stat"""
+    try:
+        mtime = os.stat(COOKIE_STORE).st_mtime_ns
+    except (OSError, TypeError):
+        return global_data["cookie"]
+    if mtime == _cookie_store_state["mtime"]:
+        return global_data["cookie"]
+    try:
+        with open(COOKIE_STORE) as f:
+            payload = json.load(f)
+        fingerprint = fingerprint_from_dict(payload["fingerprint"])
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Failed to read cookie store {COOKIE_STORE}: {e}")
+        return global_data["cookie"]
+    _cookie_store_state["mtime"] = mtime
+    global_data["cookie"] = payload["cookie"]
+    global_data["cookies"] = payload.get("cookies")
+    global_data["fingerprint"] = fingerprint
+    global_data["last_update"] = payload.get("updated_at", time.time())
+    global_data["cookie_expires"] = payload.get("expires", 0)
+    logger.info(f"Loaded cookie from store {COOKIE_STORE}")
+    return global_data["cookie"]
 
 # 添加刷新 cookie 的函数
 async def refresh_cookie():
     """刷新 cookie 的函数，用于401错误触发"""
     logger.info("Refreshing cookie due to 401 error")
+    cookie_stats["refreshes"] += 1
+    
+    if RUN_MODE == "api":
+        # API-only 模式无法自行采集，只有共享存储中出现新 cookie 时才重试
+        previous = global_data["cookie"]
+        new_cookie = load_cookie_store()
+        return new_cookie if new_cookie != previous else None
     
     # 如果已经在刷新中，等待一段时间
     if global_data["is_refreshing"]:
@@ -450,15 +2046,14 @@ async def background_refresh_cookie():
             # 更新 cookie 和过期时间
             global_data["cookie"] = new_cookie
             global_data["last_update"] = time.time()
-            # 查找 session_token cookie 的过期时间
-            session_cookie = next((cookie for cookie in global_data["cookies"] if cookie['name'] == 'session_token'), None)
-            if session_cookie and 'expires' in session_cookie and session_cookie['expires'] > 0:
-                global_data["cookie_expires"] = session_cookie['expires']
-                logger.info(f"Session token expires at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(session_cookie['expires']))}")
+            # get_cookie 已按采集结果或续期响应的 Set-Cookie 写入 session_token 的真实过期时间
+            expires = global_data["cookie_expires"]
+            if expires and expires > 0:
+                logger.info(f"Session token expires at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expires))}")
             else:
                 # 如果没有明确的过期时间，默认设置为30分钟后过期
                 global_data["cookie_expires"] = time.time() + 1800
-                logger.info("No explicit expiration in session_token cookie, setting default 30 minute expiration")
+                logger.info("No explicit expiration for session_token, setting default 30 minute expiration")
         else:
             logger.error("Background cookie refresh failed")
     except Exception as e:
@@ -466,186 +2061,628 @@ async def background_refresh_cookie():
     finally:
         global_data["is_refreshing"] = False
 
-async def check_and_update_cookie():
-    """检查并更新 cookie"""
-    try:
-        current_time = time.time()
-        # 只在 cookie 不存在或已过期时刷新
-        if not global_data["cookie"] or current_time >= global_data["cookie_expires"]:
-            logger.info("Cookie expired or not available, starting refresh")
-            try:
-                # 使用线程池执行同步的 get_cookie 函数
-                loop = asyncio.get_event_loop()
-                with ThreadPoolExecutor() as executor:
-                    new_cookie = await loop.run_in_executor(executor, get_cookie)
-                
-                if new_cookie:
-                    logger.info("Cookie refresh successful")
-                else:
-                    logger.error("Cookie refresh failed")
-            except Exception as e:
-                logger.error(f"Error during cookie refresh: {e}")
-                import traceback
-                logger.error(f"Traceback: {traceback.format_exc()}")
-        else:
-            logger.info("Using existing cookie")
-            
-    except Exception as e:
-        logger.error(f"Error in check_and_update_cookie: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+async def check_and_update_cookie():
+    """检查并更新 cookie"""
+    if RUN_MODE == "api" and not AKASH_COOKIE:
+        # API-only 模式只跟随共享存储中的 cookie
+        load_cookie_store()
+        return
+    try:
+        current_time = time.time()
+        # 只在 cookie 不存在或已过期时刷新
+        if not global_data["cookie"] or current_time >= global_data["cookie_expires"]:
+            logger.info("Cookie expired or not available, starting refresh")
+            try:
+                # 使用线程池执行同步的 get_cookie 函数
+                loop = asyncio.get_event_loop()
+                with ThreadPoolExecutor() as executor:
+                    new_cookie = await loop.run_in_executor(executor, get_cookie)
+                
+                if new_cookie:
+                    logger.info("Cookie refresh successful")
+                else:
+                    logger.error("Cookie refresh failed")
+            except Exception as e:
+                logger.error(f"Error during cookie refresh: {e}")
+                import traceback
+                logger.error(f"Traceback: {traceback.format_exc()}")
+        else:
+            logger.info("Using existing cookie")
+            
+    except Exception as e:
+        logger.error(f"Error in check_and_update_cookie: {e}")
+        import traceback
+        logger.error(f"Traceback: {traceback.format_exc()}")
+
+# 鉴权失败的负缓存：最近被拒绝的 token 直接拒绝，不再计算摘要
+AUTH_NEGATIVE_CACHE_SIZE = int(os.getenv("AUTH_NEGATIVE_CACHE_SIZE", "1024"))
+AUTH_NEGATIVE_CACHE_TTL = float(os.getenv("AUTH_NEGATIVE_CACHE_TTL", "300"))
+# 鉴权失败日志的最小间隔（秒），期间的失败只计数，在下一条日志中汇总
+AUTH_FAILURE_LOG_INTERVAL = float(os.getenv("AUTH_FAILURE_LOG_INTERVAL", "10"))
+
+auth_stats = {"failures": 0, "negative_cache_hits": 0, "logs_suppressed": 0}
+_rejected_tokens = OrderedDict()
+_auth_log_state = {"last": 0.0, "suppressed": 0}
+
+def clean_bearer_token(credentials: HTTPAuthorizationCredentials) -> str:
+    # 去掉 Bearer 前缀后再比较
+    token = credentials.credentials
+    return token.replace("Bearer ", "") if token.startswith("Bearer ") else token
+
+def recently_rejected(token: str) -> bool:
+    expires_at = _rejected_tokens.get(token)
+    if expires_at is None:
+        return False
+    if expires_at <= time.monotonic():
+        del _rejected_tokens[token]
+        return False
+    return True
+
+def remember_rejected(token: str):
+    if AUTH_NEGATIVE_CACHE_SIZE <= 0:
+        return
+    _rejected_tokens[token] = time.monotonic() + AUTH_NEGATIVE_CACHE_TTL
+    _rejected_tokens.move_to_end(token)
+    while len(_rejected_tokens) > AUTH_NEGATIVE_CACHE_SIZE:
+        _rejected_tokens.popitem(last=False)
+
+def reject_api_key(request: Request):
+    """记录鉴权失败并返回 401；日志按 AUTH_FAILURE_LOG_INTERVAL 限频，且从不记录 token 本身"""
+    auth_stats["failures"] += 1
+    now = time.monotonic()
+    if now - _auth_log_state["last"] >= AUTH_FAILURE_LOG_INTERVAL:
+        suppressed = _auth_log_state["suppressed"]
+        client = request.client.host if request.client else "unknown"
+        logger.warning(f"Invalid API key from {client}"
+                       + (f" ({suppressed} more failures since last report)" if suppressed else ""))
+        _auth_log_state["last"] = now
+        _auth_log_state["suppressed"] = 0
+    else:
+        _auth_log_state["suppressed"] += 1
+        auth_stats["logs_suppressed"] += 1
+    raise APIError(401, "Invalid API key", "invalid_api_key")
+
+async def get_api_key(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+    """校验调用方的 key，返回 key 名称用于用量统计；未配置任何 key 时不做验证"""
+    if not API_KEY_HASHES:
+        return "anonymous"
+    clean_token = clean_bearer_token(credentials)
+    if recently_rejected(clean_token):
+        auth_stats["negative_cache_hits"] += 1
+        reject_api_key(request)
+    name = API_KEY_HASHES.get(hash_api_key(clean_token))
+    if name is None:
+        remember_rejected(clean_token)
+        reject_api_key(request)
+    logger.debug(f"API key validation passed for {name}")
+    return name
+
+async def get_optional_api_key(
+    request: Request,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+) -> str:
+    """与 get_api_key 相同，但未配置任何 key 时不要求 Authorization 头"""
+    if not API_KEY_HASHES:
+        return "anonymous"
+    # 配置了 key 却没带凭据时，按 HTTPBearer 的方式拒绝，与其他接口一致
+    return await get_api_key(request, credentials or await security(request))
+
+async def get_admin_key(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+    """管理接口的鉴权：只接受 ADMIN_API_KEY；未设置时关闭管理接口，避免任意调用方把实例排空"""
+    if ADMIN_API_KEY_HASH is None:
+        raise APIError(403, "Admin API is disabled, set ADMIN_API_KEY to enable it", "admin_api_disabled")
+    if not hmac.compare_digest(hash_api_key(clean_bearer_token(credentials)), ADMIN_API_KEY_HASH):
+        raise APIError(403, "Admin API key required", "admin_key_required")
+    return "admin"
+
+# 用量统计落盘路径，未设置时只保存在内存中
+USAGE_FILE = os.getenv("USAGE_FILE", None)
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "60"))
+USAGE_FIELDS = ("requests", "errors", "cache_hits", "prompt_tokens", "completion_tokens")
+
+class UsageMeter:
+    """按 (key 名称, 模型) 聚合的用量计数器
+
+    每组计数只是一个定长整数列表，可在线程池中安全更新；有变化时才写文件，
+    启动时从 USAGE_FILE 读回之前的累计值。
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._dirty = False
+        self.since = time.time()
+        self.flushed_at = None
+        if path and os.path.exists(path):
+            self.load()
+
+    def record(self, name: str, model: str, **values: int):
+        with self._lock:
+            counters = self._counters.setdefault((name, model), [0] * len(USAGE_FIELDS))
+            for index, field in enumerate(USAGE_FIELDS):
+                counters[index] += values.get(field, 0)
+            self._dirty = True
+
+    def snapshot(self) -> dict:
+        """返回 {key 名称: {"total": {...}, "models": {模型: {...}}}}"""
+        with self._lock:
+            items = [(name, model, list(counters)) for (name, model), counters in self._counters.items()]
+        keys = {}
+        for name, model, counters in items:
+            entry = keys.setdefault(name, {"total": dict.fromkeys(USAGE_FIELDS, 0), "models": {}})
+            entry["models"][model] = dict(zip(USAGE_FIELDS, counters))
+            for field, value in zip(USAGE_FIELDS, counters):
+                entry["total"][field] += value
+        return keys
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load usage file {self.path}: {e}")
+            return
+        self.since = saved.get("since", self.since)
+        for name, entry in saved.get("keys", {}).items():
+            for model, counters in entry.get("models", {}).items():
+                self._counters[(name, model)] = [int(counters.get(field, 0)) for field in USAGE_FIELDS]
+
+    def flush(self):
+        """有变化时把累计值原子地写入 USAGE_FILE"""
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            self._dirty = False
+        payload = {"since": self.since, "updated_at": time.time(), "keys": self.snapshot()}
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(payload, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            self.flushed_at = payload["updated_at"]
+        except OSError as e:
+            self._dirty = True
+            logger.error(f"Failed to write usage file {self.path}: {e}")
+
+usage_meter = UsageMeter(USAGE_FILE)
+
+# 按 key 的限流：每分钟请求数（令牌桶，0 表示不限）与并发流数量
+KEY_RATE_LIMIT = int(os.getenv("KEY_RATE_LIMIT", "0"))
+KEY_RATE_LIMITS = parse_model_limits(os.getenv("KEY_RATE_LIMITS"))
+# 令牌桶容量，即允许的突发请求数，默认等于每分钟请求数
+KEY_RATE_BURST = int(os.getenv("KEY_RATE_BURST", "0"))
+KEY_MAX_CONCURRENT = int(os.getenv("KEY_MAX_CONCURRENT", "0"))
+KEY_CONCURRENCY_LIMITS = parse_model_limits(os.getenv("KEY_CONCURRENCY_LIMITS"))
+
+class TokenBucket:
+    """令牌桶：按经过的时间惰性补充令牌，每次检查都是 O(1)"""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: int, per_minute: int):
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """取一个令牌，成功返回 0，否则返回需要等待的秒数"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def reset_after(self) -> float:
+        """令牌桶恢复满额还需的秒数"""
+        return (self.capacity - self.tokens) / self.rate
+
+class KeyStreamSlot:
+    """按 key 占用的一个并发流名额，release 可重复调用，且可在任意线程中调用"""
+
+    def __init__(self, limiter, name: str):
+        self.limiter = limiter
+        self.name = name
+        self.released = False
+
+    def release(self):
+        self.limiter.release_stream(self)
+
+class KeyRateLimiter:
+    """按 API key 名称的请求速率与并发流限制
+
+    每个 key 只保存一个令牌桶和一个并发计数，检查与更新都是 O(1)；
+    超限时直接返回 429，不进入上游排队。
+    """
+
+    def __init__(self, rate_limit: int, rate_limits: dict, burst: int, max_concurrent: int, concurrency_limits: dict):
+        self.rate_limit = rate_limit
+        self.rate_limits = rate_limits
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.concurrency_limits = concurrency_limits
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._active = {}
+        self.stats = {"rejected_rate": 0, "rejected_concurrency": 0}
+
+    def _reject(self, name: str, detail: str, retry_after: float, headers: dict):
+        logger.warning(f"Rate limit exceeded for key {name}: {detail}")
+        raise APIError(
+            429,
+            detail,
+            "rate_limit_exceeded",
+            headers={**headers, "Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+    def check_rate(self, name: str) -> dict:
+        """消耗一个请求令牌，返回剩余额度响应头；超限时抛出 429"""
+        limit = self.rate_limits.get(name, self.rate_limit)
+        if limit <= 0:
+            return {}
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                bucket = self._buckets[name] = TokenBucket(self.burst or limit, limit)
+            wait = bucket.take()
+            headers = {
+                "X-RateLimit-Limit-Requests": str(limit),
+                "X-RateLimit-Remaining-Requests": str(int(bucket.tokens)),
+                "X-RateLimit-Reset-Requests": f"{math.ceil(bucket.reset_after())}s"
+            }
+        if wait:
+            self.stats["rejected_rate"] += 1
+            self._reject(name, f"Rate limit of {limit} requests per minute exceeded", wait, headers)
+        return headers
+
+    def acquire_stream(self, name: str, retry_after: int) -> Optional[KeyStreamSlot]:
+        """占用一个并发流名额；未设置上限时返回 None，已满时抛出 429"""
+        limit = self.concurrency_limits.get(name, self.max_concurrent)
+        if limit <= 0:
+            return None
+        with self._lock:
+            active = self._active.get(name, 0)
+            if active < limit:
+                self._active[name] = active + 1
+                return KeyStreamSlot(self, name)
+        self.stats["rejected_concurrency"] += 1
+        self._reject(name, f"Concurrent stream limit of {limit} reached", retry_after,
+                     {"X-RateLimit-Limit-Concurrency": str(limit), "X-RateLimit-Remaining-Concurrency": "0"})
+
+    def release_stream(self, slot: KeyStreamSlot):
+        with self._lock:
+            if slot.released:
+                return
+            slot.released = True
+            self._active[slot.name] -= 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                **self.stats,
+                "active_streams": {name: count for name, count in self._active.items() if count},
+                "remaining_requests": {name: int(bucket.tokens) for name, bucket in self._buckets.items()}
+            }
+
+key_limiter = KeyRateLimiter(KEY_RATE_LIMIT, KEY_RATE_LIMITS, KEY_RATE_BURST, KEY_MAX_CONCURRENT, KEY_CONCURRENCY_LIMITS)
+
+async def check_rate_limit(request: Request, api_key: str = Depends(get_api_key)) -> str:
+    """在 get_api_key 之上执行按 key 的速率限制，剩余额度由 RateLimitHeadersMiddleware 写入响应头"""
+    request.state.rate_limit_headers = key_limiter.check_rate(api_key)
+    return api_key
+
+class RateLimitHeadersMiddleware:
+    """把 request.state.rate_limit_headers 加到响应头中（纯 ASGI 实现，不缓冲流式响应）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                extra = scope.get("state", {}).get("rate_limit_headers")
+                if extra:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in extra.items()
+                    ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+app.add_middleware(RateLimitHeadersMiddleware)
 
-async def get_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
-    # logger.info(f"Received token: {token}")
+# 优雅停机：等待进行中的请求与后台图片任务结束的最长时间（秒）
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "30"))
+# 排空期间拒绝新请求时返回的 Retry-After（秒）
+DRAIN_RETRY_AFTER = int(os.getenv("DRAIN_RETRY_AFTER", "5"))
+
+# 通知 cookie 采集与刷新线程退出
+shutdown_event = threading.Event()
+
+drain_stats = {
+    "draining": False,
+    "reason": None,
+    "started_at": None,
+    "in_flight_at_start": 0,
+    "image_jobs_at_start": 0,
+    "rejected": 0,
+    "drained": None,
+    "cancelled_image_jobs": 0,
+    "killed_harvesters": 0,
+    "closed_sessions": 0,
+    "duration": None
+}
+
+def start_drain(reason: str):
+    """进入排空模式：之后的 /v1 请求直接返回 503，已在进行的请求继续完成"""
+    if drain_stats["draining"]:
+        return
+    drain_stats.update(
+        draining=True,
+        reason=reason,
+        started_at=time.time(),
+        in_flight_at_start=upstream_limiter.snapshot()["active"],
+        image_jobs_at_start=len(image_job_tasks)
+    )
+    logger.info(f"Draining ({reason}): {drain_stats['in_flight_at_start']} requests in flight, "
+                f"{drain_stats['image_jobs_at_start']} image jobs running")
+
+def drain_snapshot() -> dict:
+    return {**drain_stats, "in_flight": upstream_limiter.snapshot()["active"], "image_jobs": len(image_job_tasks)}
+
+async def wait_for_drain(timeout: float) -> bool:
+    """等待进行中的上游请求与后台图片任务全部结束，超时返回 False"""
+    deadline = time.monotonic() + timeout
+    while upstream_limiter.snapshot()["active"] or image_job_tasks:
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.2)
+    return True
+
+def kill_harvesters() -> int:
+    """结束仍在运行的 harvester 子进程组（连同其中的浏览器）"""
+    processes = list(_harvest_processes)
+    for process in processes:
+        _kill_process_group(process)
+    return len(processes)
+
+def close_upstream_sessions() -> int:
+    sessions = list(_open_sessions)
+    for session in sessions:
+        try:
+            session.close()
+        except Exception as e:
+            logger.warning(f"Error closing upstream session: {e}")
+    return len(sessions)
+
+async def drain_and_shutdown():
+    """停机流程：排空请求与图片任务，超时后取消剩余任务，再停止后台线程、浏览器与连接池"""
+    start = time.monotonic()
+    start_drain("shutdown")
+    shutdown_event.set()
+    drain_stats["drained"] = await wait_for_drain(DRAIN_TIMEOUT)
     
-    # 如果设置了 OPENAI_API_KEY，则需要验证
-    if OPENAI_API_KEY is not None:
-        # 去掉 Bearer 前缀后再比较
-        clean_token = token.replace("Bearer ", "") if token.startswith("Bearer ") else token
-        # logger.info(f"Clean token: {clean_token}")
-        if clean_token != OPENAI_API_KEY:
-            logger.error(f"Token mismatch. Expected: {OPENAI_API_KEY}, Got: {clean_token}")
-            raise HTTPException(
-                status_code=401,
-                detail="Invalid API key"
-            )
-        logger.info("API key validation passed")
+    tasks = list(image_job_tasks.values())
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    drain_stats["cancelled_image_jobs"] = len(tasks)
+    drain_stats["killed_harvesters"] = kill_harvesters()
+    drain_stats["closed_sessions"] = close_upstream_sessions()
+    upstream_executor.shutdown(wait=False, cancel_futures=True)
+    drain_stats["duration"] = round(time.monotonic() - start, 2)
     
-    return True
+    log = logger.info if drain_stats["drained"] else logger.warning
+    log(f"Drain finished: {json.dumps(drain_snapshot())}")
+
+class DrainMiddleware:
+    """排空期间对 /v1 下的新请求返回 503 并关闭连接，让负载均衡转发到其他实例"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not drain_stats["draining"] or not scope["path"].startswith("/v1/"):
+            await self.app(scope, receive, send)
+            return
+        drain_stats["rejected"] += 1
+        response = JSONResponse(
+            status_code=503,
+            content=error_body(503, "Server is shutting down, retry on another instance", "server_draining"),
+            headers={"Retry-After": str(DRAIN_RETRY_AFTER), "Connection": "close"}
+        )
+        await response(scope, receive, send)
+
+app.add_middleware(DrainMiddleware)
+
+async def flush_usage_periodically():
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        await run_blocking(usage_meter.flush)
 
 async def validate_cookie(background_tasks: BackgroundTasks):
     # 检查并更新 cookie（如果需要）
     await check_and_update_cookie()
     
-    # 等待 cookie 初始化完成
+    # 等待 cookie 初始化完成；采集熔断打开时不必空等
     max_wait = 30  # 最大等待时间（秒）
     start_time = time.time()
+    harvest_breaker = circuit_breakers["harvest"]
     while not global_data["cookie"] and time.time() - start_time < max_wait:
+        if harvest_breaker.rejecting():
+            raise upstream_unavailable(harvest_breaker)
         await asyncio.sleep(1)
         logger.info("Waiting for cookie initialization...")
     
     # 检查是否有有效的 cookie
     if not global_data["cookie"]:
         logger.error("Cookie not available after waiting")
-        raise HTTPException(
-            status_code=503,
-            detail="Service temporarily unavailable - Cookie not available"
-        )
+        raise APIError(503, "Service temporarily unavailable - Cookie not available", "cookie_unavailable",
+                       headers={"Retry-After": str(UPSTREAM_ERROR_RETRY_AFTER)})
     
     logger.info("Cookie validation passed")
     return global_data["cookie"]
 
-async def check_image_status(session: requests.Session, full_job_id: str, short_job_id: str, headers: dict) -> Optional[str]:
-    """检查图片生成状态并获取生成的图片"""
+# 标记当前线程正在驱动上游线程池内的嵌套事件循环（流式 AkashGen 轮询）
+_nested_loop = threading.local()
+
+async def run_blocking(func, *args, **kwargs):
+    """在上游线程池中执行阻塞调用，避免阻塞事件循环
+
+    在上游线程池的嵌套事件循环中直接调用：再向同一线程池提交任务，
+    线程池被流占满时工作线程会互相等待排队中的任务而卡死。
+    """
+    if getattr(_nested_loop, "active", False):
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(upstream_executor, functools.partial(func, *args, **kwargs))
+
+async def poll_image_job(session: requests.Session, base_url: str, full_job_id: str, headers: Mapping[str, str],
+                         on_status: Optional[Callable[[str], None]] = None) -> Optional[str]:
+    """在接受任务的上游 base_url 上轮询图片任务状态，完成时返回上游给出的 result，失败或超时返回 None
+
+    on_status 不为空时，每当上游返回的任务状态发生变化就以新状态调用一次。
+    """
     max_retries = 30
+    consecutive_404s = 0
+    last_status = None
+    breaker = circuit_breakers["image_status"]
     for attempt in range(max_retries):
         try:
-            print(f"\nAttempt {attempt + 1}/{max_retries} for job {full_job_id}")
-            response = session.get(
-                f'https://chat.akash.network/api/image-status?ids={full_job_id}',
-                headers=headers
-            )
-            print(f"Status response code: {response.status_code}")
+            if not breaker.allow():
+                logger.warning(f"Image status circuit open, abandoning job {full_job_id}")
+                return None
+            logger.info(f"Attempt {attempt + 1}/{max_retries} for job {full_job_id}")
+            try:
+                response = await run_blocking(
+                    session.get,
+                    f'{base_url}/api/image-status?ids={full_job_id}',
+                    headers=headers,
+                    timeout=settings.timeouts("AkashGen").request
+                )
+            except RETRYABLE_EXCEPTIONS as e:
+                breaker.record_failure()
+                record_timeout(e)
+                raise
+            if is_upstream_failure(response.status_code):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
             
             # 如果是404，说明任务已经不存在，可能已经完成并被清理
             if response.status_code == 404:
-                print(f"Job {full_job_id} not found (404), task may have been completed and cleaned up")
+                consecutive_404s += 1
+                logger.info(f"Job {full_job_id} not found (404), task may have been completed and cleaned up")
                 # 连续3次404就停止重试
-                if hasattr(check_image_status, '_consecutive_404s'):
-                    check_image_status._consecutive_404s += 1
-                else:
-                    check_image_status._consecutive_404s = 1
-                
-                if check_image_status._consecutive_404s >= 3:
-                    print(f"Stopping after {check_image_status._consecutive_404s} consecutive 404s")
+                if consecutive_404s >= 3:
+                    logger.warning(f"Stopping after {consecutive_404s} consecutive 404s")
                     return None
-                
                 await asyncio.sleep(1)
                 continue
-            else:
-                # 重置404计数器
-                check_image_status._consecutive_404s = 0
+            consecutive_404s = 0
                 
             status_data = response.json()
             
             if status_data and isinstance(status_data, list) and len(status_data) > 0:
                 job_info = status_data[0]
                 status = job_info.get('status')
-                print(f"Job status: {status}")
+                logger.info(f"Job {full_job_id} status: {status}")
+                if on_status and status != last_status:
+                    on_status(status)
+                last_status = status
                 
                 # 检查状态为 completed 或 succeeded 时处理结果
                 if status in ["completed", "succeeded"]:
                     result = job_info.get("result")
-                    print(f"API returned result: {result}")
-                    print(f"Full job_info: {job_info}")
-                    
                     if result and not result.startswith("Failed"):
-                        print("Got valid result...")
-                        
-                        # 如果result是相对路径，下载并上传到图床（因为直接访问需要认证）
-                        if result.startswith("/api/image/"):
-                            image_url = f"https://chat.akash.network{result}"
-                            print(f"Downloading image from: {image_url}")
-                            
-                            try:
-                                # 使用当前session和headers下载图片（包含认证信息）
-                                image_response = session.get(image_url, headers=headers)
-                                print(f"Download response status: {image_response.status_code}")
-                                
-                                if image_response.status_code == 200:
-                                    print("Successfully downloaded image, uploading to image host...")
-                                    print(f"Image content length: {len(image_response.content)} bytes")
-                                    
-                                    # 上传到新野图床
-                                    upload_url = await upload_to_xinyew(image_response.content, full_job_id)
-                                    if upload_url:
-                                        print(f"Successfully uploaded image: {upload_url}")
-                                        return upload_url
-                                    print("Image upload failed")
-                                    return None
-                                else:
-                                    print(f"Failed to download image, status: {image_response.status_code}")
-                                    print(f"Response content: {image_response.text[:200]}...")
-                                    return None
-                            except Exception as e:
-                                print(f"Error downloading image: {e}")
-                                import traceback
-                                print(traceback.format_exc())
-                                return None
-                        # 如果result不是完整路径，可能需要构建图片URL
-                        elif result and not result.startswith("http"):
-                            # 从result构建图片URL，格式: /api/image/job_{short_id}_00001_.webp
-                            if not result.startswith("/"):
-                                image_url = f"https://chat.akash.network/api/image/job_{short_job_id}_00001_.webp"
-                                print(f"Constructed Akash image URL: {image_url}")
-                                return image_url
-                        else:
-                            # 如果result是base64数据，上传到图床
-                            print("Got base64 result, uploading to image host...")
-                            upload_url = await upload_to_mjj(result, job_id)
-                            if upload_url:
-                                print(f"Successfully uploaded image: {upload_url}")
-                                return upload_url
-                            print("Image upload failed")
-                            return None
-                    print("Invalid result received")
+                        return result
+                    logger.error(f"Invalid result received for job {full_job_id}: {str(result)[:100]}")
                     return None
                 elif status == "failed":
-                    print(f"Job {full_job_id} failed")
+                    logger.error(f"Job {full_job_id} failed")
                     return None
-                
-                # 如果状态是其他（如 pending），继续等待
-                await asyncio.sleep(1)
-                continue
+            
+            # 如果状态是其他（如 pending），继续等待
+            await asyncio.sleep(1)
                     
         except Exception as e:
-            print(f"Error checking status: {e}")
+            logger.error(f"Error checking status: {e}")
             return None
     
-    print(f"Timeout waiting for job {full_job_id}")
+    logger.error(f"Timeout waiting for job {full_job_id}")
+    return None
+
+def image_result_url(base_url: str, result: str, short_job_id: str) -> str:
+    """把任务结果转换为接受该任务的上游 base_url 上的图片地址"""
+    if result.startswith("/"):
+        return f"{base_url}{result}"
+    # 从result构建图片URL，格式: /api/image/job_{short_id}_00001_.webp
+    return f"{base_url}/api/image/job_{short_job_id}_00001_.webp"
+
+async def fetch_image_bytes(session: requests.Session, base_url: str, result: str, short_job_id: str,
+                            headers: Mapping[str, str]) -> Optional[bytes]:
+    """获取任务结果对应的图片字节：data URL 直接解码，其余地址下载（Akash 地址需带认证信息）"""
+    if result.startswith("data:"):
+        return base64.b64decode(result.split(",", 1)[1])
+    url = result if result.startswith("http") else image_result_url(base_url, result, short_job_id)
+    try:
+        logger.info(f"Downloading image from: {url}")
+        image_response = await run_blocking(session.get, url, headers=headers,
+                                            timeout=settings.timeouts("AkashGen").request)
+    except Exception as e:
+        record_timeout(e)
+        logger.error(f"Error downloading image: {e}")
+        return None
+    if image_response.status_code != 200:
+        logger.error(f"Failed to download image, status: {image_response.status_code}, response: {image_response.text[:200]}")
+        return None
+    logger.info(f"Downloaded image, {len(image_response.content)} bytes")
+    return image_response.content
+
+async def resolve_image_url(session: requests.Session, base_url: str, result: str, full_job_id: str,
+                            short_job_id: str, headers: Mapping[str, str]) -> Optional[str]:
+    """把任务结果转换为客户端可直接访问的图片 URL"""
+    if result.startswith("http"):
+        return result
+    # 如果result是相对路径或base64数据，下载并上传到图床（因为直接访问需要认证）
+    if result.startswith("/api/image/") or result.startswith("data:"):
+        image_data = await fetch_image_bytes(session, base_url, result, short_job_id, headers)
+        if not image_data:
+            return None
+        upload_url = await upload_to_xinyew(image_data, full_job_id)
+        if upload_url:
+            logger.info(f"Successfully uploaded image: {upload_url}")
+            return upload_url
+        logger.error("Image upload failed")
+        return None
+    # 如果result不是完整路径，可能需要构建图片URL
+    if not result.startswith("/"):
+        image_url = image_result_url(base_url, result, short_job_id)
+        logger.info(f"Constructed Akash image URL: {image_url}")
+        return image_url
+    logger.error(f"Unrecognized image result: {result[:100]}")
     return None
 
+async def check_image_status(session: requests.Session, base_url: str, full_job_id: str, short_job_id: str,
+                             headers: Mapping[str, str],
+                             on_status: Optional[Callable[[str], None]] = None) -> Optional[str]:
+    """检查图片生成状态并获取生成的图片，状态变化通过 on_status 回调报告"""
+    result = await poll_image_job(session, base_url, full_job_id, headers, on_status)
+    if not result:
+        return None
+    return await resolve_image_url(session, base_url, result, full_job_id, short_job_id, headers)
+
 @app.get("/", response_class=HTMLResponse)
 async def health_check():
     """健康检查端点，返回服务状态"""
@@ -1023,198 +3060,365 @@ async def health_check():
     </html>
     """)
 
+@app.get("/metrics")
+async def get_metrics(api_key: str = Depends(get_api_key)):
+    """运行指标：上游并发、排队、重试、熔断与流式响应情况"""
+    return {
+        "limiter": upstream_limiter.snapshot(),
+        "retry": dict(retry_stats),
+        "timeouts": dict(timeout_stats),
+        "upstreams": upstream_pool.snapshot(),
+        "circuits": {name: breaker.snapshot() for name, breaker in circuit_breakers.items()},
+        "streams": {**stream_stats, "failed_by_code": dict(stream_failures)},
+        "cookie": {**cookie_stats, "fingerprint": current_fingerprint().user_agent},
+        "harvester": dict(harvest_stats),
+        "completion_cache": completion_cache.snapshot(),
+        "context": dict(context_stats),
+        "key_limits": key_limiter.snapshot(),
+        "auth": {**auth_stats, "negative_cache_size": len(_rejected_tokens)},
+        "image_jobs": {**image_job_stats, "active": len(image_job_tasks), "stored": len(image_jobs)},
+        "drain": drain_snapshot(),
+        "errors": {name: dict(counts) for name, counts in error_stats.items()}
+    }
+
+@app.get("/ready")
+async def readiness():
+    """供负载均衡探测：排空期间返回 503"""
+    if drain_stats["draining"]:
+        return JSONResponse(status_code=503, content={"status": "draining"})
+    return {"status": "ready"}
+
+@app.get("/admin/drain")
+async def get_drain(admin: str = Depends(get_admin_key)):
+    return drain_snapshot()
+
+@app.post("/admin/drain")
+async def post_drain(admin: str = Depends(get_admin_key)):
+    """滚动发布前手动进入排空模式，之后通过 GET /admin/drain 查看剩余请求数"""
+    start_drain("admin")
+    return drain_snapshot()
+
+@app.get("/admin/usage")
+async def get_usage(admin: str = Depends(get_admin_key)):
+    """按 API key 汇总的请求数与 token 用量"""
+    return {
+        "since": usage_meter.since,
+        "flushed_at": usage_meter.flushed_at,
+        "keys": usage_meter.snapshot()
+    }
+
 @app.post("/v1/chat/completions")
 async def chat_completions(
     request: Request,
     background_tasks: BackgroundTasks,
-    api_key: bool = Depends(get_api_key),
+    api_key: str = Depends(check_rate_limit),
+    upstream: None = Depends(require_upstream("chat")),
     cookie: str = Depends(validate_cookie)
 ):
+    model = "DeepSeek-R1"
     try:
-        data = await request.json()
+        data = await read_json(request)
         
-        # 获取随机浏览器指纹
-        fingerprint = get_random_browser_fingerprint()
-        logger.info(f"Using browser fingerprint: {fingerprint['user_agent']}")
+        # 使用与 cookie 绑定的浏览器指纹
+        fingerprint = current_fingerprint()
+        logger.debug(f"Using browser fingerprint: {fingerprint.user_agent}")
         
         chat_id = str(uuid.uuid4()).replace('-', '')[:16]
         
         # 确保系统消息正确处理
         system_message = data.get('system_message') or data.get('system', "You are a helpful assistant.")
         
-        # 处理messages格式，确保与官网格式一致
-        processed_messages = []
-        for msg in data.get('messages', []):
-            processed_msg = {
-                "role": msg.get("role"),
-                "content": msg.get("content"),
-                "parts": [{"type": "text", "text": msg.get("content")}]
-            }
-            processed_messages.append(processed_msg)
+        # 处理messages格式，确保与官网格式一致，并裁剪到模型的上下文预算
+        model = data.get('model', "DeepSeek-R1")
+        processed_messages, system_message = prepare_messages(data.get('messages', []), model, system_message)
         
         # 更新请求数据格式，与实际 Akash API 请求保持一致
         akash_data = {
             "id": chat_id,
             "messages": processed_messages,
-            "model": data.get('model', "DeepSeek-R1"),
+            "model": model,
             "system": system_message,
             "temperature": data.get('temperature', 0.85 if data.get('model') == 'AkashGen' else 0.6),
             "topP": data.get('top_p', 1.0 if data.get('model') == 'AkashGen' else 0.95),
             "context": []  # 添加 context 字段
         }
         
+        # 确定性请求先查缓存，命中时不占用上游并发槽位
+        cache_key = None
+        if (COMPLETION_CACHE_ENABLED and akash_data["temperature"] == 0 and akash_data["model"] != "AkashGen"
+                and "no-cache" not in request.headers.get("cache-control", "")):
+            cache_key = completion_cache_key(akash_data)
+            entry = completion_cache.get(cache_key)
+            if entry:
+                logger.info(f"Completion cache hit for {akash_data['model']}")
+                usage = build_usage(estimate_prompt_tokens(akash_data),
+                                    estimate_tokens(entry.reasoning_content + entry.content, model))
+                usage_meter.record(api_key, model, requests=1, cache_hits=1, prompt_tokens=usage["prompt_tokens"],
+                                   completion_tokens=usage["completion_tokens"])
+                if data.get("stream") is False:
+                    return JSONResponse(build_completion(chat_id, entry.model, entry.content, entry.finish_reason,
+                                                         entry.reasoning_content or None, usage=usage),
+                                        headers={"X-Cache": "HIT"})
+                return StreamingResponse(
+                    replay_cached_stream(chat_id, entry, usage if include_usage(data) else None),
+                    media_type='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Cache': 'HIT'}
+                )
+        
         # 记录当前使用的 cookie（部分隐藏）
         cookie_start = cookie[:20]
         cookie_end = cookie[-20:] if len(cookie) > 40 else ""
         logger.info(f"Using cookie: {cookie_start}...{cookie_end}")
         
-        with requests.Session() as session:
-            # 设置 Cookie 使用请求头方式
-            session.headers.update(fingerprint["headers"])
-            cookies_dict = {}
-            
-            # 解析 cookie 字符串到字典
-            for cookie_item in cookie.split(';'):
-                if '=' in cookie_item:
-                    name, value = cookie_item.strip().split('=', 1)
-                    cookies_dict[name] = value
-            
+        # 按 key 的并发流限制先于全局排队检查，避免单个 key 占满等待队列
+        key_slot = key_limiter.acquire_stream(api_key, upstream_limiter.retry_after())
+        
+        # 准入控制：获取上游并发槽位，队列已满时直接返回 429
+        try:
+            slot = await upstream_limiter.acquire(akash_data["model"])
+        except BaseException:
+            if key_slot:
+                key_slot.release()
+            raise
+        if key_slot:
+            slot.companions.append(key_slot)
+        
+        try:
+            return await forward_chat_request(request, data, akash_data, chat_id, cookie, fingerprint, slot, cache_key,
+                                              api_key)
+        except BaseException:
+            slot.release()
+            raise
+    
+    except HTTPException:
+        usage_meter.record(api_key, model, requests=1, errors=1)
+        raise
+    except Exception as e:
+        usage_meter.record(api_key, model, requests=1, errors=1)
+        # 上游网络错误已在重试中记录过，只有未预期的异常才打印堆栈
+        logger.error(f"Error in chat_completions: {e!r}", exc_info=not isinstance(e, RETRYABLE_EXCEPTIONS))
+        raise unexpected_error(e) from e
+
+def include_usage(data: dict) -> bool:
+    """stream_options.include_usage 为真或非流式请求时在响应中返回 usage"""
+    return bool((data.get("stream_options") or {}).get("include_usage")) or data.get("stream") is False
+
+async def forward_chat_request(request: Request, data: dict, akash_data: dict, chat_id: str, cookie: str, fingerprint: BrowserFingerprint, slot: LimiterSlot,
+                               cache_key: Optional[str] = None, api_key: str = "anonymous"):
+    """向 Akash 发送聊天请求并返回流式响应，槽位在流结束或客户端断开时释放
+
+    cache_key 不为空时，完整结束的响应会写入响应缓存；stream=false 时聚合为单个响应返回。
+    流结束（或客户端断开）时按 api_key 记录用量，上游未返回 usage 时使用估算值。
+    上游超时按模型取自 settings.timeouts，整体超时从这里开始计时（包含重试）。
+    """
+    started = time.monotonic()
+    timeouts = settings.timeouts(akash_data["model"])
+    # 会话由 stream_to_client 在流结束时关闭：AkashGen 在流中还要用它轮询图片任务
+    session = new_upstream_session(fingerprint)
+    try:
+        
+        # 请求体只序列化一次，重试与对冲直接复用同一份字节
+        body = encode_payload(akash_data)
+        
+        def send_chat(identity, base_url):
+            cookies_dict, headers = identity
             # 使用 cookies 参数而不是 headers['Cookie']
-            response = session.post(
-                'https://chat.akash.network/api/chat',
-                json=akash_data,
+            return session.post(
+                f'{base_url}/api/chat',
+                data=body,
                 cookies=cookies_dict,
-                stream=True
+                headers=headers,
+                stream=True,
+                timeout=transport_timeout(session, timeouts, stream=True)
             )
+        
+        # 目前只有一组 cookie/指纹，对冲请求沿用同一身份以免与 cookie 不匹配
+        cookies_dict = parse_cookie_string(cookie)
+        identities = [(cookies_dict, fingerprint.headers)]
+        if UPSTREAM_HEDGE_AFTER > 0:
+            identities.append(identities[0])
+        
+        response, base_url = await request_upstream(send_chat, identities, UPSTREAM_HEDGE_AFTER, circuit_breakers["chat"])
+        
+        # 检查响应状态码，如果是 401 或 403，尝试刷新 cookie 并重试
+        if response.status_code in [401, 403]:
+            cookie_stats["challenges"] += 1
+            logger.info(f"Authentication failed with status {response.status_code}, refreshing cookie...")
+            new_cookie = await refresh_cookie()
+            if new_cookie:
+                logger.info("Successfully refreshed cookie, retrying request")
+                response.close()
+                # 新 cookie 绑定采集时的指纹，重试需换用新指纹的请求头与会话（TLS 特征）
+                fingerprint = current_fingerprint()
+                session.close()
+                session = new_upstream_session(fingerprint)
+                identities = [(parse_cookie_string(new_cookie), fingerprint.headers)] * len(identities)
+                response, base_url = await request_upstream(send_chat, identities, UPSTREAM_HEDGE_AFTER,
+                                                            circuit_breakers["chat"])
+        
+        if response.status_code not in [200, 201]:
+            logger.error(f"Akash API error: Status {response.status_code}, Response: {response.text[:200]}")
+            error = upstream_status_error(response)
+            response.close()
+            raise error
+        
+        set_idle_timeout(response, timeouts)
+        # 读取线程累加的上游字节数；发出 error 事件时 sse_error_event 还会记下错误码
+        meter = {"bytes": 0}
+        
+        parser = DataStreamParser()
+        counter = TokenCounter(akash_data["model"])
+        prompt_tokens = estimate_prompt_tokens(akash_data)
+        
+        def current_usage() -> dict:
+            # 优先使用上游 d/e 行返回的用量
+            return build_usage(*(parser.usage or (prompt_tokens, counter.total())))
+        
+        def record_usage(iterator):
+            try:
+                yield from iterator
+            finally:
+                usage = current_usage()
+                usage_meter.record(api_key, akash_data["model"], requests=1, prompt_tokens=usage["prompt_tokens"],
+                                   completion_tokens=usage["completion_tokens"])
+        
+        def generate():
+            splitter = ThinkSplitter()
+            content_buffer = []
+            reasoning_buffer = []
+            cacheable = cache_key is not None
+            step_finished = False
             
-            # 检查响应状态码，如果是 401 或 403，尝试刷新 cookie 并重试
-            if response.status_code in [401, 403]:
-                logger.info(f"Authentication failed with status {response.status_code}, refreshing cookie...")
-                new_cookie = await refresh_cookie()
-                if new_cookie:
-                    logger.info("Successfully refreshed cookie, retrying request")
-                    # 解析新 cookie 字符串到字典
-                    new_cookies_dict = {}
-                    for cookie_item in new_cookie.split(';'):
-                        if '=' in cookie_item:
-                            name, value = cookie_item.strip().split('=', 1)
-                            new_cookies_dict[name] = value
-                    
-                    response = session.post(
-                        'https://chat.akash.network/api/chat',
-                        json=akash_data,
-                        cookies=new_cookies_dict,
-                        stream=True
-                    )
-            
-            if response.status_code not in [200, 201]:
-                logger.error(f"Akash API error: Status {response.status_code}, Response: {response.text}")
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Akash API error: {response.text}"
-                )
+            def split_reasoning(deltas):
+                # 按 REASONING_MODE 拆分或丢弃推理内容
+                for delta in deltas:
+                    if "content" in delta and REASONING_MODE != "inline":
+                        parts = splitter.feed(delta["content"])
+                    else:
+                        parts = [delta]
+                    for part in parts:
+                        if "reasoning_content" in part and REASONING_MODE == "drop":
+                            continue
+                        yield part
             
-            def generate():
-                content_buffer = ""
-                for line in response.iter_lines():
-                    if not line:
-                        continue
-                        
+            def emit(deltas):
+                nonlocal cacheable
+                for delta in deltas:
+                    counter.add(delta.get("content") or delta.get("reasoning_content") or "")
+                    for call in delta.get("tool_calls", []):
+                        counter.add(call["function"].get("arguments") or "")
+                    # 只缓存纯文本与推理内容，工具调用不进入缓存
+                    cacheable = cacheable and ("content" in delta or "reasoning_content" in delta)
+                    if cacheable:
+                        (content_buffer if "content" in delta else reasoning_buffer).append(
+                            delta.get("content") or delta.get("reasoning_content"))
+                    yield f"data: {json.dumps(build_chunk(chat_id, data.get('model'), delta))}\n\n"
+            for line in response.iter_lines():
+                meter["bytes"] += len(line) + 1
+                if not line:
+                    continue
+                    
+                try:
+                    msg_type, _, raw = line.partition(b':')
+                    msg_type = msg_type.decode('ascii')
+                    value = json.loads(raw)
+                except ValueError as e:
+                    stream_stats["malformed_lines"] += 1
+                    logger.warning(f"Skipping malformed upstream line: {e}")
+                    continue
+                
+                # 在处理消息时先判断模型类型
+                if msg_type == '0' and data.get('model') == 'AkashGen' and "<image_generation>" in value:
+                    # 图片生成模型的特殊处理：在本线程的事件循环中逐条驱动，进度一产生就发给客户端
+                    messages = process_image_generation(value, session, base_url, fingerprint.headers, chat_id)
+                    loop = asyncio.new_event_loop()
+                    asyncio.set_event_loop(loop)
+                    _nested_loop.active = True
                     try:
-                        line_str = line.decode('utf-8')
-                        msg_type, msg_data = line_str.split(':', 1)
-                        
-                        if msg_type == '0':
-                            if msg_data.startswith('"') and msg_data.endswith('"'):
-                                msg_data = msg_data.replace('\\"', '"')
-                                msg_data = msg_data[1:-1]
-                            msg_data = msg_data.replace("\\n", "\n")
-                            
-                            # 在处理消息时先判断模型类型
-                            if data.get('model') == 'AkashGen' and "<image_generation>" in msg_data:
-                                # 图片生成模型的特殊处理
-                                async def process_and_send():
-                                    messages = await process_image_generation(msg_data, session, fingerprint["headers"], chat_id)
-                                    if messages:
-                                        return messages
-                                    return None
-
-                                # 创建新的事件循环
-                                loop = asyncio.new_event_loop()
-                                asyncio.set_event_loop(loop)
-                                try:
-                                    result_messages = loop.run_until_complete(process_and_send())
-                                finally:
-                                    loop.close()
-                                
-                                if result_messages:
-                                    for message in result_messages:
-                                        yield f"data: {json.dumps(message)}\n\n"
-                                    continue
-                            
-                            content_buffer += msg_data
-                            
-                            chunk = {
-                                "id": f"chatcmpl-{chat_id}",
-                                "object": "chat.completion.chunk",
-                                "created": int(time.time()),
-                                "model": data.get('model'),
-                                "choices": [{
-                                    "delta": {"content": msg_data},
-                                    "index": 0,
-                                    "finish_reason": None
-                                }]
-                            }
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                        
-                        elif msg_type in ['e', 'd']:
-                            chunk = {
-                                "id": f"chatcmpl-{chat_id}",
-                                "object": "chat.completion.chunk",
-                                "created": int(time.time()),
-                                "model": data.get('model'),
-                                "choices": [{
-                                    "delta": {},
-                                    "index": 0,
-                                    "finish_reason": "stop"
-                                }]
-                            }
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                            yield "data: [DONE]\n\n"
-                            break
-                            
-                    except Exception as e:
-                        print(f"Error processing line: {e}")
-                        continue
-
-            return StreamingResponse(
-                generate(),
-                media_type='text/event-stream',
-                headers={
-                    'Cache-Control': 'no-cache',
-                    'Connection': 'keep-alive',
-                    'Content-Type': 'text/event-stream'
-                }
-            )
-    
-    except Exception as e:
-        print(f"Error in chat_completions: {e}")
-        import traceback
-        print(traceback.format_exc())
-        return {"error": str(e)}
+                        while True:
+                            try:
+                                message = loop.run_until_complete(messages.__anext__())
+                            except StopAsyncIteration:
+                                break
+                            # 图片生成过程的 <think> 块同样按 REASONING_MODE 处理
+                            yield from emit(split_reasoning([message["choices"][0]["delta"]]))
+                    finally:
+                        try:
+                            loop.run_until_complete(messages.aclose())
+                        finally:
+                            loop.close()
+                            _nested_loop.active = False
+                    continue
+                
+                try:
+                    deltas = parser.feed(msg_type, value)
+                except (KeyError, TypeError, AttributeError) as e:
+                    stream_stats["malformed_lines"] += 1
+                    logger.warning(f"Skipping malformed upstream {msg_type} line: {e!r}")
+                    continue
+                yield from emit(split_reasoning(deltas))
+                step_finished = step_finished or msg_type == 'e'
+                if parser.finished:
+                    break
+            
+            # 上游报错或未收到 e/d 就断开时不伪造结束标记，改为发送 error 事件
+            if parser.error is not None:
+                yield sse_error_event(APIError(502, f"Akash stream error: {parser.error}", "upstream_error"), meter)
+                return
+            if not (parser.finished or step_finished):
+                logger.warning(f"Upstream stream ended without a finish event after {meter['bytes']} bytes")
+                yield sse_error_event(APIError(502, "Upstream stream ended unexpectedly", "upstream_incomplete"),
+                                      meter)
+                return
+            yield from emit(part for part in splitter.flush()
+                            if "content" in part or REASONING_MODE != "drop")
+            finish_reason = parser.final_reason()
+            if cacheable and finish_reason == "stop":
+                completion_cache.put(cache_key, akash_data["model"], "".join(content_buffer), finish_reason,
+                                     "".join(reasoning_buffer))
+            yield f"data: {json.dumps(build_chunk(chat_id, data.get('model'), {}, finish_reason))}\n\n"
+            if include_usage(data):
+                yield f"data: {json.dumps(build_usage_chunk(chat_id, data.get('model'), current_usage()))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        # 非流式请求由 collect_completion 聚合，不需要心跳
+        keepalive = SSE_KEEPALIVE_INTERVAL if data.get("stream") is not False else 0
+        stream = stream_to_client(request, record_usage(generate()), response, session, meter, slot, timeouts, started,
+                                  keepalive)
+        if data.get("stream") is False:
+            result = await collect_completion(stream, chat_id, akash_data["model"])
+            if "error" in result:
+                return JSONResponse(status_code=stream_error_status(result), content=result)
+            return JSONResponse(result)
+        
+        return StreamingResponse(
+            stream,
+            media_type='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'Connection': 'keep-alive',
+                'Content-Type': 'text/event-stream'
+            }
+        )
+    except BaseException:
+        session.close()
+        raise
 
 @app.get("/v1/models")
 async def list_models(
     background_tasks: BackgroundTasks,
+    api_key: str = Depends(get_optional_api_key),
+    upstream: None = Depends(require_upstream("models")),
     cookie: str = Depends(validate_cookie)
 ):
+    """OpenAI 兼容的模型列表，用量按 api_key 记在 models 名下"""
     try:
-        # 获取随机浏览器指纹
-        fingerprint = get_random_browser_fingerprint()
-        logger.info(f"Using browser fingerprint: {fingerprint['user_agent']}")
+        # 使用与 cookie 绑定的浏览器指纹
+        fingerprint = current_fingerprint()
+        logger.debug(f"Using browser fingerprint: {fingerprint.user_agent}")
         
         # 构建更符合实际请求的请求头
-        headers = fingerprint["headers"]
+        headers = fingerprint.headers
         
         # 记录当前使用的 cookie（部分隐藏）
         cookie_start = cookie[:20]
@@ -1222,53 +3426,46 @@ async def list_models(
         logger.info(f"Using cookie: {cookie_start}...{cookie_end}")
         logger.info("Sending request to get models...")
         
-        with requests.Session() as session:
-            # 设置会话的默认请求头
-            session.headers.update(headers)
+        session = new_upstream_session(fingerprint)
+        try:
             
-            # 解析 cookie 字符串到字典
-            cookies_dict = {}
-            for cookie_item in cookie.split(';'):
-                if '=' in cookie_item:
-                    name, value = cookie_item.strip().split('=', 1)
-                    cookies_dict[name] = value
+            def send_models(identity, base_url):
+                cookies_dict, _ = identity
+                return session.get(
+                    f'{base_url}/api/models',
+                    cookies=cookies_dict,
+                    timeout=settings.timeouts().request
+                )
             
-            response = session.get(
-                'https://chat.akash.network/api/models',
-                cookies=cookies_dict
-            )
+            response, _ = await request_upstream(send_models, [(parse_cookie_string(cookie), headers)], breaker=circuit_breakers["models"])
             
             logger.info(f"Models response status: {response.status_code}")
         
             # 检查响应状态码，如果是 401 或 403，尝试刷新 cookie 并重试
             if response.status_code in [401, 403]:
+                cookie_stats["challenges"] += 1
                 logger.info(f"Authentication failed with status {response.status_code}, refreshing cookie...")
                 new_cookie = await refresh_cookie()
                 if new_cookie:
                     logger.info("Successfully refreshed cookie, retrying request")
-                    
-                    # 解析新 cookie 字符串到字典
-                    new_cookies_dict = {}
-                    for cookie_item in new_cookie.split(';'):
-                        if '=' in cookie_item:
-                            name, value = cookie_item.strip().split('=', 1)
-                            new_cookies_dict[name] = value
-                    
-                    response = session.get(
-                        'https://chat.akash.network/api/models',
-                        cookies=new_cookies_dict
-                    )
+                    response.close()
+                    # 新 cookie 绑定采集时的指纹，重试需换用新指纹的会话
+                    fingerprint = current_fingerprint()
+                    session.close()
+                    session = new_upstream_session(fingerprint)
+                    response, _ = await request_upstream(send_models, [(parse_cookie_string(new_cookie), fingerprint.headers)],
+                                                         breaker=circuit_breakers["models"])
         
             if response.status_code not in [200, 201]:
-                logger.error(f"Akash API error: Status {response.status_code}, Response: {response.text}")
-                return {"error": f"Authentication failed. Status: {response.status_code}"}
+                logger.error(f"Akash API error: Status {response.status_code}, Response: {response.text[:200]}")
+                raise upstream_status_error(response)
         
             try:
                 akash_response = response.json()
                 logger.info(f"Received models data of type: {type(akash_response)}")
             except ValueError:
                 logger.error(f"Invalid JSON response: {response.text[:100]}...")
-                return {"error": "Invalid response format"}
+                raise APIError(502, "Akash returned an invalid models response", "upstream_invalid_response")
             
             # 检查响应格式并适配
             models_list = []
@@ -1309,32 +3506,65 @@ async def list_models(
                 ]
             }
             
+            usage_meter.record(api_key, "models", requests=1)
             return openai_models
+        finally:
+            session.close()
             
+    except HTTPException:
+        usage_meter.record(api_key, "models", requests=1, errors=1)
+        raise
     except Exception as e:
-        logger.error(f"Error in list_models: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
-        return {"error": str(e)}
+        usage_meter.record(api_key, "models", requests=1, errors=1)
+        logger.error(f"Error in list_models: {e!r}", exc_info=not isinstance(e, RETRYABLE_EXCEPTIONS))
+        raise unexpected_error(e) from e
+
+# AkashGen 在聊天流中返回的图片任务信息
+IMAGE_JOB_PATTERN = re.compile(r"jobId='([^']+)' prompt='([^']+)' negative='([^']*)'")
+
+def image_message(chat_id: str, suffix: str, content: str) -> dict:
+    """AkashGen 图片生成过程中的单个消息块"""
+    return {
+        "id": f"chatcmpl-{chat_id}-{suffix}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "AkashGen",
+        "choices": [{
+            "delta": {"content": content},
+            "index": 0,
+            "finish_reason": None
+        }]
+    }
 
-async def process_image_generation(msg_data: str, session: requests.Session, headers: dict, chat_id: str) -> Optional[list]:
-    """处理图片生成的逻辑，返回多个消息块"""
+async def process_image_generation(msg_data: str, session: requests.Session, base_url: str, headers: dict,
+                                   chat_id: str):
+    """处理图片生成的逻辑，逐个产出消息块
+
+    先发送 <think> 开头，轮询期间任务状态每变化一次就发送一行进度，
+    结束后再发送用时、</think> 与图片（或失败说明）。任务在返回聊天流的上游 base_url 上轮询。
+    """
     # 检查消息中是否包含jobId
     if "jobId='undefined'" in msg_data or "jobId=''" in msg_data:
         logger.error("Image generation failed: jobId is undefined or empty")
-        return create_error_messages(chat_id, "Akash官网服务异常，无法生成图片,请稍后再试。")
+        for message in create_error_messages(chat_id, "Akash官网服务异常，无法生成图片,请稍后再试。"):
+            yield message
+        return
         
-    match = re.search(r"jobId='([^']+)' prompt='([^']+)' negative='([^']*)'", msg_data)
+    match = IMAGE_JOB_PATTERN.search(msg_data)
     if not match:
         logger.error(f"Failed to extract job_id from message: {msg_data[:100]}...")
-        return create_error_messages(chat_id, "无法解析图片生成任务。请稍后再试。")
+        for message in create_error_messages(chat_id, "无法解析图片生成任务。请稍后再试。"):
+            yield message
+        return
         
     job_id, prompt, negative = match.groups()
     
     # 检查job_id是否有效
     if not job_id or job_id == 'undefined' or job_id == 'null':
         logger.error(f"Invalid job_id: {job_id}")
-        return create_error_messages(chat_id, "Akash服务异常，无法获取有效的任务ID。请稍后再试。")
+        for message in create_error_messages(chat_id, "Akash服务异常，无法获取有效的任务ID。请稍后再试。"):
+            yield message
+        return
     
     print(f"Starting image generation process for job_id: {job_id}")
     print(f"Job ID format check - Length: {len(job_id)}, Contains hyphens: {'-' in job_id}")
@@ -1349,87 +3579,370 @@ async def process_image_generation(msg_data: str, session: requests.Session, hea
     # 记录开始时间
     start_time = time.time()
     
-    # 发送思考开始的消息
-    think_msg = "<think>\n"
-    think_msg += "🎨 Generating image...\n\n"
-    think_msg += f"Prompt: {prompt}\n"
+    # 立即发送思考开始的消息
+    yield image_message(chat_id, "think", f"<think>\n🎨 Generating image...\n\nPrompt: {prompt}\n")
     
+    statuses = asyncio.Queue()
+    task = asyncio.ensure_future(check_image_status(session, base_url, full_job_id, short_job_id, headers,
+                                                    statuses.put_nowait))
     try:
-        # 检查图片状态和上传
-        result = await check_image_status(session, full_job_id, short_job_id, headers)
-        
-        # 计算实际花费的时间
-        elapsed_time = time.time() - start_time
-        
-        # 完成思考部分
-        think_msg += f"\n🤔 Thinking for {elapsed_time:.1f}s...\n"
-        think_msg += "</think>"
-        
-        # 返回两个独立的消息块
-        messages = []
-        
-        # 第一个消息块：思考过程
-        messages.append({
-            "id": f"chatcmpl-{chat_id}-think",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": "AkashGen",
-            "choices": [{
-                "delta": {"content": think_msg},
-                "index": 0,
-                "finish_reason": None
-            }]
-        })
-        
-        # 第二个消息块：图片结果
-        if result:
-            image_msg = f"\n\n![Generated Image]({result})"
-            messages.append({
-                "id": f"chatcmpl-{chat_id}-image",
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": "AkashGen",
-                "choices": [{
-                    "delta": {"content": image_msg},
-                    "index": 0,
-                    "finish_reason": None
-                }]
-            })
-        else:
-            fail_msg = "\n\n*Image generation or upload failed.*"
-            messages.append({
-                "id": f"chatcmpl-{chat_id}-fail",
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": "AkashGen",
-                "choices": [{
-                    "delta": {"content": fail_msg},
-                    "index": 0,
-                    "finish_reason": None
-                }]
-            })  
-        return messages
+        # 轮询期间把任务状态变化作为进度行转发
+        while not task.done() or not statuses.empty():
+            next_status = asyncio.ensure_future(statuses.get())
+            done, _ = await asyncio.wait({next_status, task}, return_when=asyncio.FIRST_COMPLETED)
+            if next_status not in done:
+                next_status.cancel()
+                continue
+            yield image_message(chat_id, "progress", f"⏳ {next_status.result()} ({time.time() - start_time:.1f}s)\n")
+        result = task.result()
     except Exception as e:
         logger.error(f"Error in image generation process: {e}")
         import traceback
         logger.error(f"Traceback: {traceback.format_exc()}")
-        return create_error_messages(chat_id, "图片生成过程中发生错误。请稍后再试。")
+        yield image_message(chat_id, "think", "</think>")
+        for message in create_error_messages(chat_id, "图片生成过程中发生错误。请稍后再试。"):
+            yield message
+        return
+    finally:
+        task.cancel()
+    
+    # 计算实际花费的时间并结束思考部分
+    elapsed_time = time.time() - start_time
+    yield image_message(chat_id, "think", f"\n🤔 Thinking for {elapsed_time:.1f}s...\n</think>")
+    
+    if result:
+        yield image_message(chat_id, "image", f"\n\n![Generated Image]({result})")
+    else:
+        yield image_message(chat_id, "fail", "\n\n*Image generation or upload failed.*")
 
 def create_error_messages(chat_id: str, error_message: str) -> list:
     """创建错误消息块"""
-    return [{
-        "id": f"chatcmpl-{chat_id}-error",
-        "object": "chat.completion.chunk",
-        "created": int(time.time()),
+    return [image_message(chat_id, "error", f"\n\n**❌ {error_message}**")]
+
+
+
+# 单次请求允许的最大图片数
+IMAGE_MAX_N = int(os.getenv("IMAGE_MAX_N", "4"))
+
+def read_image_job(response: requests.Response) -> Optional[tuple]:
+    """读取 AkashGen 聊天流直到出现任务信息，返回 (job_id, prompt)，随后立即关闭流"""
+    try:
+        for line in response.iter_lines():
+            if not line.startswith(b'0:'):
+                continue
+            text = json.loads(line[2:])
+            if "<image_generation>" not in text:
+                continue
+            match = IMAGE_JOB_PATTERN.search(text)
+            if not match or match.group(1) in ('undefined', 'null'):
+                logger.error(f"Failed to extract job_id from message: {text[:100]}...")
+                return None
+            return match.group(1), match.group(2)
+        return None
+    finally:
+        response.close()
+
+class ImageSubmission(NamedTuple):
+    """已提交的图片任务，以及提交时使用的会话与指纹（轮询与下载必须沿用同一身份）"""
+    job_id: str
+    revised_prompt: str
+    session: requests.Session
+    fingerprint: BrowserFingerprint
+    # 接受任务的上游地址，只有它知道这个任务 ID
+    base_url: str
+
+async def submit_image_job(prompt: str, cookie: str) -> ImageSubmission:
+    """通过 AkashGen 聊天接口提交图片任务，拿到任务 ID 后不再等待聊天流结束
+
+    返回的会话由调用方关闭；提交时 cookie 被拒并刷新后，会话与指纹换成新 cookie 对应的那一组。
+    """
+    body = encode_payload({
+        "id": str(uuid.uuid4()).replace('-', '')[:16],
+        "messages": [{"role": "user", "content": prompt, "parts": [{"type": "text", "text": prompt}]}],
         "model": "AkashGen",
-        "choices": [{
-            "delta": {"content": f"\n\n**❌ {error_message}**"},
-            "index": 0,
-            "finish_reason": None
-        }]
-    }]
+        "system": "You are a helpful assistant.",
+        "temperature": 0.85,
+        "topP": 1.0,
+        "context": []
+    })
+
+    def send_job(identity, base_url):
+        cookies_dict, headers = identity
+        return session.post(f'{base_url}/api/chat', data=body, cookies=cookies_dict, headers=headers, stream=True,
+                            timeout=transport_timeout(session, settings.timeouts("AkashGen"), stream=True))
+
+    fingerprint = current_fingerprint()
+    session = new_upstream_session(fingerprint)
+    # 提交阶段占用一个 AkashGen 上游槽位，轮询阶段不占用
+    slot = await upstream_limiter.acquire("AkashGen")
+    try:
+        identities = [(parse_cookie_string(cookie), fingerprint.headers)]
+        response, base_url = await request_upstream(send_job, identities, breaker=circuit_breakers["chat"])
+        if response.status_code in [401, 403]:
+            cookie_stats["challenges"] += 1
+            new_cookie = await refresh_cookie()
+            if new_cookie:
+                response.close()
+                # 新 cookie 绑定采集时的指纹，重试需换用新指纹的请求头与会话
+                fingerprint = current_fingerprint()
+                session.close()
+                session = new_upstream_session(fingerprint)
+                identities = [(parse_cookie_string(new_cookie), fingerprint.headers)]
+                response, base_url = await request_upstream(send_job, identities, breaker=circuit_breakers["chat"])
+        if response.status_code not in [200, 201]:
+            logger.error(f"Akash API error: Status {response.status_code}, Response: {response.text[:200]}")
+            error = upstream_status_error(response)
+            response.close()
+            raise error
+        job = await run_blocking(read_image_job, response)
+        if not job:
+            raise APIError(502, "Akash did not return a valid image job ID", "image_generation_failed")
+    except BaseException:
+        session.close()
+        raise
+    finally:
+        slot.release()
+    return ImageSubmission(*job, session, fingerprint, base_url)
+
+async def generate_image(prompt: str, cookie: str, response_format: str) -> dict:
+    """提交一个图片任务并等待结果，返回 OpenAI images 格式的单项"""
+    job = await submit_image_job(prompt, cookie)
+    job_id, revised_prompt, headers = job.job_id, job.revised_prompt, job.fingerprint.headers
+    with job.session as session:
+        short_job_id = job_id.replace('-', '')[:8] if '-' in job_id else job_id[:8]
+        result = await poll_image_job(session, job.base_url, job_id, headers)
+        if not result:
+            raise APIError(502, f"Image job {job_id} failed or timed out", "image_generation_failed")
+        if response_format == "b64_json":
+            image_data = await fetch_image_bytes(session, job.base_url, result, short_job_id, headers)
+            if not image_data:
+                raise APIError(502, f"Failed to download image for job {job_id}", "image_download_failed")
+            return {"b64_json": base64.b64encode(image_data).decode('ascii'), "revised_prompt": revised_prompt}
+        url = await resolve_image_url(session, job.base_url, result, job_id, short_job_id, headers)
+        if not url:
+            raise APIError(502, f"Failed to publish image for job {job_id}", "image_upload_failed")
+        return {"url": url, "revised_prompt": revised_prompt}
+
+def parse_image_request(data: dict) -> tuple:
+    """校验 OpenAI images 请求体，返回 (prompt, n, response_format)"""
+    prompt = data.get("prompt")
+    if not prompt or not isinstance(prompt, str):
+        raise APIError(400, "'prompt' is required", "invalid_value", "prompt")
+    try:
+        n = int(data.get("n") or 1)
+    except (TypeError, ValueError):
+        raise APIError(400, "'n' must be an integer", "invalid_value", "n")
+    if not 1 <= n <= IMAGE_MAX_N:
+        raise APIError(400, f"'n' must be between 1 and {IMAGE_MAX_N}", "invalid_value", "n")
+    response_format = data.get("response_format") or "url"
+    if response_format not in ("url", "b64_json"):
+        raise APIError(400, "'response_format' must be 'url' or 'b64_json'", "invalid_value", "response_format")
+    return prompt, n, response_format
+
+async def run_image_batch(prompt: str, n: int, response_format: str, cookie: str) -> list:
+    """并发执行 n 个图片任务（每个任务使用各自的会话），全部成功才返回图片列表
+
+    任一任务失败（包括被上游并发限制拒绝）时取消其余任务并抛出该异常，不返回少于 n 张的结果。
+    """
+    tasks = [asyncio.ensure_future(generate_image(prompt, cookie, response_format)) for _ in range(n)]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def image_batch_error(error: Exception) -> HTTPException:
+    """图片任务失败时返回给客户端的错误"""
+    logger.error(f"Image generation failed: {error!r}")
+    if isinstance(error, HTTPException):
+        return error
+    return unexpected_error(error)
+
+@app.post("/v1/images/generations")
+async def create_images(
+    request: Request,
+    api_key: str = Depends(check_rate_limit),
+    upstream: None = Depends(require_upstream("chat")),
+    cookie: str = Depends(validate_cookie)
+):
+    """OpenAI 兼容的图片生成接口，n>1 时并发提交多个 AkashGen 任务"""
+    prompt, n, response_format = parse_image_request(await read_json(request))
+    try:
+        images = await run_image_batch(prompt, n, response_format, cookie)
+    except Exception as e:
+        usage_meter.record(api_key, "AkashGen", requests=1, errors=1)
+        raise image_batch_error(e) from e
+    usage_meter.record(api_key, "AkashGen", requests=1)
+    return {"created": int(time.time()), "data": images}
+
+# 异步图片任务：保留时长、最大任务数与回调设置
+IMAGE_JOB_TTL = float(os.getenv("IMAGE_JOB_TTL", "3600"))
+IMAGE_JOB_MAX = int(os.getenv("IMAGE_JOB_MAX", "256"))
+IMAGE_CALLBACK_SECRET = os.getenv("IMAGE_CALLBACK_SECRET")
+IMAGE_CALLBACK_RETRIES = int(os.getenv("IMAGE_CALLBACK_RETRIES", "3"))
+# 允许的回调主机名（逗号分隔）；设置后只能回调这些主机，未设置时拒绝解析到内网、回环、链路本地等地址的主机
+IMAGE_CALLBACK_HOSTS = {host.strip().lower() for host in os.getenv("IMAGE_CALLBACK_HOSTS", "").split(",") if host.strip()}
+
+# 内存中的任务表：job_id -> 任务信息
+image_jobs = {}
+image_job_tasks = {}
+image_job_stats = {"submitted": 0, "succeeded": 0, "failed": 0, "callbacks_sent": 0, "callbacks_failed": 0}
+
+def prune_image_jobs():
+    """清理超过保留时长的已结束任务"""
+    cutoff = time.time() - IMAGE_JOB_TTL
+    for job_id in [job_id for job_id, job in image_jobs.items()
+                   if job["status"] in ("succeeded", "failed") and job["finished_at"] < cutoff]:
+        del image_jobs[job_id]
+
+def public_image_job(job: dict) -> dict:
+    """对外返回的任务信息，不包含回调地址与提交者"""
+    return {key: value for key, value in job.items() if key not in ("callback_url", "owner")}
+
+def sign_callback(body: bytes) -> dict:
+    """配置了 IMAGE_CALLBACK_SECRET 时为回调附加 HMAC-SHA256 签名"""
+    headers = {"Content-Type": "application/json"}
+    if IMAGE_CALLBACK_SECRET:
+        digest = hmac.new(IMAGE_CALLBACK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        headers["X-Akash2API-Signature"] = f"sha256={digest}"
+    return headers
+
+def callback_url_error(url: str) -> Optional[str]:
+    """检查回调地址能否使用，返回拒绝原因（可用时返回 None）
+
+    防止借回调让代理访问内网（SSRF）：主机不在 IMAGE_CALLBACK_HOSTS 中，
+    或未配置白名单时解析出的任一地址不是公网地址，都会被拒绝。会进行 DNS 解析，需在线程池中调用。
+    """
+    try:
+        parsed = urlparse(url)
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    except ValueError:
+        return "is not a valid URL"
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return "must be an http(s) URL"
+    host = parsed.hostname.lower()
+    if IMAGE_CALLBACK_HOSTS:
+        return None if host in IMAGE_CALLBACK_HOSTS else "host is not in IMAGE_CALLBACK_HOSTS"
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)}
+    except (socket.gaierror, UnicodeError):
+        return "host cannot be resolved"
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%", 1)[0])
+        if not ip.is_global or ip.is_multicast:
+            return f"host resolves to a non-public address ({ip})"
+    return None
+
+async def notify_image_callback(job: dict):
+    """任务结束后把任务信息 POST 到回调地址，失败时按退避重试
+
+    发送前重新校验地址，避免提交后 DNS 记录被改指向内网；不跟随重定向。
+    """
+    reason = await run_blocking(callback_url_error, job["callback_url"])
+    if reason:
+        logger.warning(f"Image job {job['id']} callback skipped: callback_url {reason}")
+        image_job_stats["callbacks_failed"] += 1
+        return
+    body = encode_payload(public_image_job(job))
+    headers = sign_callback(body)
+    for attempt in range(IMAGE_CALLBACK_RETRIES + 1):
+        try:
+            response = await run_blocking(requests.post, job["callback_url"], data=body, headers=headers,
+                                          timeout=settings.callback_timeout, allow_redirects=False)
+            response.close()
+            if response.status_code < 400:
+                image_job_stats["callbacks_sent"] += 1
+                return
+            logger.warning(f"Image job {job['id']} callback returned {response.status_code}")
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Image job {job['id']} callback failed: {e}")
+        if attempt < IMAGE_CALLBACK_RETRIES:
+            await asyncio.sleep(backoff_delay(attempt))
+    image_job_stats["callbacks_failed"] += 1
+
+async def run_image_job(job: dict, n: int, response_format: str, cookie: str, api_key: str):
+    """在后台执行异步图片任务并更新任务表
+
+    回调发送完才从 image_job_tasks 中移除，停机排空时会一并等待回调。
+    """
+    job["status"] = "running"
+    try:
+        try:
+            job["data"] = await run_image_batch(job["prompt"], n, response_format, cookie)
+            job["status"] = "succeeded"
+            image_job_stats["succeeded"] += 1
+        except asyncio.CancelledError:
+            # 停机时超过 DRAIN_TIMEOUT 仍未完成的任务
+            job["status"] = "failed"
+            job["error"] = {"status": 503, "message": "Server shut down before the job finished", "code": "server_shutdown"}
+            image_job_stats["failed"] += 1
+            raise
+        except Exception as e:
+            error = image_batch_error(e)
+            job["status"] = "failed"
+            job["error"] = {"status": error.status_code, "message": str(error.detail), "code": getattr(error, "code", None)}
+            image_job_stats["failed"] += 1
+        finally:
+            job["finished_at"] = time.time()
+            usage_meter.record(api_key, "AkashGen", requests=1, errors=int(job["status"] == "failed"))
+        if job["callback_url"]:
+            await notify_image_callback(job)
+    finally:
+        image_job_tasks.pop(job["id"], None)
 
+@app.post("/v1/images/jobs", status_code=202)
+async def create_image_job(
+    request: Request,
+    api_key: str = Depends(check_rate_limit),
+    upstream: None = Depends(require_upstream("chat")),
+    cookie: str = Depends(validate_cookie)
+):
+    """异步图片接口：立即返回任务 ID，结果通过轮询或回调获取"""
+    data = await read_json(request)
+    prompt, n, response_format = parse_image_request(data)
+    callback_url = data.get("callback_url")
+    if callback_url is not None:
+        reason = "must be an http(s) URL"
+        if isinstance(callback_url, str):
+            reason = await run_blocking(callback_url_error, callback_url)
+        if reason:
+            raise APIError(400, f"'callback_url' {reason}", "invalid_value", "callback_url")
+
+    prune_image_jobs()
+    if len(image_jobs) >= IMAGE_JOB_MAX:
+        raise APIError(429, "Too many image jobs", "image_jobs_full", headers={"Retry-After": "30"})
 
+    job_id = f"imgjob-{uuid.uuid4().hex}"
+    job = {
+        "id": job_id,
+        "object": "image.job",
+        "status": "queued",
+        "created": int(time.time()),
+        "prompt": prompt,
+        "n": n,
+        "response_format": response_format,
+        "callback_url": callback_url,
+        # 提交任务的 key 名称，只有同一个 key 能查询该任务
+        "owner": api_key,
+        "data": None,
+        "error": None,
+        "finished_at": None
+    }
+    image_jobs[job_id] = job
+    image_job_stats["submitted"] += 1
+    # 保存任务引用，避免被垃圾回收
+    image_job_tasks[job_id] = asyncio.create_task(run_image_job(job, n, response_format, cookie, api_key))
+    return JSONResponse(status_code=202, content=public_image_job(job), headers={"Location": f"/v1/images/jobs/{job_id}"})
+
+@app.get("/v1/images/jobs/{job_id}")
+async def get_image_job(job_id: str, api_key: str = Depends(get_api_key)):
+    """查询异步图片任务状态；其他 key 提交的任务按不存在处理"""
+    job = image_jobs.get(job_id)
+    if not job or job["owner"] != api_key:
+        raise APIError(404, f"Image job {job_id} not found", "image_job_not_found")
+    return public_image_job(job)
 
 async def upload_to_xinyew(image_data: bytes, job_id: str) -> Optional[str]:
     """上传图片到新野图床并返回URL"""
@@ -1462,11 +3975,12 @@ async def upload_to_xinyew(image_data: bytes, job_id: str) -> Optional[str]:
             }
             
             print("Sending request to xinyew API...")
-            response = requests.post(
-                'https://api.xinyew.cn/api/jdtc',  # 使用正确的API地址
+            response = await run_blocking(
+                requests.post,
+                settings.image_upload_url,
                 files=files,
                 headers=headers,
-                timeout=30
+                timeout=settings.image_upload_timeout
             )
             
             print(f"Upload response status: {response.status_code}")
@@ -1510,8 +4024,8 @@ async def upload_to_xinyew(image_data: bytes, job_id: str) -> Optional[str]:
 
 
 def auto_refresh_cookie():
-    """自动刷新 cookie 的线程函数"""
-    while True:
+    """自动刷新 cookie 的线程函数，停机时由 shutdown_event 唤醒退出"""
+    while not shutdown_event.is_set():
         try:
             current_time = time.time()
             # 只在 cookie 不存在或已过期时刷新
@@ -1539,15 +4053,15 @@ def auto_refresh_cookie():
                     gc.collect()
             
             # 每60秒检查一次
-            time.sleep(60)
+            shutdown_event.wait(60)
         except Exception as e:
             logger.error(f"Error in auto-refresh thread: {e}")
             global_data["is_refreshing"] = False  # 确保出错时也重置标志
             # 强制执行垃圾回收，释放内存
             import gc
             gc.collect()
-            time.sleep(60)  # 出错后等待60秒再继续
+            shutdown_event.wait(60)  # 出错后等待60秒再继续
 
 if __name__ == '__main__':
     import uvicorn
-    uvicorn.run(app, host='0.0.0.0', port=9000)
+    uvicorn.run(app, host='0.0.0.0', port=9000, timeout_graceful_shutdown=DRAIN_TIMEOUT)
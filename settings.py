@@ -0,0 +1,109 @@
+"""Akash2API 上游配置：集中读取上游地址与 HTTP 超时
+
+所有取值在 load_settings() 调用时从环境变量读取一次（main.py 在 load_dotenv 之后调用）。
+AKASH_BASE_URLS 可配置多个镜像地址，第一个为主站（cookie 采集与指纹请求头均使用主站）。
+超时分为连接、首字节、流中两行之间的空闲与整体四类，后三类可按模型覆盖。
+"""
+import logging
+import os
+from typing import NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://chat.akash.network"
+DEFAULT_IMAGE_UPLOAD_URL = "https://api.xinyew.cn/api/jdtc"
+
+
+class UpstreamTimeouts(NamedTuple):
+    """一次上游调用的超时（秒，idle/total 为 0 表示不限制）"""
+    connect: float
+    first_byte: float
+    idle: float
+    total: float
+
+    @property
+    def request(self) -> Tuple[float, float]:
+        """requests / curl_cffi 使用的 (连接, 首字节) 超时"""
+        return (self.connect, self.first_byte)
+
+
+class Settings(NamedTuple):
+    # 上游地址，按配置顺序排列，第一个为主站
+    base_urls: Tuple[str, ...]
+    # 上游超时默认值
+    connect_timeout: float
+    first_byte_timeout: float
+    idle_timeout: float
+    total_timeout: float
+    # 按模型覆盖的首字节、空闲与整体超时
+    model_first_byte_timeouts: dict
+    model_idle_timeouts: dict
+    model_total_timeouts: dict
+    # 多个上游时探测各地址延迟的间隔与单次探测超时（秒）
+    probe_interval: float
+    probe_timeout: float
+    # 请求失败的上游在该时间内不再优先选择（秒）
+    failure_cooldown: float
+    # 图床上传接口及其超时
+    image_upload_url: str
+    image_upload_timeout: float
+    # 异步图片任务回调超时
+    callback_timeout: float
+
+    @property
+    def primary_url(self) -> str:
+        return self.base_urls[0]
+
+    def timeouts(self, model: Optional[str] = None) -> UpstreamTimeouts:
+        """指定模型的上游超时，未单独配置的项使用默认值"""
+        return UpstreamTimeouts(
+            connect=self.connect_timeout,
+            first_byte=self.model_first_byte_timeouts.get(model, self.first_byte_timeout),
+            idle=self.model_idle_timeouts.get(model, self.idle_timeout),
+            total=self.model_total_timeouts.get(model, self.total_timeout)
+        )
+
+
+def parse_base_urls(raw: str) -> Tuple[str, ...]:
+    """解析逗号分隔的上游地址，去掉末尾的 / 与重复项"""
+    urls = []
+    for item in raw.split(","):
+        url = item.strip().rstrip("/")
+        if url and url not in urls:
+            urls.append(url)
+    return tuple(urls)
+
+
+def parse_model_timeouts(raw: Optional[str]) -> dict:
+    """解析形如 "AkashGen=180,DeepSeek-R1=90" 的按模型超时"""
+    timeouts = {}
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        try:
+            timeouts[name.strip()] = float(value.strip())
+        except ValueError:
+            logger.warning(f"Ignoring invalid model timeout entry: {item}")
+    return timeouts
+
+
+def load_settings() -> Settings:
+    base_urls = parse_base_urls(os.getenv("AKASH_BASE_URLS") or os.getenv("AKASH_BASE_URL") or DEFAULT_BASE_URL)
+    return Settings(
+        base_urls=base_urls or (DEFAULT_BASE_URL,),
+        connect_timeout=float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10")),
+        first_byte_timeout=float(os.getenv("UPSTREAM_FIRST_BYTE_TIMEOUT", "60")),
+        idle_timeout=float(os.getenv("UPSTREAM_IDLE_TIMEOUT", "60")),
+        total_timeout=float(os.getenv("UPSTREAM_TOTAL_TIMEOUT", "600")),
+        model_first_byte_timeouts=parse_model_timeouts(os.getenv("UPSTREAM_FIRST_BYTE_TIMEOUTS")),
+        # AkashGen 的聊天流在轮询图片任务期间没有新数据，默认放宽空闲超时
+        model_idle_timeouts=parse_model_timeouts(os.getenv("UPSTREAM_IDLE_TIMEOUTS", "AkashGen=180")),
+        model_total_timeouts=parse_model_timeouts(os.getenv("UPSTREAM_TOTAL_TIMEOUTS")),
+        probe_interval=float(os.getenv("UPSTREAM_PROBE_INTERVAL", "30")),
+        probe_timeout=float(os.getenv("UPSTREAM_PROBE_TIMEOUT", "5")),
+        failure_cooldown=float(os.getenv("UPSTREAM_FAILURE_COOLDOWN", "30")),
+        image_upload_url=os.getenv("IMAGE_UPLOAD_URL", DEFAULT_IMAGE_UPLOAD_URL),
+        image_upload_timeout=float(os.getenv("IMAGE_UPLOAD_TIMEOUT", "30")),
+        callback_timeout=float(os.getenv("IMAGE_CALLBACK_TIMEOUT", "10"))
+    )
@@ -0,0 +1,23 @@
+from bench.client import latency_summary, percentile
+
+
+def test_percentile_nearest_rank():
+    samples = list(range(1, 101))
+    assert percentile(samples, 7) == 7
+    assert percentile(samples, 50) == 50
+    assert percentile(samples, 90) == 90
+    assert percentile(samples, 99) == 99
+    assert percentile(samples, 100) == 100
+    assert percentile(samples, 0) == 1
+
+
+def test_percentile_small_and_unsorted_samples():
+    assert percentile([0.3, 0.1, 0.2], 50) == 0.2
+    assert percentile([0.3, 0.1, 0.2], 99) == 0.3
+    assert percentile([0.5], 99) == 0.5
+    assert percentile([], 50) is None
+
+
+def test_latency_summary_tail_is_not_the_maximum():
+    summary = latency_summary([i / 100 for i in range(1, 101)])
+    assert summary["p99"] == 0.99